@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark of ratking's compiled cron schedules against APScheduler's CronTrigger.
+
+Times compiling the schedules of a job table (many jobs share a schedule, as they do
+in practice), and computing next fire times from random start times.
+
+    python benchmarks/bench_cron.py [--jobs 10000] [--schedules 200] [--lookups 100000]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from apscheduler.triggers import CronTrigger
+from ratking import cron
+
+
+def random_schedule(rand):
+
+    minute = rand.choice(['*', '*/5', '*/15', '0', '30', '0,30', '10-20'])
+    hour = rand.choice(['*', '*/2', '0', '6', '9-17', '0,12'])
+    day = rand.choice(['*', '*', '*', '1', '15', '1,15', '*/2'])
+    month = rand.choice(['*', '*', '*', '1', '*/3', '6-8'])
+    weekday = rand.choice(['*', '*', '*', '1-5', '0', '6'])
+
+    return ' '.join([minute, hour, day, month, weekday])
+
+
+def apscheduler_trigger(schedule):
+    """the CronTrigger ratking used to build: every field but day of month"""
+
+    minute, hour, day, month, weekday = schedule.split()
+
+    return CronTrigger(minute=minute, hour=hour, month=month, day_of_week=weekday)
+
+
+def compiled_trigger(schedule):
+    return cron.compile_schedule(schedule)
+
+
+def bench_compile(build, schedules):
+
+    start = time.time()
+
+    for schedule in schedules:
+        build(schedule)
+
+    return time.time() - start
+
+
+def bench_next_fire(triggers, starts):
+
+    start = time.time()
+
+    for trigger, when in zip(triggers, starts):
+        trigger.get_next_fire_time(when)
+
+    return time.time() - start
+
+
+def main(args):
+
+    rand = random.Random(args.seed)
+
+    distinct = [ random_schedule(rand) for i in range(args.schedules) ]
+    schedules = [ rand.choice(distinct) for i in range(args.jobs) ]
+
+    base = datetime(2026, 1, 1)
+    starts = [ base + timedelta(seconds=rand.randint(0, 365 * 86400)) for i in range(args.lookups) ]
+
+    # drawn once, so both triggers are timed on the same schedules
+    lookups = [ rand.choice(distinct) for i in range(args.lookups) ]
+
+    print "%d jobs, %d distinct schedules, %d next fire time lookups" % (args.jobs, args.schedules, args.lookups)
+    print '{0: <12} {1: >14} {2: >14} {3: >16}'.format('Trigger', 'Compile (s)', 'Lookups (s)', 'Lookups/s')
+    print '=' * 60
+
+    for name, build in (('apscheduler', apscheduler_trigger), ('compiled', compiled_trigger)):
+        cron._compiled.clear()
+
+        compile_time = bench_compile(build, schedules)
+
+        triggers = [ build(schedule) for schedule in lookups ]
+        lookup_time = bench_next_fire(triggers, starts)
+
+        print '{0: <12} {1: >14.4f} {2: >14.4f} {3: >16.0f}'.format(name, compile_time, lookup_time,
+                args.lookups / lookup_time)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='benchmark cron schedule compilation and next fire times')
+    parser.add_argument('--jobs',
+                        default=10000,
+                        type=int,
+                        help='jobs whose schedules get compiled (default: 10000)')
+    parser.add_argument('--schedules',
+                        default=200,
+                        type=int,
+                        help='distinct schedules among the jobs (default: 200)')
+    parser.add_argument('--lookups',
+                        default=100000,
+                        type=int,
+                        help='next fire time computations (default: 100000)')
+    parser.add_argument('--seed',
+                        default=1,
+                        type=int,
+                        help='random seed (default: 1)')
+
+    main(parser.parse_args())
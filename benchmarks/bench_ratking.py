@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+"""
+Benchmark of ratking's import, dispatch and rpc paths, with the daemon's components in-process.
+
+Generates a job_dir with --jobs jobfiles and a plugin_dir with a do-nothing plugin, and starts
+a SchedCtl and RpcCtl on them with test_mode on, so runs don't fork. Then times:
+
+    import      - import_jobs of the whole job_dir
+    grow        - add_job, disable_job and enable_job latency, as --grow more jobs are added
+    firing      - runs per second the scheduler fires and runs, with its clock fast-forwarded
+                  from one wakeup to the next instead of waiting for it
+    show_jobs   - show_jobs latency in-process and over xmlrpc, and the size of its response
+
+Results are printed as JSON (or written to --output), to compare runs before and after a change.
+
+    python benchmarks/bench_ratking.py [--jobs 2000] [--engine apscheduler|heap] [--output FILE]
+"""
+import argparse
+import ConfigParser
+import getpass
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import xmlrpclib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from apscheduler.scheduler import Scheduler
+from ratking.engine import SchedCtl
+from ratking.rpchandler import RpcCtl
+from ratking.scheduler import HeapScheduler
+
+
+PLUGIN = "def main(**kwargs):\n    pass\n"
+
+JOBFILE = """[{name}]
+type = {type}
+schedule = {schedule}
+owner = {owner}
+plugin_name = bench.py
+kwargs = {{'job_name': '{name}'}}
+enabled = true
+autostart = true
+"""
+
+
+def random_schedule(rand):
+    """schedules that fire at least every two hours, so the firing benchmark doesn't skip ahead far"""
+
+    return rand.choice([
+        '*/%d * * * *' % rand.choice([1, 2, 5, 10, 15, 30]),
+        '%d * * * *' % rand.randint(0, 59),
+        '%d */2 * * *' % rand.randint(0, 59),
+        '0,30 * * * *',
+        ])
+
+
+def write_jobfiles(job_dir, prefix, count, owner, rand):
+    """writes count jobfiles named <prefix><n>.conf, returns their paths"""
+
+    paths = []
+
+    for i in range(count):
+        name = '%s%d' % (prefix, i)
+        path = os.path.join(job_dir, name + '.conf')
+
+        with open(path, 'w') as f:
+            f.write(JOBFILE.format(name=name, type=rand.choice(['plugin', 'backup', 'report']),
+                    schedule=random_schedule(rand), owner=owner))
+
+        paths.append(path)
+
+    return paths
+
+
+def make_config(root, args):
+
+    config = ConfigParser.SafeConfigParser()
+    config.add_section('main')
+    config.add_section('xmlrpc')
+
+    options = [
+        ('job_dir', os.path.join(root, 'jobs.d')),
+        ('plugin_dir', os.path.join(root, 'plugins.d')),
+        ('lib_dir', root),
+        ('test_mode', '1'),
+        ('valid_users', getpass.getuser()),
+        ('scheduler_engine', args.engine),
+        ]
+
+    if args.import_workers:
+        options.append(('import_workers', str(args.import_workers)))
+
+    for option, value in options:
+        config.set('main', option, value)
+
+    config.set('xmlrpc', 'host', '127.0.0.1')
+    config.set('xmlrpc', 'port', '0')
+    config.set('xmlrpc', 'url', '/RPC2')
+
+    return config
+
+
+def percentiles(samples):
+    """min, p50, p90, p99 and max of a list of seconds, in ms"""
+
+    samples = sorted(samples)
+
+    if not samples:
+        return {}
+
+    def at(fraction):
+        return round(samples[min(len(samples) - 1, int(len(samples) * fraction))] * 1000, 4)
+
+    return {'count': len(samples), 'min_ms': at(0), 'p50_ms': at(0.5), 'p90_ms': at(0.9), 'p99_ms': at(0.99),
+            'max_ms': at(1)}
+
+
+def timed(func, *args):
+    """calls func(*args), returns (seconds it took, what it returned)"""
+
+    start = time.time()
+    result = func(*args)
+
+    return time.time() - start, result
+
+
+def bench_grow(rpc, job_dir, owner, args, rand):
+    """adds --grow jobs in --steps steps, and times disable/enable of --samples jobs after each step"""
+
+    jobctl = rpc.rpcreq
+    paths = write_jobfiles(job_dir, 'grow', args.grow, owner, rand)
+    step = max(1, args.grow // args.steps)
+    results = []
+
+    for i in range(0, len(paths), step):
+        adds = []
+        disables = []
+        enables = []
+
+        for path in paths[i:i + step]:
+            took, (returncode, output) = timed(rpc.add_job, path, owner, owner)
+
+            if returncode is False:
+                raise RuntimeError("add_job of %s failed: %s" % (path, output))
+
+            adds.append(took)
+
+        names = rand.sample(sorted(jobctl.job_index), min(args.samples, len(jobctl.job_index)))
+
+        for name in names:
+            took, (returncode, output) = timed(rpc.disable_job, name, owner, owner)
+            disables.append(took)
+
+            took, (returncode, output) = timed(rpc.enable_job, name, owner, owner)
+            enables.append(took)
+
+        results.append({'jobs': len(jobctl.job_index), 'add_job': percentiles(adds),
+                'disable_job': percentiles(disables), 'enable_job': percentiles(enables)})
+
+    return results
+
+
+def fire_due(sched, now):
+    """does what a scheduler wakeup at now does: hands every job due by then to the thread pool"""
+
+    if isinstance(sched, HeapScheduler):
+        due = sched._pop_due(now)
+
+        for i in xrange(0, len(due), sched.batch_size):
+            sched._threadpool.submit(sched._run_batch, due[i:i + sched.batch_size])
+
+        with sched._lock:
+            return sched._heap[0][0] if sched._heap else None
+
+    return sched._process_jobs(now)
+
+
+def bench_firing(sched, args):
+    """
+    fires --fires runs, moving the scheduler's clock straight to the next wakeup once the runs of
+    the last one are done (as they would be a minute later). the scheduler thread is stopped
+    first, the thread pool stays up to run the jobs
+    """
+
+    if isinstance(sched, HeapScheduler):
+        sched.shutdown(wait=True, shutdown_threadpool=False)
+
+    else:
+        sched.shutdown(wait=True, shutdown_threadpool=False, close_jobstores=False)
+
+    jobs = sched.get_jobs()
+    completed = [0]
+    done = threading.Condition()
+
+    def counted(func):
+
+        def run(*a, **kw):
+
+            try:
+                return func(*a, **kw)
+
+            finally:
+
+                with done:
+                    completed[0] += 1
+                    done.notify()
+
+        return run
+
+    for job in jobs:
+        job.func = counted(job.func)
+
+    runs_before = sum(job.runs for job in jobs)
+    fired = 0
+    wakeups = []
+    now = min(job.next_run_time for job in jobs)
+    start = time.time()
+
+    while now is not None and fired < args.fires:
+        took, now = timed(fire_due, sched, now)
+        wakeups.append(took)
+        fired = sum(job.runs for job in jobs) - runs_before
+
+        # a run skipped by the scheduler never completes, give up on it after a while
+        with done:
+            waited = time.time()
+
+            while completed[0] < fired and time.time() - waited < 5.0:
+                done.wait(1.0)
+
+    elapsed = time.time() - start
+
+    sched._threadpool.shutdown(True)
+
+    return {'scheduled_jobs': len(jobs), 'wakeups': len(wakeups), 'fired': fired, 'completed': completed[0],
+            'elapsed': round(elapsed, 4), 'runs_per_second': round(completed[0] / elapsed, 1),
+            'wakeup': percentiles(wakeups)}
+
+
+def bench_show_jobs(rpc, args):
+    """show_jobs called directly and over xmlrpc through the daemon's rpc server"""
+
+    local = [ timed(rpc.show_jobs)[0] for i in range(args.rpc_calls) ]
+
+    server = threading.Thread(target=rpc.start_instance, name='bench-rpc')
+    server.daemon = True
+    server.start()
+
+    while getattr(rpc, 'server', None) is None:
+        time.sleep(0.01)
+
+    proxy = xmlrpclib.ServerProxy('http://%s:%d/RPC2' % rpc.server.server_address)
+    remote = [ timed(proxy.show_jobs)[0] for i in range(args.rpc_calls) ]
+
+    rpc.server.shutdown()
+    rpc.server.server_close()
+
+    output = rpc.show_jobs()
+
+    return {'lines': len(output), 'payload_bytes': len(xmlrpclib.dumps((output,), methodresponse=True)),
+            'in_process': percentiles(local), 'xmlrpc': percentiles(remote)}
+
+
+def main(args):
+
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+
+    rand = random.Random(args.seed)
+    owner = getpass.getuser()
+    root = args.root or tempfile.mkdtemp(prefix='ratking-bench-')
+    job_dir = os.path.join(root, 'jobs.d')
+    plugin_dir = os.path.join(root, 'plugins.d')
+
+    for directory in (job_dir, plugin_dir):
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    with open(os.path.join(plugin_dir, 'bench.py'), 'w') as f:
+        f.write(PLUGIN)
+
+    sys.path.append(plugin_dir)
+
+    write_jobfiles(job_dir, 'job', args.jobs, owner, rand)
+
+    config = make_config(root, args)
+    sched = HeapScheduler() if args.engine == 'heap' else Scheduler()
+
+    results = {
+        'benchmark': 'ratking',
+        'engine': args.engine,
+        'jobs': args.jobs,
+        'python': platform.python_version(),
+        'cpus': os.sysconf('SC_NPROCESSORS_ONLN'),
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }
+
+    try:
+        # the order ratkingd starts them in
+        schedctl = SchedCtl(sched, config, logging)
+        schedctl.initialize()
+
+        took, summary = timed(schedctl.import_jobs)
+        results['import'] = {'elapsed': round(took, 4), 'added': summary['added'], 'failed': len(summary['failed']),
+                'jobs_per_second': round(summary['added'] / took, 1)}
+
+        rpc = RpcCtl(sched, config, logging, schedctl)
+
+        results['grow'] = bench_grow(rpc, job_dir, owner, args, rand)
+        results['show_jobs'] = bench_show_jobs(rpc, args)
+        results['firing'] = bench_firing(sched, args)
+
+    finally:
+        sched.shutdown(wait=False)
+
+        if not args.root and not args.keep:
+            shutil.rmtree(root)
+
+    report = json.dumps(results, indent=2, sort_keys=True)
+
+    if args.output:
+
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+
+    else:
+        print report
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='benchmark jobfile import, job add/disable, firing and show_jobs')
+    parser.add_argument('--jobs',
+                        default=2000,
+                        type=int,
+                        help='jobfiles in the generated job_dir (default: 2000)')
+    parser.add_argument('--grow',
+                        default=2000,
+                        type=int,
+                        help='jobs added one at a time after the import (default: 2000)')
+    parser.add_argument('--steps',
+                        default=10,
+                        type=int,
+                        help='steps the added jobs are timed in (default: 10)')
+    parser.add_argument('--samples',
+                        default=100,
+                        type=int,
+                        help='jobs disabled and enabled again after each step (default: 100)')
+    parser.add_argument('--fires',
+                        default=20000,
+                        type=int,
+                        help='runs fired for the firing benchmark (default: 20000)')
+    parser.add_argument('--rpc-calls',
+                        default=20,
+                        type=int,
+                        dest='rpc_calls',
+                        help='show_jobs calls, in-process and over xmlrpc (default: 20)')
+    parser.add_argument('--engine',
+                        default='apscheduler',
+                        choices=['apscheduler', 'heap'],
+                        help='scheduler_engine to benchmark (default: apscheduler)')
+    parser.add_argument('--import-workers',
+                        default=0,
+                        type=int,
+                        dest='import_workers',
+                        help='import_workers for the import (default: number of cpus)')
+    parser.add_argument('--root',
+                        default=None,
+                        help='directory to generate job_dir and plugin_dir in, and keep (default: a temporary one)')
+    parser.add_argument('--keep',
+                        action='store_true',
+                        default=False,
+                        help='keep the temporary directory')
+    parser.add_argument('--output',
+                        default=None,
+                        help='file to write the JSON results to (default: stdout)')
+    parser.add_argument('--seed',
+                        default=1,
+                        type=int,
+                        help='random seed (default: 1)')
+    parser.add_argument('--log-level',
+                        default='warning',
+                        dest='log_level',
+                        help='log level of the daemon components (default: warning)')
+
+    main(parser.parse_args())
@@ -2,13 +2,34 @@
 import argparse
 import ConfigParser
 import exceptions
+import httplib
 import os
 import socket
 import StringIO
 import sys
+import time
 import xmlrpclib
 
 
+class UnixStreamHTTPConnection(httplib.HTTPConnection):
+    """HTTP connection over a unix domain socket, host is the socket path"""
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.host)
+
+
+class UnixStreamTransport(xmlrpclib.Transport):
+    """xmlrpclib transport that talks to ratkingd's unix socket"""
+
+    def __init__(self, socket_path):
+        xmlrpclib.Transport.__init__(self)
+        self.socket_path = socket_path
+
+    def make_connection(self, host):
+        return UnixStreamHTTPConnection(self.socket_path)
+
+
 def read_config(config_file):
 
     parser=ConfigParser.SafeConfigParser()
@@ -27,48 +48,356 @@ def read_config(config_file):
 
 
 
-def main(args):
+def selector(args, name):
+    """builds a bulk operation selector from a jobname glob and the --owner/--type options"""
 
-    config = read_config('/opt/storage/python/ratking/etc/ratkingd.conf')
+    sel = {}
 
-    server_url = 'http://'+config.get('xmlrpc', 'host')+':'+config.get('xmlrpc', 'port')+config.get('xmlrpc', 'url')
-    s = xmlrpclib.ServerProxy(server_url)
+    # '*' means "any name", so --owner/--type alone can select jobs
+    if name != '*':
+        sel['name'] = name
 
-    realuser = os.getlogin()
-    user = os.environ['USER']
+    if args.owner:
+        sel['owner'] = args.owner
+
+    if args.type:
+        sel['type'] = args.type
 
-    test = True
+    return sel
 
-    # check if user running the client is allowed...
-    returncode,output = s.check_auth(user)
 
-    # no passing go broseph... 
+def format_results(result):
+    """turns the (returncode, [[job, returncode, output], ...]) of a bulk rpc into printable output"""
+
+    returncode, results = result
+
     if returncode is False:
-        print output
-        sys.exit(1)
+        return returncode, results
+
+    form = StringIO.StringIO()
+    failed = 0
+
+    for name, ok, output in results:
+        form.write("%-25s %-5s %s\n" % (name, 'OK' if ok else 'ERROR', output))
+
+        if not ok:
+            failed += 1
+
+    form.write("%d of %d succeeded." % (len(results) - failed, len(results)))
+
+    return failed == 0, form.getvalue()
+
+
+def list_jobs(s, args):
+    """pages through the daemon's list_jobs rpc and formats the records as a table"""
+
+    query = {'sort': args.sort, 'limit': 1000}
+
+    for key, value in (('name', args.name), ('owner', args.owner), ('status', args.jobstatus), ('type', args.type)):
+
+        if value:
+            query[key] = value
+
+    form = StringIO.StringIO()
+    form.write('{0: <25} {1: <15} {2: <15} {3: <10} {4}\n' \
+            .format('Jobname', 'Jobowner', 'JobType', 'Status', 'Next Run Time'))
+    form.write('='*110 + '\n')
+
+    total = 0
+
+    while True:
+        returncode, page = s.list_jobs(query)
+
+        if returncode is False:
+            return returncode, page
+
+        for name, owner, jobtype, status, next_run_time in page['jobs']:
+            form.write('{0: <25} {1: <15} {2: <15} {3: <10} {4}\n' \
+                    .format(name, owner, jobtype, status, next_run_time))
+
+        total += len(page['jobs'])
+
+        if not page['next_cursor']:
+            break
+
+        query['cursor'] = page['next_cursor']
+
+    if total == 0:
+        return False, "No jobs."
+
+    return True, form.getvalue()
+
+
+def job_history(s, args):
+    """formats the runs and duration percentiles from the daemon's job_history rpc"""
+
+    query = {'limit': args.limit}
+
+    if args.history != '*':
+        query['job'] = args.history
+
+    if args.since:
+        query['start'] = time.time() - args.since * 3600
+
+    returncode, history = s.job_history(query)
+
+    if returncode is False:
+        return returncode, history
+
+    if not history['runs']:
+        return False, "No runs recorded."
+
+    form = StringIO.StringIO()
+    form.write('{0: <25} {1: <8} {2: <20} {3: >10} {4: >8} {5: <8} {6: >5} {7: >9} {8: >10}\n' \
+            .format('Jobname', 'Run', 'Started', 'Duration', 'Lag', 'Status', 'Exit', 'CPU', 'MaxRSS'))
+    form.write('='*110 + '\n')
+
+    for run in history['runs']:
+        run = dict(zip(history['fields'], run))
+        lag = '%.2fs' % (run['start'] - run['scheduled']) if run['scheduled'] != '' else '-'
+        duration = '%.2fs' % run['duration'] if run['duration'] != '' else '-'
+        cpu = '%.2fs' % (run['utime'] + run['stime']) if run['utime'] != '' else '-'
+        maxrss = '%dK' % run['maxrss'] if run['maxrss'] != '' else '-'
+
+        form.write('{0: <25} {1: <8} {2: <20} {3: >10} {4: >8} {5: <8} {6: >5} {7: >9} {8: >10}\n' \
+                .format(run['job_name'], run['run_id'], 
+                    time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(run['start'])),
+                    duration, lag, run['status'], run['exitcode'], cpu, maxrss))
+
+    form.write('\n{0: <25} {1: >6} {2: >8} {3: >10} {4: >10} {5: >10}\n' \
+            .format('Jobname', 'Runs', 'Failed', 'p50', 'p95', 'Max'))
+    form.write('='*110 + '\n')
+
+    for name, stats in sorted(history['stats'].items()):
+        form.write('{0: <25} {1: >6} {2: >8} {3: >10} {4: >10} {5: >10}\n' \
+                .format(name, stats['runs'], stats['failures'], '%.2fs' % stats.get('p50', 0),
+                    '%.2fs' % stats.get('p95', 0), '%.2fs' % stats.get('max', 0)))
+
+    return True, form.getvalue()
+
+
+def job_costs(s, args):
+    """formats the jobs that cost the most, from the daemon's job_costs rpc"""
+
+    query = {'sort': args.costs, 'limit': args.limit}
+
+    if args.since:
+        query['start'] = time.time() - args.since * 3600
+
+    returncode, costs = s.job_costs(query)
+
+    if returncode is False:
+        return returncode, costs
+
+    if not costs['jobs']:
+        return False, "No runs recorded."
+
+    form = StringIO.StringIO()
+    form.write('{0: <25} {1: >6} {2: >10} {3: >10} {4: >10} {5: >10} {6: >10} {7: >10} {8: >10}\n' \
+            .format('Jobname', 'Runs', 'CPU', 'User', 'System', 'MaxRSS', 'In blocks', 'Out blocks', 'Wall'))
+    form.write('='*110 + '\n')
+
+    for job in costs['jobs']:
+        job = dict(zip(costs['fields'], job))
+
+        form.write('{0: <25} {1: >6} {2: >10} {3: >10} {4: >10} {5: >10} {6: >10.0f} {7: >10.0f} {8: >10}\n' \
+                .format(job['job_name'], job['runs'], '%.2fs' % job['cpu'], '%.2fs' % job['utime'],
+                    '%.2fs' % job['stime'], '%dK' % job['maxrss'], job['inblock'], job['oublock'],
+                    '%.2fs' % job['duration']))
+
+    return True, form.getvalue()
+
+
+def running_jobs(s, args):
+    """formats the job runs going right now, from the daemon's running_jobs rpc"""
+
+    returncode, running = s.running_jobs(selector(args, args.name or '*'))
+
+    if returncode is False:
+        return returncode, running
+
+    form = StringIO.StringIO()
+    form.write('{0: <25} {1: <8} {2: <8} {3: <15} {4: <20} {5: >10} {6: >10} {7: <10}\n' \
+            .format('Jobname', 'Run', 'Pid', 'Owner', 'Started', 'Elapsed', 'RSS', 'State'))
+    form.write('='*110 + '\n')
+
+    for run in running['runs']:
+        run = dict(zip(running['fields'], run))
+
+        form.write('{0: <25} {1: <8} {2: <8} {3: <15} {4: <20} {5: >10} {6: >10} {7: <10}\n' \
+                .format(run['job_name'], run['run_id'], run['pid'], run['owner'],
+                    time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(run['start'])), '%.1fs' % run['elapsed'],
+                    '%dK' % run['rss'] if run['rss'] != '' else '-', run['state']))
+
+    form.write("\n%d running, %d queued.\n" % (len(running['runs']), running['queued']))
+
+    return True, form.getvalue()
+
+
+def trace_summary(s, args):
+    """formats where job runs spend their time, from the daemon's trace_summary rpc"""
+
+    query = {}
+
+    if args.trace != '*':
+        query['job'] = args.trace
+
+    returncode, summary = s.trace_summary(query)
+
+    if returncode is False:
+        return returncode, summary
+
+    form = StringIO.StringIO()
+    form.write('{0: <16} {1: >8} {2: >10} {3: >10} {4: >10} {5: >10}\n' \
+            .format('Phase', 'Runs', 'Mean', 'p50', 'p95', 'Max'))
+    form.write('='*110 + '\n')
+
+    for span in summary['spans']:
+        stats = summary['overall'].get(span)
+
+        if stats:
+            form.write('{0: <16} {1: >8} {2: >10} {3: >10} {4: >10} {5: >10}\n' \
+                    .format(span, stats['count'], '%.4fs' % stats['mean'], '%.4fs' % stats['p50'],
+                        '%.4fs' % stats['p95'], '%.4fs' % stats['max']))
+
+    # one column per phase, mean seconds per run
+    form.write('\n{0: <25} '.format('Jobname') + ' '.join('{0: >14}'.format(span) for span in summary['spans']) + '\n')
+    form.write('='*110 + '\n')
+
+    for name, spans in sorted(summary['jobs'].items()):
+        form.write('{0: <25} '.format(name) + ' '.join('{0: >14}'.format('%.4fs' % spans[span]['mean'] 
+                if span in spans else '-') for span in summary['spans']) + '\n')
+
+    return True, form.getvalue()
+
+
+def forecast(s, args):
+    """formats the busiest minutes and hourly job starts from the daemon's forecast rpc"""
+
+    query = selector(args, args.name or '*')
+    query['hours'] = args.forecast
+
+    returncode, forecast = s.forecast(query)
+
+    if returncode is False:
+        return returncode, forecast
+
+    form = StringIO.StringIO()
+    form.write("%d jobs, %d schedules, over %s hours. Peak: %d starts in a minute, %.2f jobs running. " \
+            "%d jobs have no run history.\n\n" % (forecast['jobs'], forecast['schedules'], args.forecast,
+                forecast['peak_starts'], forecast['peak_concurrency'], forecast['no_history']))
+
+    form.write('{0: <20} {1: >8} {2: >10}\n'.format('Busiest minutes', 'Starts', 'Running'))
+    form.write('='*110 + '\n')
+
+    for when, starts, running in forecast['top']:
+        form.write('{0: <20} {1: >8} {2: >10.2f}\n'.format(time.strftime('%Y-%m-%d %H:%M', time.localtime(when)),
+                starts, running))
+
+    form.write('\n{0: <20} {1: >8} {2: >10}\n'.format('From', 'Starts', 'Peak'))
+    form.write('='*110 + '\n')
+
+    for i, (starts, running) in enumerate(zip(forecast['starts'], forecast['concurrency'])):
+        when = forecast['start'] + i * forecast['resolution'] * 60
+        form.write('{0: <20} {1: >8} {2: >10.2f}\n'.format(time.strftime('%Y-%m-%d %H:%M', time.localtime(when)),
+                starts, running))
+
+    return True, form.getvalue()
+
+
+def tail_output(s, args, user, realuser):
+    """
+    writes a job's output to stdout as it comes: a run's (--run) from its start, or the end of
+    everything the job printed. with --follow, keeps going until the run is done (or ^C)
+    """
+
+    offset = 0 if args.run else -args.bytes
+
+    while True:
+        returncode, output = s.tail_job_output(args.tail, args.run, offset, user, realuser)
+
+        if returncode is False:
+            return returncode, output
+
+        sys.stdout.write(output['data'].data)
+        sys.stdout.flush()
+
+        offset = output['offset']
+
+        # more is waiting, get it right away
+        if offset < output['end']:
+            continue
+
+        if not args.follow or output['done']:
+            return True, ''
+
+        time.sleep(1)
+
+
+def main(args):
+
+    config = read_config(args.configfile)
+
+    realuser = os.getlogin()
+    user = os.environ['USER']
+
+    # prefer the local unix socket. the daemon identifies us from the socket itself, so there's
+    #   no separate check_auth round trip
+    if config.has_option('xmlrpc', 'socket') and os.path.exists(config.get('xmlrpc', 'socket')) \
+            and not args.tcp:
+        s = xmlrpclib.ServerProxy('http://localhost'+config.get('xmlrpc', 'url'), 
+                transport=UnixStreamTransport(config.get('xmlrpc', 'socket')))
+
     else:
-        pass
+        server_url = 'http://'+config.get('xmlrpc', 'host')+':'+config.get('xmlrpc', 'port')+config.get('xmlrpc', 'url')
+        s = xmlrpclib.ServerProxy(server_url)
+
+        # check if user running the client is allowed...
+        returncode,output = s.check_auth(user)
+
+        # no passing go broseph... 
+        if returncode is False:
+            print output
+            sys.exit(1)
 
     try:
 
         if args.listjobs:
-            out = s.show_jobs()
+            returncode, output = list_jobs(s, args)
 
-            # length of 2 means that only the header + divider line were received, aka no jobs
-            if len(out) == 2:
-                returncode, output = False, "No jobs."
+        elif args.history:
+            returncode, output = job_history(s, args)
 
-            else:
-                form = StringIO.StringIO()
-            
-                for line in out:
-                    form.write("%s\n" % line)
+        elif args.trace:
+            returncode, output = trace_summary(s, args)
 
-                returncode, output = [True, form.getvalue()] 
+        elif args.running:
+            returncode, output = running_jobs(s, args)
+
+        elif args.costs:
+            returncode, output = job_costs(s, args)
+
+        elif args.forecast:
+            returncode, output = forecast(s, args)
+
+        elif args.tail:
+            returncode, output = tail_output(s, args, user, realuser)
 
         elif args.addjob:
             returncode, output = s.add_job(args.addjob, user, realuser)
 
+        elif args.addjobs:
+            returncode, output = format_results(s.add_jobs(args.addjobs, user, realuser))
+
+        elif args.disablejobs:
+            returncode, output = format_results(s.disable_jobs(selector(args, args.disablejobs), user, realuser))
+
+        elif args.enablejobs:
+            returncode, output = format_results(s.enable_jobs(selector(args, args.enablejobs), user, realuser))
+
+        elif args.removejobs:
+            returncode, output = format_results(s.remove_jobs(selector(args, args.removejobs), user, realuser))
+
         elif args.disablejob:
             returncode, output = s.disable_job(args.disablejob, user, realuser)
 
@@ -81,6 +410,9 @@ def main(args):
         elif args.removejob:
             returncode, output = s.remove_job(args.removejob, user, realuser)
 
+        elif args.kill:
+            returncode, output = s.cancel_run(args.kill, user, realuser)
+
         elif args.status:
             returncode, output = s.check_sched()
 
@@ -93,7 +425,8 @@ def main(args):
         if returncode is False:
             print "ERROR: %s" % output
 
-        else:
+        # tail has written its output already
+        elif output:
             print output
 
     except xmlrpclib.Fault as fault:
@@ -109,11 +442,73 @@ if __name__ == '__main__':
 
     
     parser = argparse.ArgumentParser()
+    parser.add_argument('-c','--configfile',
+                        default='/opt/storage/python/ratking/etc/ratkingd.conf',
+                        dest='configfile',
+                        required=False,
+                        help='ratking config file')
+    parser.add_argument('--tcp',
+                        action='store_true',
+                        default=False,
+                        dest='tcp',
+                        required=False,
+                        help='connect over tcp even if the local unix socket is available')
     parser.add_argument('--add_job',
                         default=False,
                         dest='addjob',
                         required=False,
                         help='add a new job. takes a filename as an argument')
+    parser.add_argument('--add_jobs',
+                        default=False,
+                        dest='addjobs',
+                        nargs='+',
+                        required=False,
+                        help='add several jobs. takes one or more filenames as arguments')
+    parser.add_argument('--disable_jobs',
+                        default=False,
+                        dest='disablejobs',
+                        metavar='PATTERN',
+                        required=False,
+                        help='disables all jobs matching PATTERN (a jobname glob, quote it), --owner and --type')
+    parser.add_argument('--enable_jobs',
+                        default=False,
+                        dest='enablejobs',
+                        metavar='PATTERN',
+                        required=False,
+                        help='enables all jobs matching PATTERN (a jobname glob, quote it), --owner and --type')
+    parser.add_argument('--remove_jobs',
+                        default=False,
+                        dest='removejobs',
+                        metavar='PATTERN',
+                        required=False,
+                        help='removes all jobs matching PATTERN (a jobname glob, quote it), --owner and --type')
+    parser.add_argument('--name',
+                        default=None,
+                        dest='name',
+                        required=False,
+                        help='with --list_jobs, only list jobs whose name matches NAME (a glob, quote it)')
+    parser.add_argument('--sort',
+                        default='name',
+                        choices=['name', 'owner', 'type', 'status', 'next_run_time'],
+                        dest='sort',
+                        required=False,
+                        help='with --list_jobs, sort on this field')
+    parser.add_argument('--job_status',
+                        default=None,
+                        choices=['Enabled', 'Disabled'],
+                        dest='jobstatus',
+                        required=False,
+                        help='with --list_jobs, only list jobs with this status')
+    parser.add_argument('--owner',
+                        default=None,
+                        dest='owner',
+                        required=False,
+                        help='with --list_jobs or --*_jobs, only select jobs owned by OWNER')
+    parser.add_argument('--type',
+                        default=None,
+                        dest='type',
+                        required=False,
+                        help='with --list_jobs or --*_jobs, only select jobs of type TYPE')
     parser.add_argument('--disable_job',
                         default=False,
                         dest='disablejob',
@@ -129,6 +524,85 @@ if __name__ == '__main__':
                         dest='forcerun',
                         required=False,
                         help='run a job. takes a jobname as an argument')
+    parser.add_argument('--forecast',
+                        default=False,
+                        dest='forecast',
+                        type=float,
+                        metavar='HOURS',
+                        required=False,
+                        help='forecast job starts and running jobs over the next HOURS hours, and the busiest minutes. ' \
+                                'takes --name/--owner/--type to forecast only some jobs')
+    parser.add_argument('--running',
+                        action='store_true',
+                        default=False,
+                        dest='running',
+                        required=False,
+                        help='show the job runs going right now, with pid, elapsed time and memory. takes --name/--owner/--type')
+    parser.add_argument('--kill',
+                        default=False,
+                        dest='kill',
+                        type=int,
+                        metavar='RUN_ID',
+                        required=False,
+                        help='cancel a running job run: SIGTERM, then SIGKILL if it does not exit')
+    parser.add_argument('--history',
+                        default=False,
+                        dest='history',
+                        metavar='JOBNAME',
+                        required=False,
+                        help="show recorded runs of JOBNAME ('*' for all jobs), with duration percentiles")
+    parser.add_argument('--costs',
+                        default=False,
+                        dest='costs',
+                        metavar='SORT',
+                        choices=['runs', 'cpu', 'utime', 'stime', 'maxrss', 'inblock', 'oublock', 'duration'],
+                        required=False,
+                        help='show the jobs whose runs cost the most, sorted on SORT: cpu, maxrss, inblock, ' \
+                                'oublock, duration, ... takes --since and --limit')
+    parser.add_argument('--trace',
+                        default=False,
+                        dest='trace',
+                        metavar='JOBNAME',
+                        required=False,
+                        help="show where runs of JOBNAME ('*' for the slowest jobs) spend their time, per phase")
+    parser.add_argument('--tail',
+                        default=False,
+                        dest='tail',
+                        metavar='JOBNAME',
+                        required=False,
+                        help='show the end of the output of JOBNAME, or of one of its runs with --run')
+    parser.add_argument('--run',
+                        default=0,
+                        dest='run',
+                        type=int,
+                        metavar='RUN_ID',
+                        required=False,
+                        help='with --tail, show the output of run RUN_ID, from its start')
+    parser.add_argument('--follow',
+                        action='store_true',
+                        default=False,
+                        dest='follow',
+                        required=False,
+                        help='with --tail, keep showing output as it comes, until the run is done')
+    parser.add_argument('--bytes',
+                        default=4096,
+                        dest='bytes',
+                        type=int,
+                        required=False,
+                        help='with --tail and no --run, how many bytes of the end of the output to show (default: 4096)')
+    parser.add_argument('--since',
+                        default=None,
+                        dest='since',
+                        type=float,
+                        metavar='HOURS',
+                        required=False,
+                        help='with --history or --costs, only runs from the last HOURS hours')
+    parser.add_argument('--limit',
+                        default=50,
+                        dest='limit',
+                        type=int,
+                        required=False,
+                        help='with --history, the number of runs to show, with --costs, of jobs (default: 50)')
     parser.add_argument('--list_jobs',
                         action='store_true',
                         default=False,
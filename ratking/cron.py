@@ -0,0 +1,272 @@
+import calendar
+import hashlib
+import threading
+from datetime import datetime, timedelta
+
+
+# field name, lowest and highest value, and names allowed in place of numbers
+FIELDS = [
+    ('minute', 0, 59, None),
+    ('hour', 0, 23, None),
+    ('day of month', 1, 31, None),
+    ('month', 1, 12, ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']),
+    ('day of week', 0, 7, ['sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat']),
+    ]
+
+# how far ahead to look for a fire time before deciding there is none ('0 0 30 2 *').
+#   a Feb 29 that falls on a given weekday can be 28 years away
+MAX_YEARS = 28
+
+# schedule string -> CronSchedule, so jobs with the same schedule share one
+_compiled = {}
+_compiled_lock = threading.Lock()
+
+
+def compile_schedule(schedule):
+    """
+    returns the CronSchedule for a five field cron schedule ('*/5 * * * mon-fri'), compiled
+    once and shared by every job with the same schedule. raises ValueError if it isn't valid
+    """
+
+    key = ' '.join(schedule.split())
+    compiled = _compiled.get(key)
+
+    if compiled is None:
+        compiled = CronSchedule(key)
+
+        with _compiled_lock:
+            compiled = _compiled.setdefault(key, compiled)
+
+    return compiled
+
+
+class CronSchedule(object):
+    """
+    A cron schedule, compiled to one bitmask per field. Used as the trigger of a job.
+
+    Works like cron: day of week 0 and 7 are Sunday, and when both day of month and day
+    of week are restricted (neither starts with '*') a day matching either one fires,
+    otherwise a day has to match both.
+
+    Finding the next fire time steps field by field, month, day, hour, minute, and each
+    step is a lookup of the lowest set bit at or above a value, so it takes a handful of
+    operations whatever the schedule.
+    """
+
+    def __init__(self, schedule):
+
+        fields = schedule.split()
+
+        if len(fields) != 5:
+            raise ValueError("cron schedule must have 5 fields (minute hour day month weekday): '%s'" % schedule)
+
+        self.schedule = schedule
+        self.minutes, self.hours, self.doms, self.months, dows = [ parse_field(field, *spec)
+                for field, spec in zip(fields, FIELDS) ]
+
+        # 7 is Sunday too
+        self.dows = (dows | dows >> 7) & 0x7f
+
+        # a day of month or day of week starting with '*' means a day has to match both
+        self.dom_any = fields[2].startswith('*')
+        self.dow_any = fields[4].startswith('*')
+
+        # numbers in day of week ('1-5', '*/2') meant Monday-based days under APScheduler
+        self.numeric_weekdays = any(c.isdigit() for c in fields[4])
+
+        # (year, month) -> mask of the days in that month the schedule fires on
+        self.day_masks = {}
+
+
+    def get_next_fire_time(self, start):
+        """returns the first fire time at or after start (a datetime), or None if there isn't one"""
+
+        t = start.replace(second=0, microsecond=0)
+
+        if t < start:
+            t += timedelta(minutes=1)
+
+        year, month, day, hour, minute = t.year, t.month, t.day, t.hour, t.minute
+
+        while year <= t.year + MAX_YEARS:
+
+            m = next_bit(self.months, month)
+
+            if m < 0:
+                year, month, day, hour, minute = year + 1, 1, 1, 0, 0
+                continue
+
+            if m != month:
+                month, day, hour, minute = m, 1, 0, 0
+
+            d = next_bit(self._days(year, month), day)
+
+            if d < 0:
+                month, day, hour, minute = month + 1, 1, 0, 0
+                continue
+
+            if d != day:
+                day, hour, minute = d, 0, 0
+
+            h = next_bit(self.hours, hour)
+
+            if h < 0:
+                day, hour, minute = day + 1, 0, 0
+                continue
+
+            if h != hour:
+                hour, minute = h, 0
+
+            mi = next_bit(self.minutes, minute)
+
+            if mi < 0:
+                hour, minute = hour + 1, 0
+                continue
+
+            return datetime(year, month, day, hour, mi)
+
+        return None
+
+
+    def _days(self, year, month):
+        """mask of the days of month (bit 1 = the 1st) the schedule fires on"""
+
+        mask = self.day_masks.get((year, month))
+
+        if mask is not None:
+            return mask
+
+        first, length = calendar.monthrange(year, month)
+        month_days = (1 << (length + 1)) - 2
+
+        # the weekday mask, turned to start on the weekday of the 1st (calendar has monday = 0,
+        #   cron sunday = 0), repeated over the month, and moved up so bit 1 is the 1st
+        first = (first + 1) % 7
+        week = ((self.dows >> first) | (self.dows << (7 - first))) & 0x7f
+        dows = 0
+
+        for i in range(5):
+            dows |= week << (1 + 7 * i)
+
+        if self.dom_any or self.dow_any:
+            mask = self.doms & dows & month_days
+
+        else:
+            mask = (self.doms | dows) & month_days
+
+        self.day_masks[(year, month)] = mask
+
+        return mask
+
+
+    def __str__(self):
+        return "cron[%s]" % self.schedule
+
+    def __repr__(self):
+        return "<CronSchedule (%s)>" % self.schedule
+
+
+class SpreadSchedule(object):
+    """
+    A CronSchedule that fires offset seconds after each of its cron fire times, so jobs with
+    the same schedule don't all start in the same second. See spread_offset.
+    """
+
+    def __init__(self, cron, offset):
+
+        self.cron = cron
+        self.offset = offset
+        self.delta = timedelta(seconds=offset)
+
+
+    def get_next_fire_time(self, start):
+
+        fire_time = self.cron.get_next_fire_time(start - self.delta)
+
+        if fire_time is None:
+            return None
+
+        return fire_time + self.delta
+
+
+    def __str__(self):
+        return "cron[%s] +%ds" % (self.cron.schedule, self.offset)
+
+    def __repr__(self):
+        return "<SpreadSchedule (%s +%ds)>" % (self.cron.schedule, self.offset)
+
+
+def spread_offset(name, window):
+    """
+    seconds (0 to window - 1) a job's runs are moved by to spread them over window seconds.
+    a hash of the job name, so it's the same on every restart, and evenly spread over many jobs
+    """
+
+    if window < 1:
+        return 0
+
+    return int(hashlib.md5(name).hexdigest()[:15], 16) % int(window)
+
+
+def next_bit(mask, value):
+    """the lowest set bit of mask at or above value, -1 if there is none"""
+
+    mask = mask >> value << value
+
+    if not mask:
+        return -1
+
+    return (mask & -mask).bit_length() - 1
+
+
+def parse_field(field, name, low, high, names):
+    """returns the bitmask (bit n = value n) of one cron field: '*', '5', '1-5', '*/15', '0-30/10', 'mon,wed'"""
+
+    mask = 0
+
+    for part in field.lower().split(','):
+        step = 1
+
+        if '/' in part:
+            part, step = part.split('/', 1)
+
+            if not step.isdigit() or int(step) == 0:
+                raise ValueError("invalid step in %s field: '%s'" % (name, field))
+
+            step = int(step)
+
+        if part == '*':
+            start, end = low, high
+
+            # '*' in day of week covers 0-6, 7 is only an alias for sunday
+            if name == 'day of week':
+                end = 6
+
+        elif '-' in part:
+            start, end = [ field_value(v, name, low, high, names, field) for v in part.split('-', 1) ]
+
+        else:
+            start = end = field_value(part, name, low, high, names, field)
+
+            # '5/10' means from 5 to the end, every 10
+            if step > 1:
+                end = high
+
+        if start > end:
+            raise ValueError("invalid range in %s field: '%s'" % (name, field))
+
+        for value in range(start, end + 1, step):
+            mask |= 1 << value
+
+    return mask
+
+
+def field_value(value, name, low, high, names, field):
+
+    if names and value in names:
+        return names.index(value) + (low if name == 'month' else 0)
+
+    if not value.isdigit() or not low <= int(value) <= high:
+        raise ValueError("invalid value in %s field: '%s'" % (name, field))
+
+    return int(value)
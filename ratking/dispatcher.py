@@ -0,0 +1,230 @@
+import heapq
+import itertools
+import threading
+import time
+from util import get_option
+
+
+class Dispatcher(object):
+    """
+    Sits between the scheduler and the Supervisor, and caps how many job runs go at once.
+
+    max_running caps all runs, max_running_per_owner and max_running_per_type cap the runs
+    of each job owner and job type, and owner_limits / type_limits ('alice:2,bob:8') set
+    the cap of single owners and types. 0 is no cap. A run over any cap waits in a queue,
+    highest jobfile priority first, and is started as soon as runs finish and it fits.
+
+    Queued runs wait at most queue_max_wait seconds, after that they're dropped. A job has
+    at most one run queued, later scheduled runs of it are skipped while it waits, and
+    runs are rejected once queue_max_size runs are waiting.
+    """
+
+    def __init__(self, jobctl, config, logging):
+
+        self.jobctl = jobctl
+        self.config = config
+        self.logging = logging
+
+        self.max_running = get_option(self.config, 'max_running', 0)
+        self.max_per_owner = get_option(self.config, 'max_running_per_owner', 0)
+        self.max_per_type = get_option(self.config, 'max_running_per_type', 0)
+        self.owner_limits = parse_limits(get_option(self.config, 'owner_limits', ''))
+        self.type_limits = parse_limits(get_option(self.config, 'type_limits', ''))
+        self.max_wait = get_option(self.config, 'queue_max_wait', 300.0)
+        self.max_size = get_option(self.config, 'queue_max_size', 10000)
+
+        # runs counted against the caps: all of them, and by owner and by type
+        self.running = 0
+        self.owner_running = {}
+        self.type_running = {}
+
+        # heap of (-priority, seq, QueuedRun), and job_name -> its queued run
+        self.queue = []
+        self.queued = {}
+        self.seq = itertools.count()
+        self.lock = threading.Lock()
+
+        self.jobctl.supervisor.listeners.append(self.release)
+
+
+    def submit(self, kwargs, job_type='', priority=0, max_instances=1, scheduled=None, fired=None):
+        """
+        starts a run of a job, or queues it if it's over a cap. returns the run id, 0 if the run
+        was queued, or None if it wasn't started (max_instances reached, or it couldn't be queued)
+        """
+
+        run = QueuedRun(kwargs, job_type, priority, max_instances, scheduled, fired)
+
+        with self.lock:
+            queued = self.queued.get(run.job_name)
+
+            # the queue is only cleaned out when a run finishes, while the caps stay full a run of
+            #   this job that waited too long would otherwise keep skipping the job's new runs
+            if queued is not None and run.queued_at - queued.queued_at > self.max_wait:
+                self._expire(queued)
+
+            if self._fits(run):
+                self._count(run, 1)
+
+            elif run.job_name in self.queued:
+                self.logging.warning("Execution of job '%s' skipped: a run of it is already queued", run.job_name)
+                return None
+
+            elif len(self.queued) >= self.max_size:
+                self.logging.error("Execution of job '%s' skipped: the run queue is full (%d runs)",
+                        run.job_name, self.max_size)
+                self.jobctl.metrics.queue_rejected.inc()
+                return None
+
+            else:
+                self.logging.info("Job: '%s' queued, over its concurrency limit (owner: '%s', type: '%s')",
+                        run.job_name, run.owner, run.job_type)
+                heapq.heappush(self.queue, (-priority, self.seq.next(), run))
+                self.queued[run.job_name] = run
+                return 0
+
+        return self._start(run)
+
+
+    def release(self, run):
+        """Supervisor listener, frees the finished run's place and starts the queued runs that fit now"""
+
+        with self.lock:
+            self._count(run, -1)
+            runnable = self._take_runnable()
+
+        for queued in runnable:
+            self.jobctl.metrics.queue_wait.observe(time.time() - queued.queued_at)
+            self._start(queued)
+
+
+    def depth(self):
+        return len(self.queued)
+
+
+    def _start(self, run):
+
+        run_id = self.jobctl.supervisor.dispatch(run.kwargs, run.max_instances, run.scheduled, run.fired,
+                run.job_type)
+
+        # not started, so it won't be released by the supervisor
+        if run_id is None:
+            self.release(run)
+
+        return run_id
+
+
+    def _fits(self, run):
+        """must be called with self.lock held"""
+
+        if self.max_running and self.running >= self.max_running:
+            return False
+
+        limit = self.owner_limits.get(run.owner, self.max_per_owner)
+
+        if limit and self.owner_running.get(run.owner, 0) >= limit:
+            return False
+
+        limit = self.type_limits.get(run.job_type, self.max_per_type)
+
+        if limit and self.type_running.get(run.job_type, 0) >= limit:
+            return False
+
+        return True
+
+
+    def _count(self, run, amount):
+        """must be called with self.lock held"""
+
+        self.running += amount
+        self.owner_running[run.owner] = self.owner_running.get(run.owner, 0) + amount
+        self.type_running[run.job_type] = self.type_running.get(run.job_type, 0) + amount
+
+        if not self.owner_running[run.owner]:
+            del self.owner_running[run.owner]
+
+        if not self.type_running[run.job_type]:
+            del self.type_running[run.job_type]
+
+
+    def _take_runnable(self):
+        """
+        takes the queued runs that fit under the caps off the queue, highest priority first, and
+        counts them as running. drops the ones that waited too long. must be called with self.lock held
+        """
+
+        now = time.time()
+        runnable = []
+        blocked = []
+
+        while self.queue and not (self.max_running and self.running >= self.max_running):
+            entry = heapq.heappop(self.queue)
+            run = entry[2]
+
+            # already dropped by submit()
+            if run.expired:
+                continue
+
+            if now - run.queued_at > self.max_wait:
+                self._expire(run)
+
+            elif self._fits(run):
+                del self.queued[run.job_name]
+                self._count(run, 1)
+                runnable.append(run)
+
+            # over its owner or type cap, runs behind it may still fit
+            else:
+                blocked.append(entry)
+
+        for entry in blocked:
+            heapq.heappush(self.queue, entry)
+
+        return runnable
+
+
+    def _expire(self, run):
+        """drops a queued run that waited too long. must be called with self.lock held"""
+
+        # its heap entry is skipped when it comes up, or cleaned out once those pile up
+        run.expired = True
+        del self.queued[run.job_name]
+
+        if len(self.queue) > 2 * len(self.queued) + 1024:
+            self.queue = [ entry for entry in self.queue if not entry[2].expired ]
+            heapq.heapify(self.queue)
+
+        self.jobctl.metrics.queue_expired.inc()
+        self.logging.error("Execution of job '%s' skipped: it waited in the run queue for more than %ss",
+                run.job_name, self.max_wait)
+
+
+class QueuedRun(object):
+    """a run on its way to the Supervisor"""
+
+    def __init__(self, kwargs, job_type, priority, max_instances, scheduled, fired):
+
+        self.kwargs = kwargs
+        self.job_name = kwargs['job_name']
+        self.owner = kwargs['owner']
+        self.job_type = job_type
+        self.priority = priority
+        self.max_instances = max_instances
+        self.scheduled = scheduled
+        self.fired = fired
+        self.queued_at = time.time()
+        self.expired = False
+
+
+def parse_limits(value):
+    """'alice:2,bob:8' -> {'alice': 2, 'bob': 8}"""
+
+    limits = {}
+
+    for item in value.split(','):
+
+        if item.strip():
+            name, limit = item.rsplit(':', 1)
+            limits[name.strip()] = int(limit)
+
+    return limits
@@ -6,9 +6,12 @@ import importlib
 import multiprocessing
 import os
 import sys
+import time
 from drop_privileges import drop_privileges
-from jobhandler import JobCtl
+from jobhandler import JobCtl, RatkingException, parse_jobfile
 from pwd import getpwnam 
+from snapshot import JobSnapshot
+from util import get_option
 
 class SchedCtl(object):
 
@@ -22,6 +25,13 @@ class SchedCtl(object):
         #   jobs in the $RATKINGROOT/etc/jobs.d directory
         self.job_control_instance = JobCtl(self.sched, self.config, self.logging)
 
+        # snapshot_file lets a restart skip parsing and validating unchanged jobfiles
+        if get_option(self.config, 'snapshot_file', ''):
+            self.snapshot = JobSnapshot(self.job_control_instance, self.config, self.logging)
+
+        else:
+            self.snapshot = None
+
     def check_sched(self):
         """Checks to see if scheduler is running"""
 
@@ -32,21 +42,182 @@ class SchedCtl(object):
             return False, "Scheduler is stopped."
 
     def import_jobs(self):
-        """read jobs from persistent directory, specified in the config file, under option job_dir"""
+        """
+        read jobs from persistent directory, specified in the config file, under option job_dir
+
+        job_dir is listed once, and jobfiles that changed since they were last parsed (or were
+        never parsed) are parsed in parallel by a pool of import_workers processes. Unchanged
+        jobfiles come from JobCtl's parse cache. Returns a summary dict of the import.
+
+        On the first import with snapshot_file set, the parse cache comes from the snapshot.
+        Jobs from jobfiles that haven't changed since are added without validating them
+        again, and get their saved Enabled/Disabled status back.
+        """
+
+        start = time.time()
+        jobctl = self.job_control_instance
+        job_dir = self.config.get('main', 'job_dir')
+
+        snapshot = None
+
+        if self.snapshot is not None and not jobctl.parse_cache:
+            snapshot = self.snapshot.load()
+
+        if snapshot is not None:
+            jobctl.parse_cache.update(snapshot['jobfiles'])
+
+        # stat every jobfile once, the (mtime, size) pair is the parse cache key
+        jobfiles = {}
+
+        for entry in sorted(os.listdir(job_dir)):
+
+            if not entry.endswith('.conf'):
+                continue
+
+            infile = os.path.join(job_dir, entry)
 
-        for infile in glob.glob( os.path.join(self.config.get('main', 'job_dir'), '*.conf') ):
-            self.logging.info("Trying to import jobfile: %s", infile)
-            
             try:
-                self.job_control_instance.add_job(infile, 'initial_startup', 'initial_startup')
-    
+                st = os.stat(infile)
+
+            except OSError as error:
+                self.logging.error("Import: cannot stat jobfile: %s, error: %s", infile, error)
+                continue
+
+            jobfiles[infile] = (st.st_mtime, st.st_size)
+
+        # forget jobfiles that are gone from job_dir
+        for infile in jobctl.parse_cache.keys():
+
+            if infile not in jobfiles:
+                del jobctl.parse_cache[infile]
+
+        stale = [ f for f in sorted(jobfiles) 
+                    if jobctl.parse_cache.get(f, (None, None))[:2] != jobfiles[f] ]
+
+        timings = {}
+
+        for infile, returncode, output, elapsed in self._parse_jobfiles(stale):
+            jobctl.parse_cache[infile] = jobfiles[infile] + (returncode, output)
+            timings[infile] = elapsed
+
+        added = []
+        failed = []
+        skipped = []
+        restored = 0
+        changed = set(stale)
+
+        for infile in sorted(jobfiles):
+            self.logging.debug("Trying to import jobfile: %s", infile)
+
+            returncode, output = jobctl.parse_cache[infile][2:]
+
+            if returncode is False:
+                failed.append((infile, output))
+                continue
+
+            jobdict = output.itervalues().next()
+
+            # don't load jobs with autostart=false during import
+            if jobdict['autostart'].lower() == 'false':
+                self.logging.info("During import: job '%s' will not be added, autostart=false in config file.", 
+                        jobdict['__name__'])
+                skipped.append(infile)
+                continue
+
+            add_start = time.time()
+
+            # a jobfile unchanged since the snapshot was validated back then
+            unchanged = snapshot is not None and infile not in changed and infile in snapshot['added']
+
+            try:
+                returncode, output = jobctl.add_parsed_job(infile, jobdict, 'initial_startup', 'initial_startup',
+                        checked=unchanged)
+
             except RatkingException as error:
-                print "RatkingException: Error adding job, jobfile: %s. " % infile
-                pass
+                returncode, output = False, "RatkingException: %s" % error
+
+            if returncode is not False and unchanged:
+                restored += self._restore_status(jobdict['__name__'], snapshot['status'].get(jobdict['__name__']))
+
+            timings[infile] = timings.get(infile, 0.0) + time.time() - add_start
+
+            if returncode is False:
+                failed.append((infile, output))
+
+            else:
+                added.append(infile)
+
+        elapsed = time.time() - start
+
+        jobctl.metrics.import_duration.set(elapsed)
+
+        for result, count in (('added', len(added)), ('failed', len(failed)), ('skipped', len(skipped))):
+            jobctl.metrics.import_jobfiles.set(count, (result,))
+
+        for infile, error in failed:
+            self.logging.error("Import failed for jobfile: %s, error: %s", infile, error)
+
+        slowest = sorted(timings.items(), key=lambda t: t[1], reverse=True)[:10]
+
+        for infile, took in slowest:
+            self.logging.debug("Import timing: %s took %.4fs", infile, took)
+
+        self.logging.info("Imported %d of %d jobfiles in %.2fs (%d parsed, %d cached, %d skipped, %d failed).",
+                len(added), len(jobfiles), elapsed, len(stale), len(jobfiles) - len(stale), 
+                len(skipped), len(failed))
+
+        if self.snapshot is not None:
+            self.snapshot.save()
+
+        return {
+            'added': len(added),
+            'cached': len(jobfiles) - len(stale),
+            'elapsed': elapsed,
+            'failed': failed,
+            'parsed': len(stale),
+            'restored': restored,
+            'skipped': len(skipped),
+            'slowest': slowest,
+            'total': len(jobfiles),
+            }
+
+
+    def _restore_status(self, jobname, status):
+        """puts a job back in the Enabled/Disabled status it had in the snapshot. returns 1 if it changed it"""
+
+        jobctl = self.job_control_instance
+        job = jobctl._get_job_obj(jobname)
+
+        if status == 'Disabled' and job.status != 'Disabled':
+            returncode, output = jobctl.disable_job(jobname, 'root', 'snapshot')
+
+        elif status == 'Enabled' and job.status == 'Disabled':
+            returncode, output = jobctl.enable_job(jobname, 'root', 'snapshot')
+
+        else:
+            return 0
+
+        return 1 if returncode else 0
+
+
+    def _parse_jobfiles(self, jobfiles):
+        """parses jobfiles, in a pool of worker processes if there are enough of them"""
+
+        workers = get_option(self.config, 'import_workers', multiprocessing.cpu_count())
+
+        # a pool isn't worth the fork for a handful of files
+        if workers <= 1 or len(jobfiles) < workers * 4:
+            return [ _timed_parse_jobfile(f) for f in jobfiles ]
+
+        pool = multiprocessing.Pool(workers)
+
+        try:
+            return pool.map(_timed_parse_jobfile, jobfiles, chunksize=max(1, len(jobfiles) / (workers * 4)))
+
+        finally:
+            pool.close()
+            pool.join()
 
-            except ConfigParser.ParsingError as error:
-                self.logging.error("ConfigParser.ParsingError: %s. ", error)
-                pass
 
     def initialize(self):
         """Starts the scheduler for the first time. Only to be used in ratkingd daemon"""
@@ -98,13 +269,10 @@ class SchedCtl(object):
         return True, "Ratkingd job scheduling has been stopped."
 
 
-class RatkingException(Exception):
-
-    def __init__(self, message):
-
-        self.message = message
+def _timed_parse_jobfile(filename):
+    """parse_jobfile wrapper for the import pool, returns (filename, returncode, output, seconds)"""
 
-    def __str__(self):
-       
-        return repr(self.message)
+    start = time.time()
+    returncode, output = parse_jobfile(filename)
 
+    return filename, returncode, output, time.time() - start
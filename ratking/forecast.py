@@ -0,0 +1,253 @@
+import heapq
+import math
+import time
+from datetime import datetime, timedelta
+
+# numpy is optional, without it the forecast is computed in plain python, which is a lot slower
+try:
+    import numpy
+
+except ImportError:
+    numpy = None
+
+
+# longest run length, in minutes, that concurrency is spread over
+MAX_SPAN = 1440
+
+
+def forecast(jobs, start, minutes, resolution=60, top=20):
+    """
+    Forecasts job starts and running jobs, minute by minute, from start (a datetime, rounded
+    up to the minute) for the next minutes minutes.
+
+    jobs is a list of (trigger, duration in seconds) for every enabled job, where trigger is
+    a CronSchedule or SpreadSchedule. Jobs are grouped by schedule and spread minutes, and a
+    schedule fires on the minutes where it fires on the day and on the time of day, so the
+    starts of all jobs for every minute of every day are one (days x schedules) by (schedules
+    x minutes of day) matrix product, two when spread moves runs past midnight. Expected concurrency
+    spreads every start over the job's duration, for each distinct duration (in minutes,
+    rounded to a few significant steps) once.
+
+    Returns a dict:
+
+        start        - epoch of the first minute
+        minutes      - minutes forecast
+        resolution   - minutes per bucket
+        starts       - job starts per bucket
+        concurrency  - peak expected running jobs per bucket
+        top          - [[epoch, starts, expected running jobs]] of the top busiest minutes
+        peak_starts, peak_concurrency, mean_starts - over the whole forecast
+        schedules    - distinct schedules
+        engine       - 'numpy' or 'python'
+    """
+
+    if start.second or start.microsecond:
+        start = start.replace(second=0, microsecond=0) + timedelta(minutes=1)
+
+    # schedule -> index, and per schedule: job count, and per duration span the
+    #   full minutes jobs run (n) and the fraction of the last minute (frac)
+    index = {}
+    counts = []
+    spans = {}
+
+    for trigger, duration in jobs:
+
+        # (schedule, minutes its runs are moved by)
+        schedule = (getattr(trigger, 'cron', trigger), int(getattr(trigger, 'offset', 0)) // 60)
+        i = index.get(schedule)
+
+        if i is None:
+            i = index[schedule] = len(counts)
+            counts.append(0)
+
+        counts[i] += 1
+
+        length = min(duration / 60.0, MAX_SPAN)
+        span = round_span(int(length))
+        n, frac = spans.setdefault(span, ({}, {}))
+
+        n[i] = n.get(i, 0) + 1
+        frac[i] = frac.get(i, 0.0) + length - int(length)
+
+    schedules = sorted(index, key=index.get)
+
+    # whole days, from the day before start (runs started then may still be going), to the last minute
+    first_day = datetime(start.year, start.month, start.day) - timedelta(days=1)
+    offset = 1440 + start.hour * 60 + start.minute
+    days = [ first_day + timedelta(days=d) for d in range(int(math.ceil((offset + minutes) / 1440.0))) ]
+
+    if numpy is not None:
+        starts, running = _forecast_numpy(schedules, counts, spans, days)
+        engine = 'numpy'
+
+    else:
+        starts, running = _forecast_python(schedules, counts, spans, days)
+        engine = 'python'
+
+    starts = starts[offset:offset + minutes]
+    running = running[offset:offset + minutes]
+
+    epoch = time.mktime(start.timetuple())
+    busiest = heapq.nlargest(top, range(len(starts)), key=lambda t: (starts[t], -t))
+
+    buckets = range(0, len(starts), resolution)
+
+    return {
+        'start': int(epoch),
+        'minutes': minutes,
+        'resolution': resolution,
+        'starts': [ int(sum(starts[b:b + resolution])) for b in buckets ],
+        'concurrency': [ round(float(max(running[b:b + resolution])), 2) for b in buckets ],
+        'top': [ [ int(epoch) + t * 60, int(starts[t]), round(float(running[t]), 2) ] for t in busiest if starts[t] ],
+        'peak_starts': int(max(starts)) if len(starts) else 0,
+        'peak_concurrency': round(float(max(running)), 2) if len(running) else 0.0,
+        'mean_starts': float(sum(starts)) / len(starts) if len(starts) else 0.0,
+        'schedules': len(set(s for s, shift in schedules)),
+        'engine': engine,
+        }
+
+
+def round_span(span):
+    """minutes, exact up to 10, then in steps of about 10%, so there are few distinct spans to spread"""
+
+    if span <= 10:
+        return span
+
+    return min(int(round(10 * 1.1 ** round(math.log(span / 10.0, 1.1)))), MAX_SPAN)
+
+
+def fires_on(schedule, day):
+    return (schedule.months >> day.month & 1) and (schedule._days(day.year, day.month) >> day.day & 1)
+
+
+def minutes_of_day(schedule):
+    """the minutes of the day (0-1439) a schedule fires on"""
+
+    return [ h * 60 + m for h in range(24) if schedule.hours >> h & 1
+                        for m in range(60) if schedule.minutes >> m & 1 ]
+
+
+def _forecast_numpy(schedules, counts, spans, days):
+
+    crons = list(set(s for s, shift in schedules))
+    cron_index = dict((s, i) for i, s in enumerate(crons))
+    row = numpy.array([ cron_index[s] for s, shift in schedules ], dtype=numpy.int64)
+    shifts = numpy.array([ shift for s, shift in schedules ], dtype=numpy.int64)
+
+    # crons x days, from far enough before the first day for the runs spread into it. a run moved
+    #   to a day comes from the day shift // 1440 days before, or one more when it crossed midnight
+    before = int(shifts.max()) // 1440 + 1 if len(shifts) else 1
+    all_days = [ days[0] - timedelta(days=d) for d in range(before, 0, -1) ] + days
+    cron_days = numpy.array([ [ fires_on(s, day) for day in all_days ] for s in crons ],
+            dtype=numpy.float32).reshape(len(crons), len(all_days))
+
+    # schedules x days
+    day = numpy.arange(len(days)) + before - (shifts // 1440).reshape(-1, 1)
+    day_ok = cron_days[row.reshape(-1, 1), day]
+
+    # schedules x minutes of the day, of the cron times moved by the spread minutes
+    minute = numpy.arange(1440)
+    source = (minute - (shifts % 1440).reshape(-1, 1)) % 1440
+    hours = numpy.array([ s.hours for s, shift in schedules ], dtype=numpy.uint64).reshape(-1, 1)
+    mins = numpy.array([ s.minutes for s, shift in schedules ], dtype=numpy.uint64).reshape(-1, 1)
+    time_ok = (((hours >> (source // 60).astype(numpy.uint64)) & 1) &
+               ((mins >> (source % 60).astype(numpy.uint64)) & 1)).astype(numpy.float32)
+
+    # the minutes that came from the day before
+    wrapped = source > minute
+
+    if wrapped.any():
+        wrap_day_ok = cron_days[row.reshape(-1, 1), day - 1]
+        wrap_time_ok = time_ok * wrapped
+        time_ok *= ~wrapped
+
+    else:
+        wrap_day_ok = None
+
+    def per_minute(weights):
+        """sum of weights of the schedules firing, for every minute of every day"""
+
+        weights = weights.astype(numpy.float32)
+        out = numpy.dot(day_ok.T * weights, time_ok)
+
+        if wrap_day_ok is not None:
+            out += numpy.dot(wrap_day_ok.T * weights, wrap_time_ok)
+
+        return out.ravel().astype(numpy.float64)
+
+    starts = per_minute(numpy.array(counts, dtype=numpy.float64))
+    running = numpy.zeros(len(starts))
+
+    for span, (n, frac) in spans.iteritems():
+
+        if span:
+            full = numpy.cumsum(per_minute(weights_array(n, len(schedules))))
+            full[span:] -= full[:-span].copy()
+            running += full
+
+        last = per_minute(weights_array(frac, len(schedules)))
+        running[span:] += last[:len(last) - span]
+
+    return starts, running
+
+
+def weights_array(weights, size):
+
+    array = numpy.zeros(size)
+
+    for i, w in weights.iteritems():
+        array[i] = w
+
+    return array
+
+
+def _forecast_python(schedules, counts, spans, days):
+
+    length = len(days) * 1440
+    times = [ [ t + shift for t in minutes_of_day(s) ] for s, shift in schedules ]
+
+    # runs moved forward by spread can come from days before the first one
+    before = max([ shift for s, shift in schedules ] or [0]) // 1440 + 1
+    days = [ days[0] - timedelta(days=d) for d in range(before, 0, -1) ] + days
+    firing = [ [ i for i, (s, shift) in enumerate(schedules) if fires_on(s, day) ] for day in days ]
+
+    def per_minute(weights):
+
+        out = [0.0] * length
+
+        for d, active in enumerate(firing):
+            base = (d - before) * 1440
+
+            for i in active:
+                w = weights.get(i) if isinstance(weights, dict) else weights[i]
+
+                if w:
+                    for t in times[i]:
+                        if 0 <= base + t < length:
+                            out[base + t] += w
+
+        return out
+
+    starts = per_minute(counts)
+    running = [0.0] * length
+
+    for span, (n, frac) in spans.iteritems():
+
+        if span:
+            full = per_minute(n)
+            window = 0.0
+
+            for t in range(length):
+                window += full[t]
+
+                if t >= span:
+                    window -= full[t - span]
+
+                running[t] += window
+
+        last = per_minute(frac)
+
+        for t in range(span, length):
+            running[t] += last[t - span]
+
+    return starts, running
@@ -0,0 +1,229 @@
+import math
+import Queue
+import sqlite3
+import threading
+import time
+from util import get_option
+
+
+class HistoryStore(object):
+    """
+    Append-only record of every job run, in a local sqlite database (WAL mode).
+
+    record() only puts the finished run on a queue. A writer thread inserts queued runs
+    in batches of up to history_batch_size, one transaction per batch, and once an hour
+    deletes runs older than history_retention_days and compacts the database.
+    """
+
+    # columns of a history record, in record order
+    fields = ['run_id', 'job_name', 'owner', 'scheduled', 'start', 'end', 'duration', 'status',
+              'exitcode', 'pid', 'utime', 'stime', 'maxrss', 'inblock', 'oublock']
+
+    def __init__(self, config, logging):
+
+        self.config = config
+        self.logging = logging
+
+        self.path = self.config.get('main', 'history_db')
+        self.retention = get_option(self.config, 'history_retention_days', 30)
+        self.batch_size = get_option(self.config, 'history_batch_size', 500)
+        self.flush_interval = get_option(self.config, 'history_flush_interval', 1.0)
+
+        self.queue = Queue.Queue(get_option(self.config, 'history_queue_size', 100000))
+        self.dropped = 0
+
+        # readers (rpc threads) each get their own connection
+        self.local = threading.local()
+
+        db = self._connect()
+        db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        db.execute("""CREATE TABLE IF NOT EXISTS runs (
+                            run_id INTEGER, job_name TEXT, owner TEXT, scheduled REAL, start REAL,
+                            end REAL, duration REAL, status TEXT, exitcode INTEGER, pid INTEGER,
+                            utime REAL, stime REAL, maxrss INTEGER, inblock INTEGER, oublock INTEGER)""")
+        db.execute("CREATE INDEX IF NOT EXISTS runs_job_start ON runs (job_name, start)")
+        db.execute("CREATE INDEX IF NOT EXISTS runs_start ON runs (start)")
+        db.commit()
+        db.close()
+
+        self.writer = threading.Thread(target=self._write, name='ratking-history')
+        self.writer.daemon = True
+        self.writer.start()
+
+
+    def record(self, run):
+        """queues a finished supervisor Run for the writer thread. never blocks"""
+
+        rusage = run.rusage
+
+        try:
+            self.queue.put_nowait((run.run_id, run.job_name, run.owner, run.scheduled, run.start, run.end,
+                    run.duration, run.status, run.exitcode, run.pid, rusage.get('utime'), rusage.get('stime'),
+                    rusage.get('maxrss'), rusage.get('inblock'), rusage.get('oublock')))
+
+        except Queue.Full:
+            self.dropped += 1
+
+            if self.dropped % 1000 == 1:
+                self.logging.warning("History queue is full, %d run records dropped so far.", self.dropped)
+
+
+    def query(self, job_name=None, start=None, end=None, limit=1000):
+        """returns the most recent runs (newest first) of job_name (or all jobs) that started between start and end"""
+
+        where, args = self._where(job_name, start, end)
+
+        return self._reader().execute("SELECT %s FROM runs %s ORDER BY start DESC LIMIT ?"
+                % (', '.join(self.fields), where), args + [limit]).fetchall()
+
+
+    def stats(self, job_name=None, start=None, end=None):
+        """returns {job_name: {runs, failures, p50, p95, max, mean}} of run durations"""
+
+        where, args = self._where(job_name, start, end)
+
+        rows = self._reader().execute("SELECT job_name, duration, status FROM runs %s ORDER BY job_name, duration"
+                % where, args)
+
+        stats = {}
+        durations = {}
+
+        for name, duration, status in rows:
+            job = stats.setdefault(name, {'runs': 0, 'failures': 0})
+            job['runs'] += 1
+
+            if status != 'success':
+                job['failures'] += 1
+
+            if duration is not None:
+                durations.setdefault(name, []).append(duration)
+
+        for name, values in durations.iteritems():
+            stats[name].update({
+                'p50': percentile(values, 50),
+                'p95': percentile(values, 95),
+                'max': values[-1],
+                'mean': sum(values) / len(values),
+                })
+
+        return stats
+
+
+    # columns of a costs() record, and what they can be sorted on
+    cost_fields = ['job_name', 'runs', 'cpu', 'utime', 'stime', 'maxrss', 'inblock', 'oublock', 'duration']
+
+    def costs(self, start=None, end=None, sort='cpu', limit=50):
+        """
+        returns [job_name, runs, cpu, utime, stime, maxrss, inblock, oublock, duration] of the jobs
+        that cost the most, per cost_fields. cpu, utime, stime, inblock, oublock and duration are
+        totals over the runs, maxrss (KB) is the peak of any run
+        """
+
+        where, args = self._where(None, start, end)
+
+        return self._reader().execute("""SELECT job_name, COUNT(*), TOTAL(utime) + TOTAL(stime) AS cpu, TOTAL(utime),
+                TOTAL(stime), COALESCE(MAX(maxrss), 0) AS maxrss, TOTAL(inblock), TOTAL(oublock), TOTAL(duration)
+                FROM runs %s GROUP BY job_name ORDER BY %s DESC LIMIT ?""" % (where, self._cost_column(sort)),
+                args + [limit]).fetchall()
+
+
+    def _cost_column(self, sort):
+
+        if sort not in self.cost_fields[1:]:
+            raise ValueError("Cannot sort costs on: '%s', must be one of: %s" % (sort, ', '.join(self.cost_fields[1:])))
+
+        return self.cost_fields.index(sort) + 1
+
+
+    def _where(self, job_name, start, end):
+
+        clauses = []
+        args = []
+
+        if job_name:
+            clauses.append("job_name = ?")
+            args.append(job_name)
+
+        if start:
+            clauses.append("start >= ?")
+            args.append(start)
+
+        if end:
+            clauses.append("start < ?")
+            args.append(end)
+
+        if not clauses:
+            return '', args
+
+        return 'WHERE ' + ' AND '.join(clauses), args
+
+
+    def _connect(self):
+
+        db = sqlite3.connect(self.path, timeout=30)
+        db.execute("PRAGMA journal_mode = WAL")
+        db.execute("PRAGMA synchronous = NORMAL")
+
+        return db
+
+
+    def _reader(self):
+
+        db = getattr(self.local, 'db', None)
+
+        if db is None:
+            db = self.local.db = self._connect()
+
+        return db
+
+
+    def _write(self):
+        """writer thread main loop"""
+
+        db = self._connect()
+        last_prune = 0
+
+        while True:
+            batch = []
+
+            try:
+                batch.append(self.queue.get(timeout=self.flush_interval))
+
+                while len(batch) < self.batch_size:
+                    batch.append(self.queue.get_nowait())
+
+            except Queue.Empty:
+                pass
+
+            try:
+                if batch:
+                    db.executemany("INSERT INTO runs VALUES (%s)" % ', '.join('?' * len(self.fields)), batch)
+                    db.commit()
+
+                if time.time() - last_prune > 3600:
+                    self._prune(db)
+                    last_prune = time.time()
+
+            except sqlite3.Error as e:
+                self.logging.error("History write failed, %d run records lost: %s", len(batch), e)
+
+
+    def _prune(self, db):
+        """deletes runs past retention, and gives the space back"""
+
+        cutoff = time.time() - self.retention * 86400
+        deleted = db.execute("DELETE FROM runs WHERE start < ?", (cutoff,)).rowcount
+        db.commit()
+
+        if deleted:
+            db.execute("PRAGMA incremental_vacuum")
+            db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self.logging.info("History: removed %d runs older than %d days.", deleted, self.retention)
+
+
+def percentile(values, pct):
+    """nearest-rank percentile of a sorted, non-empty list"""
+
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+
+    return values[min(max(rank, 1), len(values)) - 1]
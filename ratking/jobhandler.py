@@ -1,16 +1,28 @@
 import ast
+import bisect
 import ConfigParser
 import datetime
-import exceptions
+import fnmatch
 import glob
 import grp
-import importlib
-import inspect
-import multiprocessing
+import json
 import os
-import sys
+import threading
+import time
+from apscheduler.job import Job
+from cron import SpreadSchedule, compile_schedule, spread_offset
+from dispatcher import Dispatcher
 from drop_privileges import drop_privileges
+from forecast import forecast
+from history import HistoryStore
+from limits import apply_limits, parse_limits
+from metrics import Metrics
+from output import OutputCapture
+from plugins import PluginLoader
 from pwd import getpwnam 
+from supervisor import Supervisor
+from tracing import Tracer, mark
+from util import get_option
 
 
 class JobCtl(object):
@@ -21,6 +33,56 @@ class JobCtl(object):
         self.config = config  
         self.logging = logging
 
+        # name -> job object index, so lookups don't have to scan the jobstore.
+        #   kept in sync by add_job/remove_job. the lock is reentrant because
+        #   add_job calls disable_job for jobs imported with enabled=false
+        self.job_index = {}
+        self.job_lock = threading.RLock()
+
+        # jobfile path -> (mtime, size, returncode, output) from the last parse, so
+        #   unchanged jobfiles don't get parsed again. filled by read_jobfile and by
+        #   SchedCtl.import_jobs, which parses in bulk
+        self.parse_cache = {}
+
+        # seconds to spread the runs of jobs without a spread setting over, 0 runs them on the minute
+        self.spread_window = get_option(self.config, 'spread_window', 0.0)
+
+        # plugin modules, cached and only reloaded when a plugin file changes
+        self.plugins = PluginLoader(self.config, self.logging)
+
+        # counters and histograms, served by MetricsServer when metrics_port is set
+        self.metrics = Metrics(self)
+
+        # output_dir captures what job runs print, into rotated log files per job
+        if get_option(self.config, 'output_dir', ''):
+            self.output = OutputCapture(self.config, self.logging)
+
+        else:
+            self.output = None
+
+        # starts job runs without blocking the scheduler, and reaps them
+        self.supervisor = Supervisor(self, self.config, self.logging)
+        self.supervisor.listeners.append(self.metrics.record_run)
+
+        # caps on how many runs go at once, in all, per owner and per type, runs over them wait in a queue
+        self.dispatcher = Dispatcher(self, self.config, self.logging)
+
+        # history_db keeps a record of every finished run
+        if get_option(self.config, 'history_db', ''):
+            self.history = HistoryStore(self.config, self.logging)
+            self.supervisor.listeners.append(self.history.record)
+
+        else:
+            self.history = None
+
+        # trace_runs keeps timings of every phase of a run, from when it was due until it was reaped
+        if get_option(self.config, 'trace_runs', False):
+            self.tracer = Tracer(self.config, self.logging)
+            self.supervisor.listeners.append(self.tracer.record)
+
+        else:
+            self.tracer = None
+
 
     def add_job(self, filename, username, realuser):
         """adds a job to jobstore if it passes read_jobfile, check_job functions"""
@@ -29,8 +91,10 @@ class JobCtl(object):
         if not os.path.isfile(filename):
             return False, "Jobfile does not exist."
 
-        if os.path.basename(filename) not in os.listdir(self.config.get('main', 'job_dir')):
-            return False, "Job file must be placed under: %s" % self.config.get('main', 'job_dir')
+        job_dir = self.config.get('main', 'job_dir')
+
+        if not os.path.isfile(os.path.join(job_dir, os.path.basename(filename))):
+            return False, "Job file must be placed under: %s" % job_dir
 
         returncode, output = self.read_jobfile(filename)
 
@@ -38,23 +102,29 @@ class JobCtl(object):
             self.logging.error("Adding job failed: %s", output)
             return False, output
 
-        else:
-            # output is a dictionary, return from read_jobfile
-            jobdict = output.itervalues().next() 
+        # output is a dictionary, return from read_jobfile
+        jobdict = output.itervalues().next() 
+
+        return self.add_parsed_job(filename, jobdict, username, realuser)
+
+
+    def add_parsed_job(self, filename, jobdict, username, realuser, checked=False):
+        """
+        adds a job from an already parsed jobfile (see read_jobfile) to the jobstore.
+
+        checked skips _check_job, for jobs that passed it before and haven't changed since
+        """
 
         try:
             jobname = jobdict['__name__']
             owner = jobdict['owner']
 
-            # don't let someone submit a job with a name that already exists
-            if self._check_if_job_exists(jobname):
-                return False, "Job: %s already exists." % jobname
-
-            returncode, output = self._check_job(jobname, owner, username)
+            if not checked:
+                returncode, output = self._check_job(jobname, owner, username)
 
-            if returncode is False:
-            
-                return False, output
+                if returncode is False:
+                
+                    return False, output
 
         except KeyError as ke:
             return False, "Jobcheck subroutine could not complete, exception: '%s'" % ke 
@@ -62,70 +132,91 @@ class JobCtl(object):
         except TypeError as te:
             return False, "Improper format for in jobfile: '%s', error: '%s'" % (filename, te)
 
+        # hold the index lock from the duplicate check until the job is indexed,
+        #   so two concurrent add_job calls can't both add the same jobname
+        with self.job_lock:
 
-        try:
-            
-            # takes string "* * * * *" and turns it into a list 
-            schedule = [ f for f in jobdict['schedule'].split() ]
-
-            # converts a string to dict, to be passed to a function as **kwargs
-            jobargs = ast.literal_eval(jobdict['kwargs'])
-
-            # silently add the owner to the kwargs. 
-            jobargs['owner'] = jobdict['owner']
-
-            # add the job to the jobstore
-            self.sched.add_cron_job(
-                self.run_job,
-                minute=schedule[0],
-                hour=schedule[1],
-                month=schedule[3],
-                day_of_week=schedule[4],
-                name=jobdict['__name__'],
-                kwargs=jobargs,
-                max_instances=1
-                )
+            # don't let someone submit a job with a name that already exists
+            if self._check_if_job_exists(jobname):
+                return False, "Job: %s already exists." % jobname
 
-        except ValueError as ve:
-            
-            self.logging.error("Error adding job: '%s', Jobfile: '%s', Error: '%s'", 
-                    jobdict['__name__'], filename, ve)
-            return False, "Error adding job, job file parse error: '%s'" % ve
+            try:
+                
+                # "minute hour day month weekday", compiled once for all jobs with the same schedule
+                trigger = compile_schedule(jobdict['schedule'])
 
-        # extend the apscheduler.job schema by adding some attributes to a job object
-        job = self._get_job_obj(jobname)
+                if trigger.numeric_weekdays:
+                    self.logging.warning("Job: %s has a numeric day of week in its schedule: '%s'. Weekdays are "
+                            "numbered like cron (0 and 7 are Sunday), not like APScheduler (0 was Monday), "
+                            "use names (mon-fri) to be sure." % (jobname, jobdict['schedule']))
 
-        job.jobfile = filename
-        job.owner = jobdict['owner']
-        job.type = jobdict['type']
+                # spread (jobfile) or spread_window (ratkingd config) moves the job's runs by up to
+                #   that many seconds, a fixed offset per job, so jobs on one schedule don't start together
+                offset = spread_offset(jobname, float(jobdict.get('spread', self.spread_window)))
 
-        # if the job is disabled by default (enabled=false), set job as disabled
-        #   so that during the add_job phase, it's disabled...
-        if jobdict['enabled'].lower() != 'true':
-            job.status = 'Null' # set the attribute for now. as soon as disable_job() runs, it will be set to 'Disabled'
-            self.disable_job(jobname, 'initial_import', 'initial_import')
+                if offset:
+                    trigger = SpreadSchedule(trigger, offset)
 
-        else:
-            job.status = 'Enabled'
+                # converts a string to dict, to be passed to a function as **kwargs
+                jobargs = ast.literal_eval(jobdict['kwargs'])
+
+                # silently add the owner to the kwargs. 
+                jobargs['owner'] = jobdict['owner']
+
+                # run_job needs these too, don't make every jobfile repeat them in kwargs
+                jobargs.setdefault('job_name', jobname)
+                jobargs.setdefault('plugin_name', jobdict['plugin_name'])
+
+                # the job starts out paused: known to ratking, but not in the scheduler
+                job = Job(trigger, self.run_job, [], jobargs, self.sched.misfire_grace_time, self.sched.coalesce,
+                        name=jobname, max_instances=1)
+
+                # extend the apscheduler.job schema by adding some attributes to a job object
+                job.jobfile = filename
+                job.owner = jobdict['owner']
+                job.type = jobdict['type']
+                job.priority = int(jobdict.get('priority', 0))
+                job.limits = parse_limits(jobdict)
+                job.timeout = float(jobdict.get('timeout', 0))
+                job.status = 'Disabled'
+
+                # jobs with enabled=false stay paused until enable_job
+                if jobdict['enabled'].lower() == 'true':
+                    job = self._schedule(job)
+
+            except ValueError as ve:
+                
+                self.logging.error("Error adding job: '%s', Jobfile: '%s', Error: '%s'", 
+                        jobdict['__name__'], filename, ve)
+                return False, "Error adding job, job file parse error: '%s'" % ve
+
+            self.job_index[jobname] = job
 
         self.logging.info("Adding job: '%s', Submitted by user: '%s(%s)'", 
                 jobdict['__name__'], username, realuser)
         return True, "Successfully added job: '%s'" % jobdict['__name__'] 
 
 
-    def _check_if_job_exists(self, jobname):
-        """returns True/False based on whether or not job exists"""
+    def add_jobs(self, filenames, username, realuser):
+        """adds several jobfiles in one call. returns a [filename, returncode, output] result per file"""
 
-        joblist = self.sched._jobstores.get('default').jobs
+        results = []
 
-        for job in joblist:
+        with self.job_lock:
 
-            if jobname == job.name:
-                self.logging.debug("check_if_job_exists = True, for job: '%s'" % jobname)
-                return True
+            for filename in filenames:
+                returncode, output = self.add_job(filename, username, realuser)
+                results.append([filename, returncode, output])
 
-            else:
-                pass
+        return True, results
+
+
+    def _check_if_job_exists(self, jobname):
+        """returns True/False based on whether or not job exists"""
+
+        if jobname in self.job_index:
+            self.logging.debug("check_if_job_exists = True, for job: '%s'" % jobname)
+            return True
 
         self.logging.debug("check_if_job_exists = False, for job: '%s'" % jobname)
         return False
@@ -163,79 +254,104 @@ class JobCtl(object):
         return True, "Job passed all checks"
 
 
+    def _schedule(self, job):
+        """
+        puts a paused job in the scheduler. returns the scheduled job, which takes the paused
+        job's place in the job index. raises ValueError if the job would never run
+        """
+
+        scheduled = self.sched.add_job(job.trigger, self.run_job, None, job.kwargs, name=job.name,
+                max_instances=job.max_instances, misfire_grace_time=job.misfire_grace_time, coalesce=job.coalesce)
+
+        scheduled.jobfile = job.jobfile
+        scheduled.owner = job.owner
+        scheduled.type = job.type
+        scheduled.priority = job.priority
+        scheduled.limits = job.limits
+        scheduled.timeout = job.timeout
+        scheduled.status = 'Enabled'
+
+        return scheduled
+
+
+    def _unschedule(self, job):
+        """takes a job out of the scheduler. must be called with job_lock held"""
+
+        try:
+            self.sched.unschedule_job(job)
+
+        except KeyError:
+
+            # apscheduler keeps jobs added while it's stopped in a pending list until it starts
+            pending = getattr(self.sched, '_pending_jobs', [])
+            pending[:] = [ entry for entry in pending if entry[0] is not job ]
+
+
     def disable_job(self, jobname, user, realuser):
         """
-        This disables a job by setting its rundate.year > 2100, 
-        and job.status to 'Disabled'.
+        Pauses a job: it's taken out of the scheduler, so it costs nothing when the scheduler
+        looks for due jobs, but stays in the job index with job.status 'Disabled'.
         """
 
-        if not self._check_if_job_exists(jobname):
-            return False, "Job does not exist."
+        # the lookup, status check and update must not interleave with another request for this
+        #   job. enable_job puts a new job object in the index, one looked up before would be stale
+        with self.job_lock:
+            job = self._get_job_obj(jobname)
 
-        job = self._get_job_obj(jobname)
+            if job is None:
+                return False, "Job does not exist."
 
-        # sorry, can't disable someone else's job unless you are root
-        if job.owner != user and user not in ['root', 'initial_import']:
-            self.logging.error("User '%s' tried to disable job: '%s', owned by: '%s'." 
-                                % (user, job.name, job.owner) )
-            return False, "Cannot disable job: '%s', owned by: '%s'" % (job.name, job.owner)
+            # sorry, can't disable someone else's job unless you are root
+            if job.owner != user and user != 'root':
+                self.logging.error("User '%s' tried to disable job: '%s', owned by: '%s'." 
+                                    % (user, job.name, job.owner) )
+                return False, "Cannot disable job: '%s', owned by: '%s'" % (job.name, job.owner)
         
-        # no job.status attribute. The only way possible is during job import
-        #
-        # this was ordered above the job.status line below because of Attribute.errors that 
-        #   I couldn't figure out how to catch
-        elif not job.status:
-            # this shouldn't return anything, since an xmlrpc request to disable
-            #   a non existent job should fail long before this
-            self.logging.debug("Job: '%s' has no status, must be an import with \
-                    'enabled=false'. Disabling job.", jobname)
-            
-        # can't disable a job that's already in a 'Disabled' state
-        elif job.status == 'Disabled':
-            return False, "Job: '%s' is already disabled." % job.name
+            # can't disable a job that's already in a 'Disabled' state
+            elif job.status == 'Disabled':
+                return False, "Job: '%s' is already disabled." % job.name
 
-            
-        # set the year for the job to run to be > 2100. ghetto disable
-        #
-        # idea from: http://stackoverflow.com/questions/5871168/how-can-i-subtract-or-add-100-years-to-a-datetime-field-in-the-database-in-djang
-        next_run_time = job.next_run_time
-        disabled_run_time = datetime.datetime(
-                next_run_time.year + 200, *next_run_time.timetuple()[1:-2])
-        job.next_run_time = disabled_run_time
-        job.status = 'Disabled'
+            self._unschedule(job)
+            job.next_run_time = None
+            job.status = 'Disabled'
 
         self.logging.info("Job: '%s' has been disabled by user: '%s'.", 
                 job.name, user)
-        self.logging.info("Disabled job: '%s', New Schedule: '%s'", 
-                job.name, job)
 
         return True, "Job: '%s' has been disabled." % job.name 
 
             
+    def disable_jobs(self, selector, user, realuser):
+        """disables every job matching selector (see select_jobs). returns a [jobname, returncode, output] result per job"""
+
+        return self._bulk(self.disable_job, selector, user, realuser)
+
+            
     def enable_job(self, jobname, user, realuser):
         """Re-enables a job that was disabled via the rpc client"""
 
-        if not self._check_if_job_exists(jobname):
-            return False, "Job does not exist."
-        
-        job = self._get_job_obj(jobname)
-    
-        # sorry, can't enable someone else's job unless you are root
-        if job.owner != user and user != 'root':
-            self.logging.error("User '%s' tried to re-enable job: '%s', owned by: '%s'." 
-                                % (user, job.name, job.owner) )
-            return False, "Cannot re-enable job: '%s', owned by: '%s'" % (job.name, job.owner)
-
-        elif job.status == 'Enabled':
-            return False, "Job: '%s' is already enabled." % job.name
-
-        # job.compute_next_run_time is an internal apscheduler function that 
-        #   uses the initial job scedule submission parameters to determine the 
-        #   next run time. since we want to re-enable the job, this will 
-        #   reschedule the job to run at the next valid time
-        new_next_run_time = job.compute_next_run_time(datetime.datetime.now())
-        job.next_run_time = new_next_run_time
-        job.status = 'Enabled'
+        # the lookup, status check and update must not interleave with another request for this job
+        with self.job_lock:
+            job = self._get_job_obj(jobname)
+
+            if job is None:
+                return False, "Job does not exist."
+
+            # sorry, can't enable someone else's job unless you are root
+            if job.owner != user and user != 'root':
+                self.logging.error("User '%s' tried to re-enable job: '%s', owned by: '%s'." 
+                                    % (user, job.name, job.owner) )
+                return False, "Cannot re-enable job: '%s', owned by: '%s'" % (job.name, job.owner)
+
+            elif job.status == 'Enabled':
+                return False, "Job: '%s' is already enabled." % job.name
+
+            # the scheduler works out the next run time from now
+            try:
+                job = self.job_index[job.name] = self._schedule(job)
+
+            except ValueError as ve:
+                return False, "Cannot re-enable job: '%s', error: '%s'" % (job.name, ve)
 
         self.logging.info("Job: '%s' has been re-enabled by user: '%s'.", 
                 job.name, user)
@@ -243,13 +359,19 @@ class JobCtl(object):
         return True, "Job: '%s' has been re-enabled" % job.name
 
 
-    def force_run_job(self, jobname, user, realuser):
-        """Run a job in the jobstore at this very moment. Does not spawn another thread."""
+    def enable_jobs(self, selector, user, realuser):
+        """re-enables every job matching selector (see select_jobs). returns a [jobname, returncode, output] result per job"""
+
+        return self._bulk(self.enable_job, selector, user, realuser)
 
-        if not self._check_if_job_exists(jobname):
-            return False, "Job does not exist."
+
+    def force_run_job(self, jobname, user, realuser):
+        """Run a job in the jobstore at this very moment. Returns as soon as the run has started."""
 
         job = self._get_job_obj(jobname)
+
+        if job is None:
+            return False, "Job does not exist."
         
         # don't let any joe schmoe force run a job they don't own
         if user != job.owner and user != 'root':
@@ -258,206 +380,505 @@ class JobCtl(object):
             return False, "User: '%s', cannot force run job: '%s', owned by '%s'" % (user, job.name, job.owner)
 
         self.logging.info("User: '%s(%s)', force running job: '%s'", user, realuser, jobname)
-        self.run_job(**job.kwargs)
 
-        return True, "Successfully force ran job: '%s'" % job.name
+        # test mode enabled. No subprocesses will spawn, and job won't execute it's function
+        if self.config.get('main', 'test_mode') == '1':
+            return self.run_job(**job.kwargs), "Test mode enabled, job '%s' not run." % job.name
+
+        run_id = self.dispatcher.submit(job.kwargs, job.type, job.priority, job.max_instances)
+
+        if run_id is None:
+            return False, "Job: '%s' is already running or queued." % job.name
+
+        if run_id == 0:
+            return True, "Queued job: '%s', it will start once it fits under the concurrency limits" % job.name
+
+        return True, "Started job: '%s', run id: %s" % (job.name, run_id)
+
+
+    def cancel_run(self, run_id, user, realuser):
+        """Ends a running job run: SIGTERM to its process group, then SIGKILL if it doesn't exit."""
+
+        try:
+            run = self.supervisor.runs.get(int(run_id))
+
+        except (TypeError, ValueError):
+            return False, "Invalid run id: '%s'" % run_id
+
+        if run is None:
+            return False, "Run: %s is not running." % run_id
+
+        # same rule as disabling or removing a job
+        if user != run.owner and user != 'root':
+            self.logging.error("User '%s' tried to cancel run %s of job: '%s', owned by '%s'",
+                    user, run_id, run.job_name, run.owner)
+            return False, "User: '%s', cannot cancel job: '%s', owned by '%s'" % (user, run.job_name, run.owner)
+
+        if not self.supervisor.cancel(run.run_id):
+            return False, "Run: %s of job: '%s' has not started, or is already being cancelled." % (run_id, run.job_name)
+
+        self.logging.info("User: '%s(%s)', cancelled run %s of job: '%s'", user, realuser, run_id, run.job_name)
+        return True, "Cancelling run: %s of job: '%s'" % (run_id, run.job_name)
 
 
     def _get_job_obj(self, jobname):
-        """returns a job object"""
+        """returns a job object, or None if the job does not exist"""
+
+        job = self.job_index.get(jobname)
 
-        # check if job checks
-        if not self._check_if_job_exists(jobname):
+        if job is None:
             self.logging.debug("Function: get_job, Job: '%s' does not exist." % jobname)
-            return False, "Job: '%s' does not exist." % jobname
 
-        jobs = self.sched.get_jobs()
+        return job
 
-        for job in jobs:
 
-            if job.name == jobname:
-                return job
-            else:
-                pass
+    # fields of a list_jobs record, in record order
+    list_fields = ['name', 'owner', 'type', 'status', 'next_run_time']
 
-        # this is an internal error. if we make it all the way through the for loop
-        #   and don't find the job, it doesn't exist. 
-        raise RatkingException("Function: ratking.jobcontrol._get_job_obj() went plaid.")
+    def job_history(self, query):
+        """
+        Returns recorded runs, newest first. query is a dict with any of:
 
+            job   - jobname (default: all jobs)
+            start - only runs that started at or after this time (epoch seconds)
+            end   - only runs that started before this time (epoch seconds)
+            limit - max runs returned (default: 100)
 
-    def read_jobfile(self, filename):
-        """reads a file, parses with ConfigParser, and returns a dictionary of config options"""
+        Returns True, {'fields': HistoryStore.fields, 'runs': [record, ...], 'stats': {job: stats}},
+        where stats (see HistoryStore.stats) covers every run matching job/start/end, not just this page.
+        """
+
+        if self.history is None:
+            return False, "Run history is not enabled, set history_db in the ratkingd config."
+
+        job_name = query.get('job')
+        start = query.get('start')
+        end = query.get('end')
 
+        # xmlrpc has no None, records use '' for missing values
+        runs = [ [ '' if value is None else value for value in row ]
+                    for row in self.history.query(job_name, start, end, int(query.get('limit', 100))) ]
 
-        # first off, check and see if the jobfile is in $RATKING_ROOT/etc/jobs.d
-        #   We do not want jobfiles spread randomly everywhere
+        return True, {'fields': self.history.fields, 'runs': runs, 'stats': self.history.stats(job_name, start, end)}
+
+
+    def job_costs(self, query):
+        """
+        Returns the jobs whose runs cost the most CPU, memory or I/O, from the run history.
+        query is a dict with any of:
+
+            start - only runs that started at or after this time (epoch seconds)
+            end   - only runs that started before this time (epoch seconds)
+            sort  - one of HistoryStore.cost_fields but job_name (default: cpu)
+            limit - max jobs returned (default: 50)
+
+        Returns True, {'fields': HistoryStore.cost_fields, 'jobs': [record, ...]}
+        """
+
+        if self.history is None:
+            return False, "Run history is not enabled, set history_db in the ratkingd config."
 
-        parser=ConfigParser.SafeConfigParser()
         try:
-            parser.read([filename])
-        
-        except ConfigParser.MissingSectionHeaderError as error:
-            return False, "Config file: '%s' is not in correct format" % filename
+            jobs = self.history.costs(query.get('start'), query.get('end'), query.get('sort', 'cpu'),
+                    int(query.get('limit', 50)))
 
-        except MissingSectionHeaderError as error:
-            return False, "Config file: '%s' is not in correct format" % filename
+        except ValueError as ve:
+            return False, str(ve)
+
+        return True, {'fields': self.history.cost_fields, 'jobs': [ list(job) for job in jobs ]}
 
-        for section in parser.sections():
-            
-            for option in parser.options(section):
-                
-                try:
-                    value=parser.getint(section,option)
-                except ValueError:
-                    value=parser.get(section,option)
 
+    def trace_summary(self, query):
+        """
+        Returns where the time of job runs goes, per lifecycle phase (see tracing.PHASES).
+        query is a dict with any of:
 
-        # check the config file, and make sure a number of things exist
-        if len(parser.sections()) != 1:
-            self.logging.error("Reading jobfile: Cannot have more (or less) than one [section] in job config file.")
-            return False, "Cannot have more (or less) than one [section] in job config file."
+            job   - jobname (default: the jobs with the most time spent outside of their plugin)
+            limit - max jobs returned without job (default: 20)
 
-        jobname = parser.sections()[0]  # we already ensured that this array is length 1
+        Returns True, Tracer.summary()
+        """
 
-        # make sure the jobname matches the filename (minus the .conf)
-        if jobname != filename.split(os.path.sep)[-1].split('.')[0]:
-            self.logging.error("Filename: %s (minus .conf) must match header name: [%s]", filename, jobname)
-            return False, "Filename: %s (minus .conf) must match header name: [%s]" % (filename, jobname)
+        if self.tracer is None:
+            return False, "Run tracing is not enabled, set trace_runs in the ratkingd config."
 
-        required_options = ['type', 'schedule', 'owner', 'plugin_name', 'kwargs', 'enabled', 'autostart']
+        return True, self.tracer.summary(query.get('job'), int(query.get('limit', 20)))
 
-        # make sure if the job is a plugin job, the plugin is in $RATKING_ROOT/var/lib/ratkingd/plugins.d
 
-        for req in required_options:
-            
-            if not req in parser._sections[jobname]:
+    def forecast(self, query):
+        """
+        Forecasts when enabled jobs will start, and how many will be running, to find the
+        minutes where too many jobs pile up. query is a dict with any of:
+
+            hours             - how far ahead to look (default: 24)
+            resolution        - minutes per bucket of the returned series (default: 60)
+            top               - how many of the busiest minutes to return (default: 20)
+            name, owner, type - only forecast these jobs, as in select_jobs
+
+        Expected running jobs need run durations, the median of the last week's runs from
+        the run history (history_db). Jobs without recorded runs count as starts only.
+
+        Returns True, forecast.forecast() plus 'jobs' (forecast) and 'no_history' (of those,
+        the jobs without recorded runs)
+        """
+
+        hours = float(query.get('hours', 24))
+        resolution = int(query.get('resolution', 60))
+        top = int(query.get('top', 20))
 
-                self.logging.error("Missing required job config options: '%s'" % req)
-                return False, "Missing one or more attributes '[%s]' in job config file." % req
+        if not 0 < hours <= 24 * 366:
+            return False, "hours must be between 0 and %d." % (24 * 366)
 
-        # get the calling function, so that if its import_jobs, we don't load if autostart=false
-        calling_function = inspect.stack()[2][3]
+        if resolution < 1:
+            return False, "resolution must be a positive number."
+
+        durations = {}
+
+        if self.history is not None:
+            durations = dict( (name, stats['p50']) for name, stats
+                    in self.history.stats(start=time.time() - 7 * 86400).iteritems() if 'p50' in stats )
+
+        jobs = [ (job.trigger, durations.get(job.name, 0)) for job in self.select_jobs(query) if job.status == 'Enabled' ]
+
+        result = forecast(jobs, datetime.datetime.now(), int(hours * 60), resolution, top)
+        result['jobs'] = len(jobs)
+        result['no_history'] = len([ job for job, duration in jobs if not duration ])
+
+        return True, result
+
+
+    def running_jobs(self, query):
+        """
+        Returns the job runs going right now, oldest first. query is a dict with any of:
+
+            name, owner, type - filters, as in select_jobs
+
+        Returns True, {'fields': Supervisor.running_fields, 'runs': [record, ...], 'queued': runs
+        waiting in the dispatcher's queue}
+        """
 
-        if calling_function == 'import_jobs' and parser._sections[jobname]['autostart'].lower() == 'false':
-            self.logging.info("During import: job will not be added, autostart=false in config file.")
-            return False, 'During import: job will not be added, autostart=false in config file.'
+        runs = self.supervisor.running()
+
+        if any(query.get(key) for key in ('name', 'owner', 'type')):
+            names = set(job.name for job in self.select_jobs(query))
+            runs = [ run for run in runs if run[1] in names ]
+
+        return True, {'fields': self.supervisor.running_fields, 'runs': runs, 'queued': self.dispatcher.depth()}
+
+
+    def tail_job_output(self, jobname, run_id, offset, user, realuser):
+        """
+        Returns output of a job, from offset on. With run_id, output of that run only (one of the
+        job's last 20), offset 0 is where it starts. With run_id 0, all of the job's output that's
+        kept, and a negative offset is that many bytes before the end.
+
+        Only the job's owner and root can read it. Output of a job that's no longer loaded is root's only.
+
+        Returns True, OutputCapture.tail(), call again with its 'offset' for the bytes that came since
+        """
+
+        if self.output is None:
+            return False, "Output capture is not enabled, set output_dir in the ratkingd config."
+
+        job = self._get_job_obj(jobname)
+
+        if job is None and jobname not in self.output.logs:
+            return False, "Job does not exist."
+
+        # jobs print secrets often enough, same rule as disabling or removing a job
+        owner = job.owner if job is not None else 'root'
+
+        if user != owner and user != 'root':
+            self.logging.error("User '%s(%s)' tried to read the output of job: '%s', owned by '%s'",
+                    user, realuser, jobname, owner)
+            return False, "User: '%s', cannot read the output of job: '%s', owned by '%s'" % (user, jobname, owner)
 
-        # this checks to make sure that the kwargs= section in the jobfile can be properly converted to
-        #   a dictionary later on in the process
         try:
-            ast.literal_eval(parser._sections[jobname]['kwargs'])
+            run_id, offset = int(run_id), int(offset)
 
-        except ValueError as ve:
+        except (TypeError, ValueError):
+            return False, "Invalid run id or offset."
+
+        result = self.output.tail(jobname, run_id, offset)
+
+        if result is None:
+            return False, "No output recorded for run: %s of job: '%s'" % (run_id, jobname)
+
+        return True, result
+
+
+    def list_jobs(self, query):
+        """
+        Returns a filtered, sorted page of jobs as compact records, for clients to format.
+
+        query is a dict with any of:
+
+            name, owner, type - filters, as in select_jobs
+            status            - filter on 'Enabled' or 'Disabled'
+            sort              - field to sort on, one of list_fields (default: name)
+            limit             - max records per page (default: 500)
+            cursor            - the next_cursor of the previous page
+
+        Returns True, {'fields': list_fields, 'jobs': [record, ...], 'total': matching jobs,
+        'next_cursor': cursor of the next page, '' on the last page}
+        """
+
+        sort = query.get('sort', 'name')
+        limit = int(query.get('limit', 500))
+        status = query.get('status')
+
+        if sort not in self.list_fields:
+            return False, "Cannot sort on: '%s', must be one of: %s" % (sort, ', '.join(self.list_fields))
+
+        if limit < 1:
+            return False, "limit must be a positive number."
+
+        column = self.list_fields.index(sort)
+
+        records = [ self._job_record(job) for job in self.select_jobs(query) ]
+
+        if status:
+            records = [ r for r in records if r[3] == status ]
+
+        # sorted on (sort field, name), names are unique so this is a total order a cursor can resume from
+        records.sort(key=lambda r: (r[column], r[0]))
+
+        start = 0
+
+        if query.get('cursor'):
+
+            try:
+                cursor_sort, key = json.loads(query['cursor'])
+    
+            except (ValueError, TypeError):
+                return False, "Invalid cursor."
+
+            if cursor_sort != sort:
+                return False, "Cursor is from a listing sorted on: '%s'" % cursor_sort
+
+            start = bisect.bisect_right([ (r[column], r[0]) for r in records ], tuple(key))
+
+        page = records[start:start + limit]
+        next_cursor = ''
+
+        if start + limit < len(records):
+            last = page[-1]
+            next_cursor = json.dumps([sort, [last[column], last[0]]])
+
+        return True, {'fields': self.list_fields, 'jobs': page, 'total': len(records), 'next_cursor': next_cursor}
 
-            self.logging.debug("Error importing jobfile: '%s'. kwargs must have apostrophies around all key value " +
-                                "pairs: { 'keyname' : 'value' }, or be True|False: { 'mail' : True }")
-            return False, 'Job import failed, kwargs key/value parsing error'
-        
-        return True, parser._sections
+
+    def _job_record(self, job):
+        """a job as a list_jobs record, see list_fields"""
+
+        if job.status == 'Disabled' or job.next_run_time is None:
+            return [ job.name, job.owner, job.type, 'Disabled', 'Never' ]
+
+        return [ job.name, job.owner, job.type, job.status, job.next_run_time.strftime('%Y-%m-%d %H:%M:%S') ]
+
+
+    def read_jobfile(self, filename):
+        """reads a file, parses with ConfigParser, and returns a dictionary of config options"""
+
+        try:
+            st = os.stat(filename)
+
+        except OSError as oe:
+            return False, "Config file: '%s' could not be read: %s" % (filename, oe)
+
+        cached = self.parse_cache.get(filename)
+
+        if cached is not None and cached[:2] == (st.st_mtime, st.st_size):
+            return cached[2:]
+
+        returncode, output = parse_jobfile(filename)
+        self.parse_cache[filename] = (st.st_mtime, st.st_size, returncode, output)
+
+        if returncode is False:
+            self.logging.error("Reading jobfile: %s", output)
+
+        return returncode, output
 
     
+    def reload_jobfile(self, filename):
+        """
+        Brings the jobstore in line with a jobfile in job_dir that was created, changed or deleted.
+
+        Used by the job_dir watcher. A deleted jobfile removes its job, a changed one replaces
+        it, and an unchanged one (same mtime and size as the last parse) is left alone. A new
+        jobfile with autostart=false isn't loaded, as in import_jobs. A job that was disabled
+        stays disabled when its jobfile changes, and if the new version can't be added, the
+        old one stays loaded.
+        """
+
+        jobname = os.path.basename(filename).split('.')[0]
+        cached = self.parse_cache.get(filename)
+
+        if not os.path.isfile(filename):
+            self.parse_cache.pop(filename, None)
+
+            if not self._check_if_job_exists(jobname):
+                return True, "Job: '%s' not loaded, nothing to remove." % jobname
+
+            return self.remove_job(jobname, 'root', 'job_dir_watcher')
+
+        returncode, output = self.read_jobfile(filename)
+
+        # a broken edit leaves the currently loaded version of the job in place
+        if returncode is False:
+            return False, output
+
+        jobdict = output.itervalues().next()
+
+        with self.job_lock:
+            old = self._get_job_obj(jobname)
+
+            if old is None and jobdict['autostart'].lower() == 'false':
+                self.logging.info("Job: '%s' will not be added, autostart=false in jobfile: %s", jobname, filename)
+                return True, "Job: '%s' not loaded, autostart=false." % jobname
+
+            if old is not None:
+
+                if self.parse_cache.get(filename) is cached:
+                    return True, "Job: '%s' is unchanged." % jobname
+
+                returncode, output = self.remove_job(jobname, 'root', 'job_dir_watcher')
+
+                if returncode is False:
+                    return False, output
+
+            returncode, output = self.add_parsed_job(filename, jobdict, 'initial_startup', 'job_dir_watcher')
+
+            if old is None:
+                return returncode, output
+
+            # the new version was rejected, put the old one back as it was
+            if returncode is False:
+                self._restore_job(old)
+                self.logging.error("Job: '%s' kept its loaded version, its changed jobfile was rejected: %s",
+                        jobname, output)
+                return False, output
+
+            if old.status == 'Disabled' and self.job_index[jobname].status == 'Enabled':
+                self.disable_job(jobname, 'root', 'job_dir_watcher')
+
+        return returncode, output
+
+
+    def _restore_job(self, job):
+        """puts a removed job back in the index, and in the scheduler if it was enabled. must be called with job_lock held"""
+
+        if job.status == 'Enabled':
+
+            try:
+                job = self._schedule(job)
+
+            except ValueError as ve:
+                self.logging.error("Job: '%s' could not be scheduled again, it stays disabled: %s", job.name, ve)
+                job.next_run_time = None
+                job.status = 'Disabled'
+
+        self.job_index[job.name] = job
+
+
     def remove_job(self, jobname, user, realuser):
         """Removes a job from the schedule completely"""
 
-        if not self._check_if_job_exists(jobname):
-            return False, "Job does not exist."
+        try:
+            # looked up under the lock, so it's the object enable_job/disable_job left in the index
+            with self.job_lock:
+                job = self._get_job_obj(jobname)
 
-        job = self._get_job_obj(jobname)
+                if job is None:
+                    return False, "Job does not exist."
 
-        # first check if the user removing the job owns that job
-        if user != 'root' and user != job.owner:
+                # first check if the user removing the job owns that job
+                if user != 'root' and user != job.owner:
 
-            self.logging.error("Job: '%s', cannot be removed by user: '%s(%s)'", job.name, user, realuser)
-            return False, 'Cannot remove a job you do not own.'
+                    self.logging.error("Job: '%s', cannot be removed by user: '%s(%s)'", job.name, user, realuser)
+                    return False, 'Cannot remove a job you do not own.'
+
+                # paused jobs aren't in the scheduler
+                if job.status != 'Disabled':
+                    self._unschedule(job)
+
+                del self.job_index[job.name]
 
-        try:
-            self.sched.unschedule_job(job)
             self.logging.info("Job: '%s', removed by user: '%s(%s)'", job.name, user, realuser)
             return True, "Successfully removed job: '%s'" % job.name
 
         except KeyError as ke:
-            return False, "Removing job: '%s' failed, Error: '%s'" % (job.name, ke)      
+            return False, "Removing job: '%s' failed, Error: '%s'" % (jobname, ke)
+
+
+    def remove_jobs(self, selector, user, realuser):
+        """removes every job matching selector (see select_jobs). returns a [jobname, returncode, output] result per job"""
+
+        return self._bulk(self.remove_job, selector, user, realuser)
 
 
     def run_job(self, **kwargs):
-        """sets up multiprocessor to run the actual exec function """
+        """starts a scheduled run of a job in the background, returns its run id (None if it wasn't started)"""
 
         # test mode enabled. No subprocesses will spawn, and job won't execute it's function
         if self.config.get('main', 'test_mode') == '1':
             self.logging.info("Test mode enabled, job '%s' finishing.", kwargs['job_name'])
             return True
 
-        # use multiprocess to fork a new process for each job being run
-        p = multiprocessing.Process(target=self._run_job_exec, kwargs=kwargs)
-        p.daemon = True
-        p.start()
+        fired = time.time()
+        job = self._get_job_obj(kwargs['job_name'])
 
-        # this will wait for the process to finish. since apscheduler runs jobs via a separate thread,
-        #   only the job running thread will be blocking, so the rest of the main daemon will be fine
-        p.join()    
-    
-        return True
+        if job is None:
+            return self.dispatcher.submit(kwargs, fired=fired)
 
+        # apscheduler has already moved next_run_time on, and doesn't tell the job which run time
+        #   it's running for. a run more than misfire_grace_time late is never started, so the run
+        #   time this is for is the first one since then
+        now = datetime.datetime.now()
+        scheduled = job.trigger.get_next_fire_time(now - datetime.timedelta(seconds=job.misfire_grace_time))
 
-    def _run_job_exec(self, **kwargs):
-        """Loads appropriate module, changes uid/gid to owner/group, and runs the job """
-       
-        plugin_dir = self.config.get('main', 'plugin_dir')
-        plugin_name = kwargs['plugin_name'].split('.')[0]
-        plugin_path = "%s%s%s" % (plugin_dir, os.path.sep, kwargs['plugin_name'])
-        #sys.path.append(plugin_dir)
+        if scheduled is not None and scheduled <= now:
+            scheduled = time.mktime(scheduled.timetuple()) + scheduled.microsecond / 1e6
 
-        # this loads the plugin
-        try:
+        else:
+            scheduled = None
 
-            # first, check if the plugin even exists
-            if os.path.isfile(plugin_path):
-                pass
-            else:
-                #self.logging.error("Job (%s) run error, plugin does not exist: '%s'" 
-                #        %  (kwargs['job_name'], plugin_path) )
-                raise RatkingException("Job (%s) run error, plugin does not exist: '%s'" 
-                    %  (kwargs['job_name'], plugin_path) )
-            
+        # the supervisor forks the job (or hands it to a prefork worker) and returns right away.
+        #   its reaper thread collects the exit status, so this apscheduler thread is free again.
+        #   runs over a concurrency limit wait in the dispatcher's queue instead (run id 0)
+        run_id = self.dispatcher.submit(kwargs, job.type, job.priority, job.max_instances, scheduled, fired)
 
-            if kwargs['plugin_name'] not in sys.modules.keys():
-                self.logging.debug("Importing module: %s" % plugin_name)
-                lib = importlib.import_module(plugin_name)
+        if run_id is None:
+            self.metrics.skipped.inc()
 
-            else:
-                # we reload so that each time the script is run, any updates to the plugin
-                #   will be in effect. usecases would be if you disable/re-enable a job due to error.
-                #   Python won't 'unload' the module when you disable it. remove_job and then add_job
-                #   probably won't do any garbage collection either.
-                self.logging.debug("Reloading module: %s" % plugin_name)
-                reload(plugin_name)
+        return run_id
 
-        except ImportError as ie:
-            
-            self.logging.error("Module import error for job: '%s'" % kwargs['job_name'])    
-            raise RatkingException("Module import error for job: '%s, error: %s'" \
-                                % (kwargs['job_name'], ie) )
+
+    def _run_job_exec(self, **kwargs):
+        """Loads appropriate module, changes uid/gid to owner/group, and runs the job """
+
+        lib = self._load_plugin(kwargs)
+        mark('plugin_loaded')
 
         try:     
 
-            # get uid/gid of job owner:
-            uid = getpwnam(kwargs['owner'])[2]
+            # resource limits, nice and ionice from the jobfile, set while still root so lowering
+            #   nice works, and the hard limits are out of the job's reach once it's the owner
+            job = self.job_index.get(kwargs['job_name'])
 
-            # get primary group gid of user
-            gid = getpwnam(kwargs['owner'])[3]  
-            group_name = grp.getgrgid(gid)[0]
+            if job is not None and job.limits:
+                apply_limits(job.limits, kwargs['owner'])
 
-            self.logging.debug("Running job: '%s' as user: '%s', group: '%s'", 
-                            kwargs['job_name'], kwargs['owner'], group_name)
-            
-            # use drop_privileges module to set the uid/gid of the subprocess
-            drop_privileges(uid_name=kwargs['owner'], gid_name=group_name)
+            self._drop_to_owner(kwargs)
+            mark('privileges_dropped')
 
             # ALL plugin's main() function should accept **kwargs:
             #   EX: def main(**kwargs):
             #
             # run the actual module
+            mark('main_start')
             lib.main(**kwargs)
+            mark('main_end')
 
             return True
     
@@ -468,12 +889,96 @@ class JobCtl(object):
 
         return True
 
+
+    def _load_plugin(self, kwargs):
+        """returns the plugin module for a job, from the plugin cache"""
+
+        try:
+            return self.plugins.load(kwargs['plugin_name'])
+
+        except ImportError as ie:
+            
+            self.logging.error("Module import error for job: '%s'" % kwargs['job_name'])    
+            raise RatkingException("Module import error for job: '%s, error: %s'" \
+                                % (kwargs['job_name'], ie) )
+
+
+    def _drop_to_owner(self, kwargs):
+        """changes the uid/gid of the current process to the job owner and their primary group"""
+
+        # get uid/gid of job owner:
+        uid = getpwnam(kwargs['owner'])[2]
+
+        # get primary group gid of user
+        gid = getpwnam(kwargs['owner'])[3]  
+        group_name = grp.getgrgid(gid)[0]
+
+        self.logging.debug("Running job: '%s' as user: '%s', group: '%s'", 
+                        kwargs['job_name'], kwargs['owner'], group_name)
+        
+        # use drop_privileges module to set the uid/gid of the subprocess
+        drop_privileges(uid_name=kwargs['owner'], gid_name=group_name)
+
  
+    def select_jobs(self, selector):
+        """
+        Returns the jobs matching selector, a dict with any of the keys:
+
+            name  - jobname, or a shell style glob of jobnames ('backup_*')
+            owner - job owner
+            type  - job type
+
+        A job has to match every key given.
+        """
+
+        name = selector.get('name')
+        owner = selector.get('owner')
+        jobtype = selector.get('type')
+
+        with self.job_lock:
+
+            # a plain jobname is a single index lookup
+            if name and not glob.has_magic(name):
+                candidates = [ self.job_index[name] ] if name in self.job_index else []
+
+            else:
+                candidates = self.job_index.values()
+
+            return [ job for job in candidates
+                        if (not name or fnmatch.fnmatchcase(job.name, name))
+                        and (not owner or job.owner == owner)
+                        and (not jobtype or job.type == jobtype) ]
+
+
+    def _bulk(self, operation, selector, user, realuser):
+        """runs operation(jobname, user, realuser) on every job matching selector, under one hold of the job lock"""
+
+        if not any(selector.get(key) for key in ('name', 'owner', 'type')):
+            return False, "Selector needs at least one of: name, owner, type."
+
+        with self.job_lock:
+            jobs = self.select_jobs(selector)
+
+            if not jobs:
+                return False, "No jobs match selector: %s" % selector
+
+            results = []
+
+            for job in sorted(jobs, key=lambda j: j.name):
+                returncode, output = operation(job.name, user, realuser)
+                results.append([job.name, returncode, output])
+
+        return True, results
+
+
     def show_jobs(self):
         """Returns a list object of all active jobs"""
 
         output = []
-        jobs = self.sched.get_jobs()
+
+        # the index has paused jobs too, the scheduler only has the enabled ones
+        with self.job_lock:
+            jobs = sorted(self.job_index.values(), key=lambda job: job.name)
 
         output.append('{0: <25} {1: <15} {2: <15} {3: <10} {4}' \
                 .format('Jobname', 'Jobowner', 'JobType', 'Status', 'Next Run Time'))
@@ -484,10 +989,8 @@ class JobCtl(object):
             status = job.status
             next_run_time = job.next_run_time
 
-            # dirty hack to display disabled jobs in a meaningful way
-            if job.next_run_time.year > 2100 or job.status == 'Disabled':
+            if job.status == 'Disabled':
                 next_run_time = 'Never'
-                status = 'Disabled'
 
             line = '{0: <25} {1: <15} {2: <15} {3: <10} {4}' \
                 .format(job.name, job.owner, job.type, status, next_run_time)
@@ -498,6 +1001,93 @@ class JobCtl(object):
         return output
 
 
+def parse_jobfile(filename):
+    """
+    Parses and validates a jobfile. Returns (True, sections) or (False, error).
+
+    This is a plain function (no logging, no JobCtl state) so that it can be run
+    in worker processes during a bulk import.
+    """
+
+    # first off, check and see if the jobfile is in $RATKING_ROOT/etc/jobs.d
+    #   We do not want jobfiles spread randomly everywhere
+
+    parser=ConfigParser.SafeConfigParser()
+    try:
+        parser.read([filename])
+    
+    except ConfigParser.Error as error:
+        return False, "Config file: '%s' is not in correct format" % filename
+
+    # check the config file, and make sure a number of things exist
+    if len(parser.sections()) != 1:
+        return False, "Cannot have more (or less) than one [section] in job config file: '%s'." % filename
+
+    jobname = parser.sections()[0]  # we already ensured that this array is length 1
+
+    # make sure the jobname matches the filename (minus the .conf)
+    if jobname != filename.split(os.path.sep)[-1].split('.')[0]:
+        return False, "Filename: %s (minus .conf) must match header name: [%s]" % (filename, jobname)
+
+    required_options = ['type', 'schedule', 'owner', 'plugin_name', 'kwargs', 'enabled', 'autostart']
+
+    # make sure if the job is a plugin job, the plugin is in $RATKING_ROOT/var/lib/ratkingd/plugins.d
+
+    for req in required_options:
+        
+        if not req in parser._sections[jobname]:
+            return False, "Missing one or more attributes '[%s]' in job config file." % req
+
+    # this checks to make sure that the kwargs= section in the jobfile can be properly converted to
+    #   a dictionary later on in the process. kwargs must have apostrophies around all key value
+    #   pairs: { 'keyname' : 'value' }, or be True|False: { 'mail' : True }
+    try:
+        ast.literal_eval(parser._sections[jobname]['kwargs'])
+
+    except (ValueError, SyntaxError) as ve:
+        return False, 'Job import failed, kwargs key/value parsing error'
+
+    try:
+        compile_schedule(parser._sections[jobname]['schedule'])
+
+    except ValueError as ve:
+        return False, "Job import failed, schedule error: %s" % ve
+
+    try:
+        parse_limits(parser._sections[jobname])
+
+    except ValueError as ve:
+        return False, "Job import failed, resource limit error: %s" % ve
+
+    if 'timeout' in parser._sections[jobname]:
+
+        try:
+            if float(parser._sections[jobname]['timeout']) < 0:
+                raise ValueError
+
+        except ValueError:
+            return False, "Job import failed, timeout must be a number of seconds: '%s'" % parser._sections[jobname]['timeout']
+
+    if 'priority' in parser._sections[jobname]:
+
+        try:
+            int(parser._sections[jobname]['priority'])
+
+        except ValueError:
+            return False, "Job import failed, priority must be a whole number: '%s'" % parser._sections[jobname]['priority']
+
+    if 'spread' in parser._sections[jobname]:
+
+        try:
+            if float(parser._sections[jobname]['spread']) < 0:
+                raise ValueError
+
+        except ValueError:
+            return False, "Job import failed, spread must be a number of seconds: '%s'" % parser._sections[jobname]['spread']
+    
+    return True, parser._sections
+
+
 class RatkingException(Exception):
 
     def __init__(self, message):
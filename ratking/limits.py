@@ -0,0 +1,146 @@
+import ctypes
+import ctypes.util
+import os
+import resource
+
+
+# jobfile option -> rlimit it sets
+RLIMITS = [
+    ('cpu_time', resource.RLIMIT_CPU),
+    ('address_space', resource.RLIMIT_AS),
+    ('open_files', resource.RLIMIT_NOFILE),
+    ]
+
+# ionice classes, and the ioprio_set syscall number per machine (linux only)
+IOPRIO_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_SET = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'armv7l': 314, 'ppc64le': 273}
+
+SIZE_SUFFIXES = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+
+def parse_limits(section):
+    """
+    Returns the resource limits set in a jobfile section (a dict), raises ValueError if one is invalid.
+
+    They're applied while the job's process is still root, so a job not owned by root can't use
+    them to get more than the daemon has: nice below the daemon's, the realtime io class, or an
+    rlimit over the daemon's hard limit are refused.
+
+        cpu_time      - seconds of CPU time, the run is killed (SIGXCPU) when it uses more
+        address_space - max memory the run can map, in bytes, or with a K, M or G suffix
+        open_files    - max open file descriptors
+        nice          - niceness, -20 to 19
+        ionice        - io scheduling class: idle, best-effort or realtime, best-effort and
+                        realtime with a level, 0 (highest) to 7: best-effort:7
+    """
+
+    limits = {}
+
+    for option, rlimit in RLIMITS:
+
+        if option in section:
+            value = section[option].strip().lower()
+
+            if option == 'address_space' and value[-1:] in SIZE_SUFFIXES:
+                limit = int(value[:-1]) * SIZE_SUFFIXES[value[-1]]
+
+            else:
+                limit = int(value)
+
+            if limit < 0:
+                raise ValueError("%s must not be negative: '%s'" % (option, section[option]))
+
+            hard = resource.getrlimit(rlimit)[1]
+
+            if not privileged(section) and hard != resource.RLIM_INFINITY and limit > hard:
+                raise ValueError("%s can't be over the daemon's hard limit (%s) for jobs not owned by root: '%s'"
+                        % (option, hard, section[option]))
+
+            limits[option] = limit
+
+    if 'nice' in section:
+        nice = int(section['nice'])
+
+        if not -20 <= nice <= 19:
+            raise ValueError("nice must be -20 to 19: '%s'" % section['nice'])
+
+        if not privileged(section) and nice < os.nice(0):
+            raise ValueError("nice can't be below the daemon's (%d) for jobs not owned by root: '%s'"
+                    % (os.nice(0), section['nice']))
+
+        limits['nice'] = nice
+
+    if 'ionice' in section:
+        ioclass, sep, level = section['ionice'].strip().lower().partition(':')
+
+        if ioclass not in IOPRIO_CLASSES or (level and (not level.isdigit() or int(level) > 7)) \
+                or (level and ioclass == 'idle'):
+            raise ValueError("ionice must be idle, best-effort[:0-7] or realtime[:0-7]: '%s'" % section['ionice'])
+
+        if not privileged(section) and ioclass == 'realtime':
+            raise ValueError("ionice realtime is only for jobs owned by root: '%s'" % section['ionice'])
+
+        limits['ionice'] = [ioclass, int(level or (0 if ioclass == 'idle' else 4))]
+
+    return limits
+
+
+def apply_limits(limits, owner):
+    """
+    applies parse_limits() limits to the current process, which is still root. raises OSError
+    if one can't be set. for owners other than root, the same things parse_limits() refuses are
+    clamped to what the daemon has, in case the daemon's own limits changed since
+    """
+
+    privileged = owner == 'root'
+
+    for option, rlimit in RLIMITS:
+
+        if option in limits:
+            limit = limits[option]
+            hard = resource.getrlimit(rlimit)[1]
+
+            if not privileged and hard != resource.RLIM_INFINITY:
+                limit = min(limit, hard)
+
+            # the hard limit too, so the job can't raise it again
+            try:
+                resource.setrlimit(rlimit, (limit, limit))
+
+            except resource.error as e:
+                raise OSError("could not set %s to %s: %s" % (option, limit, e))
+
+    if 'nice' in limits:
+        current = os.nice(0)
+        nice = limits['nice'] if privileged else max(limits['nice'], current)
+        os.nice(nice - current)
+
+    if 'ionice' in limits:
+        ioclass, level = limits['ionice']
+
+        if not privileged and ioclass == 'realtime':
+            ioclass = 'best-effort'
+
+        ioprio_set(ioclass, level)
+
+
+def privileged(section):
+    """True if a jobfile section's job runs as root, and may have any limits"""
+
+    return section.get('owner', '').strip() == 'root'
+
+
+def ioprio_set(ioclass, level):
+
+    number = IOPRIO_SET.get(os.uname()[4])
+
+    if number is None:
+        raise OSError("ionice is not supported on: %s" % os.uname()[4])
+
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+    if libc.syscall(number, IOPRIO_WHO_PROCESS, 0, IOPRIO_CLASSES[ioclass] << IOPRIO_CLASS_SHIFT | level) != 0:
+        error = ctypes.get_errno()
+        raise OSError(error, "ioprio_set failed: %s" % os.strerror(error))
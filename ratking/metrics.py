@@ -0,0 +1,315 @@
+import bisect
+import BaseHTTPServer
+import SocketServer
+import threading
+from util import get_option
+
+
+# seconds. covers sub-second plugin runs up to hour long jobs
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+
+
+class Metric(object):
+    """
+    Base of the metric types. Each metric keeps label values -> value(s) in a dict behind its
+    own lock, which is only held for the dict update, so recording costs about as much as
+    an uncontended lock and a dict lookup.
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+        self.series = {}
+        self.lock = threading.Lock()
+
+
+    def samples(self):
+        """returns [(name suffix, label pairs, value)] for render()"""
+
+        with self.lock:
+            return [ ('', zip(self.labels, key), value) for key, value in sorted(self.series.items()) ]
+
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def inc(self, labels=(), amount=1):
+
+        with self.lock:
+            self.series[labels] = self.series.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """a value that is set, or, with func, read when metrics are scraped"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=(), func=None):
+
+        Metric.__init__(self, name, help, labels)
+        self.func = func
+
+
+    def set(self, value, labels=()):
+
+        with self.lock:
+            self.series[labels] = value
+
+
+    def samples(self):
+
+        if self.func is None:
+            return Metric.samples(self)
+
+        return [ ('', [], self.func()) ]
+
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+
+        Metric.__init__(self, name, help, labels)
+        self.buckets = sorted(buckets)
+
+
+    def observe(self, value, labels=()):
+
+        # bucket counts, then the +Inf count, then the sum
+        i = bisect.bisect_left(self.buckets, value)
+
+        with self.lock:
+            series = self.series.get(labels)
+
+            if series is None:
+                series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+
+            series[i] += 1
+            series[-1] += value
+
+
+    def samples(self):
+
+        with self.lock:
+            series = [ (key, list(values)) for key, values in sorted(self.series.items()) ]
+
+        samples = []
+
+        for key, values in series:
+            labels = zip(self.labels, key)
+            count = 0
+
+            for bound, n in zip(self.buckets + ['+Inf'], values[:-1]):
+                count += n
+                samples.append(('_bucket', labels + [('le', bound)], count))
+
+            samples.append(('_sum', labels, values[-1]))
+            samples.append(('_count', labels, count))
+
+        return samples
+
+
+class Registry(object):
+    """a set of metrics, rendered in the Prometheus text format"""
+
+    def __init__(self):
+
+        self.metrics = []
+
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=(), func=None):
+        return self._add(Gauge(name, help, labels, func))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help, labels, buckets))
+
+
+    def _add(self, metric):
+
+        self.metrics.append(metric)
+
+        return metric
+
+
+    def render(self):
+
+        lines = []
+
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+
+            try:
+                samples = metric.samples()
+
+            # a gauge's func can fail, that shouldn't take down the other metrics
+            except Exception:
+                continue
+
+            for suffix, labels, value in samples:
+
+                if labels:
+                    labels = '{%s}' % ','.join('%s="%s"' % (k, escape(v)) for k, v in labels)
+
+                else:
+                    labels = ''
+
+                lines.append('%s%s%s %s' % (metric.name, suffix, labels, number(value)))
+
+        return '\n'.join(lines) + '\n'
+
+
+class Metrics(Registry):
+    """the daemon's metrics. recorded by JobCtl, the Supervisor, SchedCtl.import_jobs and RpcCtl"""
+
+    def __init__(self, jobctl):
+
+        Registry.__init__(self)
+
+        self.jobctl = jobctl
+
+        self.runs = self.counter('ratking_job_runs_total',
+                'Finished job runs, by plugin and final status.', ('plugin', 'status'))
+        self.failures = self.counter('ratking_job_failures_total',
+                'Job runs that did not finish successfully, by plugin.', ('plugin',))
+        self.skipped = self.counter('ratking_job_skipped_total',
+                'Scheduled runs not started because max_instances runs were already going, or one was queued.')
+        self.duration = self.histogram('ratking_job_duration_seconds',
+                'Wall clock time of job runs, by plugin.', ('plugin',))
+        self.timeouts = self.counter('ratking_job_timeouts_total',
+                'Job runs killed for running past their timeout, by plugin.', ('plugin',))
+        self.cancelled = self.counter('ratking_job_cancelled_total',
+                'Job runs killed by cancel_run, by plugin.', ('plugin',))
+        self.cpu = self.counter('ratking_job_cpu_seconds_total',
+                'CPU time (user and system) used by job runs, by plugin.', ('plugin',))
+        self.lag = self.histogram('ratking_job_lag_seconds',
+                'Time from when a scheduled run was due until it started.')
+
+        self.queue_wait = self.histogram('ratking_queue_wait_seconds',
+                'Time runs over a concurrency limit waited in the run queue before they started.')
+        self.queue_expired = self.counter('ratking_queue_expired_total',
+                'Queued runs dropped after waiting longer than queue_max_wait.')
+        self.queue_rejected = self.counter('ratking_queue_rejected_total',
+                'Runs not queued because queue_max_size runs were already waiting.')
+
+        self.rpc_calls = self.counter('ratking_rpc_requests_total',
+                'XMLRPC requests, by method.', ('method',))
+        self.rpc_latency = self.histogram('ratking_rpc_duration_seconds',
+                'Time spent serving XMLRPC requests, by method.', ('method',))
+
+        self.import_duration = self.gauge('ratking_import_duration_seconds',
+                'Time the last import of job_dir took.')
+        self.import_jobfiles = self.gauge('ratking_import_jobfiles',
+                'Jobfiles seen by the last import of job_dir, by result.', ('result',))
+
+        self.gauge('ratking_jobs', 'Jobs in the jobstore.', func=lambda: len(self.jobctl.job_index))
+        self.gauge('ratking_running_jobs', 'Job runs started and not yet reaped.',
+                func=lambda: len(self.jobctl.supervisor.runs))
+        self.gauge('ratking_queued_runs', 'Job runs waiting in the run queue for a concurrency limit.',
+                func=lambda: self.jobctl.dispatcher.depth())
+        self.gauge('ratking_scheduler_threads', 'Threads in the scheduler thread pool.',
+                func=lambda: len(self._threadpool()._threads))
+        self.gauge('ratking_scheduler_max_threads', 'Max threads of the scheduler thread pool.',
+                func=lambda: self._threadpool().max_threads)
+        self.gauge('ratking_scheduler_queued', 'Job runs waiting for a scheduler thread.',
+                func=lambda: self._threadpool()._queue.qsize())
+
+
+    def _threadpool(self):
+        return self.jobctl.sched._threadpool
+
+
+    def record_run(self, run):
+        """Supervisor listener"""
+
+        plugin = run.kwargs.get('plugin_name', '')
+
+        self.runs.inc((plugin, run.status))
+        self.duration.observe(run.duration, (plugin,))
+
+        if run.status != 'success':
+            self.failures.inc((plugin,))
+
+        if run.status == 'timeout':
+            self.timeouts.inc((plugin,))
+
+        elif run.status == 'cancelled':
+            self.cancelled.inc((plugin,))
+
+        if run.rusage:
+            self.cpu.inc((plugin,), run.rusage['utime'] + run.rusage['stime'])
+
+        if run.scheduled is not None:
+            self.lag.observe(max(run.start - run.scheduled, 0), ())
+
+
+class MetricsServer(threading.Thread):
+    """serves the metrics at http://metrics_host:metrics_port/metrics"""
+
+    def __init__(self, metrics, config, logging):
+
+        threading.Thread.__init__(self, name='ratking-metrics')
+        self.daemon = True
+
+        self.metrics = metrics
+        self.config = config
+        self.logging = logging
+
+        address = (get_option(self.config, 'metrics_host', ''), get_option(self.config, 'metrics_port', 0))
+
+        self.server = ThreadingHTTPServer(address, MetricsRequestHandler)
+        self.server.metrics = self.metrics
+
+
+    def run(self):
+
+        self.logging.info("Serving metrics on: %s:%s", *self.server.server_address)
+        self.server.serve_forever()
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+
+class MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = self.server.metrics.render()
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def number(value):
+
+    if isinstance(value, float):
+        return repr(value)
+
+    return str(value)
@@ -0,0 +1,378 @@
+import collections
+import errno
+import fcntl
+import os
+import select
+import threading
+from util import get_option
+
+
+class OutputCapture(object):
+    """
+    Captures the stdout and stderr of job runs into a log file per job, used when output_dir is set.
+
+    Every forked run writes to a pipe, and one thread multiplexes the read ends of all of
+    them with epoll (poll where there's no epoll), so there's no thread per running job.
+    Prefork workers keep one pipe for their whole life, and it's pointed at each run they
+    get in turn (start/stop).
+
+    Output is appended to output_dir/<job_name>.log, which is rotated to .log.1, .log.2, ...
+    once it reaches output_max_bytes, keeping output_backups old files. Bytes are addressed
+    by their offset in all output the job ever wrote (since the oldest file kept), which
+    stays put when files rotate, and the offsets where each of a job's last runs started
+    and ended are kept, so tail() reads new bytes with a seek.
+    """
+
+    # runs of each job whose offsets are kept
+    run_records = 20
+
+    def __init__(self, config, logging):
+
+        self.config = config
+        self.logging = logging
+
+        self.directory = self.config.get('main', 'output_dir')
+        self.max_bytes = get_option(self.config, 'output_max_bytes', 10485760)
+        self.backups = get_option(self.config, 'output_backups', 3)
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        # job_name -> JobLog, and pipe read fd -> Capture
+        self.logs = {}
+        self.captures = {}
+        self.lock = threading.Lock()
+
+        if hasattr(select, 'epoll'):
+            self.poller = select.epoll()
+            self.timeout = 1.0
+
+        else:
+            self.poller = select.poll()
+            self.timeout = 1000
+
+        self.events = select.POLLIN | select.POLLHUP | select.POLLERR
+
+        self.thread = threading.Thread(target=self._loop, name='ratking-output')
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def pipe(self):
+        """
+        a new (read fd, write fd) pipe, the read end non-blocking and close-on-exec. must be called
+        with the supervisor's fork_lock held, up to the fork and closing the write end after it
+        """
+
+        read_fd, write_fd = os.pipe()
+        fcntl.fcntl(read_fd, fcntl.F_SETFL, fcntl.fcntl(read_fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        fcntl.fcntl(read_fd, fcntl.F_SETFD, fcntl.fcntl(read_fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+        return read_fd, write_fd
+
+
+    def add(self, fd, job_name=None, run_id=None):
+        """starts capturing a pipe's read end, for a run (forked runs) or for the runs start() points it at"""
+
+        with self.lock:
+            capture = self.captures[fd] = Capture(fd)
+
+            if job_name is not None:
+                self._start(capture, job_name, run_id)
+
+        self.poller.register(fd, self.events)
+
+
+    def start(self, fd, job_name, run_id):
+        """the output on fd is run_id's from here on"""
+
+        with self.lock:
+            capture = self.captures.get(fd)
+
+            if capture is not None:
+                self._read(capture)
+                self._end(capture)
+                self._start(capture, job_name, run_id)
+
+
+    def stop(self, fd):
+        """the run on fd is done. reads what it wrote before it finished"""
+
+        with self.lock:
+            capture = self.captures.get(fd)
+
+            if capture is not None:
+                self._read(capture)
+                self._end(capture)
+
+
+    def tail(self, job_name, run_id=0, offset=0, limit=65536):
+        """
+        returns up to limit bytes of a job's output from offset, and where to continue from.
+
+        with a run_id, only that run's output, offset 0 is where it started. without one, all
+        of the job's output that's kept, and a negative offset counts back from the end.
+        returns None if run_id isn't one of the job's last runs.
+
+        returns {'data', 'offset': offset to read from next, 'end': offset of the end of
+        the output so far, 'done': True if no more output will come}
+        """
+
+        with self.lock:
+            log = self._log(job_name)
+
+            if run_id:
+                record = log.runs.get(run_id)
+
+                if record is None:
+                    return None
+
+                start, stop = record[0], record[1]
+                done = stop is not None
+
+                if stop is None:
+                    stop = log.total
+
+            else:
+                start, stop = log.bases[-1], log.total
+                done = not log.active
+
+                if offset < 0:
+                    offset = stop + offset
+
+            # the start of the output (or all of a run's) may have been rotated out
+            offset = min(max(offset, start, log.bases[-1]), stop)
+            data = log.read(offset, min(stop, offset + limit))
+
+        return {'data': data, 'offset': offset + len(data), 'end': stop, 'done': done and offset + len(data) >= stop}
+
+
+    def _loop(self):
+
+        while True:
+
+            try:
+                events = self.poller.poll(self.timeout)
+
+            except (IOError, OSError, select.error) as e:
+
+                if e.args[0] == errno.EINTR:
+                    continue
+
+                raise
+
+            for fd, event in events:
+
+                with self.lock:
+                    capture = self.captures.get(fd)
+
+                    if capture is None:
+                        continue
+
+                    if not self._read(capture):
+                        self._close(capture)
+
+
+    def _read(self, capture):
+        """
+        appends everything waiting in capture's pipe to its run's log. returns False once the
+        write end is closed. must be called with self.lock held
+        """
+
+        while True:
+
+            try:
+                data = os.read(capture.fd, 65536)
+
+            except OSError as oe:
+
+                if oe.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return True
+
+                if oe.errno == errno.EINTR:
+                    continue
+
+                self.logging.error("Error reading job output: %s", oe)
+                return False
+
+            if not data:
+                return False
+
+            # output of a prefork worker between runs belongs to no job
+            if capture.log is None:
+                continue
+
+            try:
+                capture.log.write(data)
+
+            except (IOError, OSError) as e:
+                self.logging.error("Error writing output of job: '%s' to: %s: %s", os.path.basename(capture.log.path)[:-4],
+                        capture.log.path, e)
+
+
+    def _close(self, capture):
+        """must be called with self.lock held"""
+
+        self._end(capture)
+        del self.captures[capture.fd]
+
+        try:
+            self.poller.unregister(capture.fd)
+
+        except (IOError, OSError, KeyError, ValueError):
+            pass
+
+        os.close(capture.fd)
+
+
+    def _start(self, capture, job_name, run_id):
+
+        log = self._log(job_name)
+        log.active += 1
+        log.runs[run_id] = [log.total, None]
+
+        while len(log.runs) > self.run_records:
+            log.runs.popitem(last=False)
+
+        capture.log = log
+        capture.run_id = run_id
+
+
+    def _end(self, capture):
+
+        log = capture.log
+
+        if log is None:
+            return
+
+        if capture.run_id in log.runs:
+            log.runs[capture.run_id][1] = log.total
+
+        log.active -= 1
+
+        if not log.active:
+            log.close()
+
+        capture.log = capture.run_id = None
+
+
+    def _log(self, job_name):
+
+        log = self.logs.get(job_name)
+
+        if log is None:
+            log = self.logs[job_name] = JobLog(os.path.join(self.directory, job_name + '.log'),
+                    self.max_bytes, self.backups)
+
+        return log
+
+
+class Capture(object):
+    """a captured pipe, and the log of the run whose output it is"""
+
+    def __init__(self, fd):
+
+        self.fd = fd
+        self.log = None
+        self.run_id = None
+
+
+class JobLog(object):
+    """the rotated output files of one job. must only be used with OutputCapture.lock held"""
+
+    def __init__(self, path, max_bytes, backups):
+
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+
+        # offset of the first byte of path, path.1, path.2, ... (newest first), and of the end
+        self.bases = []
+        self.total = 0
+
+        for i in range(self.backups, -1, -1):
+            name = self.filename(i)
+
+            if os.path.exists(name):
+                self.bases.insert(0, self.total)
+                self.total += os.path.getsize(name)
+
+        if not self.bases:
+            self.bases = [0]
+
+        self.size = self.total - self.bases[0]
+        self.fd = None
+        self.active = 0
+
+        # run_id -> [start offset, end offset (None while running)], oldest first
+        self.runs = collections.OrderedDict()
+
+
+    def filename(self, i):
+        return self.path if i == 0 else '%s.%d' % (self.path, i)
+
+
+    def write(self, data):
+
+        if self.size and self.size + len(data) > self.max_bytes:
+            self.rotate()
+
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0640)
+
+        os.write(self.fd, data)
+        self.size += len(data)
+        self.total += len(data)
+
+
+    def rotate(self):
+
+        self.close()
+
+        for i in range(self.backups, 0, -1):
+
+            if os.path.exists(self.filename(i - 1)):
+                os.rename(self.filename(i - 1), self.filename(i))
+
+        self.bases.insert(0, self.total)
+        del self.bases[self.backups + 1:]
+        self.size = 0
+
+        # with no backups, the output that was rotated out is gone
+        if not self.backups and os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+    def read(self, start, end):
+        """bytes from offset start to end, from however many files they're spread over"""
+
+        chunks = []
+
+        for i, base in enumerate(self.bases):
+
+            if start >= end:
+                break
+
+            top = self.total if i == 0 else self.bases[i - 1]
+
+            if base >= end or top <= start:
+                continue
+
+            begin = max(start, base)
+
+            try:
+                with open(self.filename(i), 'rb') as f:
+                    f.seek(begin - base)
+                    chunks.append((begin, f.read(min(end, top) - begin)))
+
+            except IOError:
+                pass
+
+        return ''.join(data for begin, data in sorted(chunks))
+
+
+    def close(self):
+
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
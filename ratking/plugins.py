@@ -0,0 +1,214 @@
+import hashlib
+import imp
+import os
+import sys
+import threading
+import time
+
+
+# the package plugin modules are put under in sys.modules, ratking_plugins.<plugin name>
+PACKAGE = 'ratking_plugins'
+
+
+class PluginLoader(object):
+    """
+    Loads plugin modules from plugin_dir, and keeps the compiled plugins cached.
+
+    compile() only compiles a plugin's source, without running any of it. The daemon calls it
+    before it forks a run, so the child inherits the compiled code and only has to run it
+    (load()), and the counts and timings of compiles and cache hits are kept in the daemon,
+    see stats(). With preload_plugins, the daemon load()s the plugins too, and children
+    inherit the modules.
+
+    A cached plugin is only compiled again when its file's mtime or size changes and the sha1
+    of its source is different too, so touching a plugin doesn't cost a recompile.
+    """
+
+    def __init__(self, config, logging):
+
+        self.config = config
+        self.logging = logging
+
+        self.plugin_dir = self.config.get('main', 'plugin_dir')
+
+        # plugin_name -> Plugin
+        self.cache = {}
+        self.lock = threading.Lock()
+
+
+    def compile(self, plugin_name):
+        """compiles plugin_name ('myplugin.py') if it changed, raises ImportError if it can't be compiled"""
+
+        with self.lock:
+            self._compile(plugin_name)
+
+
+    def load(self, plugin_name):
+        """returns the module for plugin_name ('myplugin.py'), raises ImportError if it can't be loaded"""
+
+        with self.lock:
+            plugin = self._compile(plugin_name)
+
+            if plugin.module is not None and plugin.module_digest == plugin.digest:
+                return plugin.module
+
+            # a private namespace, so a plugin called json.py or time.py can't stand in for that
+            #   module for the rest of the daemon. the package goes in first, so imports in the
+            #   plugin find their parent
+            package = sys.modules.get(PACKAGE)
+
+            if package is None:
+                package = sys.modules[PACKAGE] = imp.new_module(PACKAGE)
+                package.__path__ = []
+
+            name = '%s.%s' % (PACKAGE, plugin_name.split('.')[0])
+
+            module = imp.new_module(name)
+            module.__file__ = plugin.path
+            module.__package__ = PACKAGE
+            sys.modules[name] = module
+
+            try:
+                exec plugin.code in module.__dict__
+
+            except Exception as e:
+                del sys.modules[name]
+                plugin.errors += 1
+                raise ImportError("error loading plugin: '%s': %s" % (plugin.path, e))
+
+            setattr(package, name.split('.', 1)[1], module)
+            plugin.module, plugin.module_digest = module, plugin.digest
+
+            return module
+
+
+    def _compile(self, plugin_name):
+        """returns plugin_name's Plugin, with its code current. must be called with self.lock held"""
+
+        path = os.path.join(self.plugin_dir, plugin_name)
+
+        try:
+            st = os.stat(path)
+
+        except OSError as oe:
+            raise ImportError("plugin does not exist: '%s' (%s)" % (path, oe))
+
+        plugin = self.cache.get(plugin_name)
+
+        if plugin is None:
+            plugin = self.cache[plugin_name] = Plugin(plugin_name, path)
+
+        if plugin.code is not None and (plugin.mtime, plugin.size) == (st.st_mtime, st.st_size):
+            plugin.hits += 1
+            return plugin
+
+        start = time.time()
+
+        try:
+            with open(path, 'rb') as f:
+                source = f.read()
+
+        except IOError as ie:
+            plugin.errors += 1
+            raise ImportError("cannot read plugin: '%s' (%s)" % (path, ie))
+
+        digest = hashlib.sha1(source).hexdigest()
+
+        # only the mtime changed, the plugin is the same
+        if plugin.code is not None and plugin.digest == digest:
+            plugin.mtime, plugin.size = st.st_mtime, st.st_size
+            plugin.hits += 1
+            return plugin
+
+        try:
+            code = compile(source, path, 'exec')
+
+        except Exception as e:
+            plugin.errors += 1
+            raise ImportError("error loading plugin: '%s': %s" % (path, e))
+
+        if plugin.code is None:
+            plugin.loads += 1
+            self.logging.debug("Loaded plugin: %s", plugin_name)
+
+        else:
+            plugin.reloads += 1
+            self.logging.info("Reloaded changed plugin: %s", plugin_name)
+
+        plugin.code = code
+        plugin.mtime, plugin.size, plugin.digest = st.st_mtime, st.st_size, digest
+        plugin.load_time += time.time() - start
+        plugin.last_load = time.time()
+
+        return plugin
+
+
+    def after_fork(self):
+        """
+        call in a freshly forked child. another thread of the daemon may have held the lock
+        at fork time, and it would stay locked forever in the child
+        """
+
+        self.lock = threading.Lock()
+
+
+    def preload(self):
+        """loads every plugin in plugin_dir. returns the number loaded"""
+
+        loaded = 0
+
+        for entry in sorted(os.listdir(self.plugin_dir)):
+
+            if not entry.endswith('.py'):
+                continue
+
+            try:
+                self.load(entry)
+                loaded += 1
+
+            except ImportError as ie:
+                self.logging.error("Preloading plugin failed: %s", ie)
+
+        self.logging.info("Preloaded %d plugins from: %s", loaded, self.plugin_dir)
+
+        return loaded
+
+
+    def stats(self):
+        """returns {plugin_name: {loads, reloads, hits, errors, load_time, last_load}}"""
+
+        with self.lock:
+            return dict( (p.name, p.stats()) for p in self.cache.itervalues() )
+
+
+class Plugin(object):
+    """a cache entry of PluginLoader"""
+
+    def __init__(self, name, path):
+
+        self.name = name
+        self.path = path
+        self.code = None
+        self.module = None
+        self.module_digest = None
+        self.mtime = None
+        self.size = None
+        self.digest = None
+
+        self.loads = 0
+        self.reloads = 0
+        self.hits = 0
+        self.errors = 0
+        self.load_time = 0.0
+        self.last_load = 0.0
+
+    def stats(self):
+
+        return {
+            'loads': self.loads,
+            'reloads': self.reloads,
+            'hits': self.hits,
+            'errors': self.errors,
+            'load_time': self.load_time,
+            'last_load': self.last_load,
+            }
@@ -1,14 +1,116 @@
 #!/usr/bin/env python
 import exceptions
+import inspect
+import os
+import pwd
+import Queue
+import socket
+import SocketServer
+import struct
 import sys
+import threading
+import time
+import xmlrpclib
 from SimpleXMLRPCServer import SimpleXMLRPCServer
 from SimpleXMLRPCServer import SimpleXMLRPCRequestHandler
+from SimpleXMLRPCServer import resolve_dotted_attribute
 from ratking.engine import JobCtl, SchedCtl
+from ratking.util import get_option
+
+
+class ThreadPoolMixIn(SocketServer.ThreadingMixIn):
+    """Handles requests in a fixed pool of threads, instead of a new thread per request."""
+
+    daemon_threads = True
+
+    def start_workers(self, workers):
+
+        self.requests = Queue.Queue()
+
+        for i in range(workers):
+            t = threading.Thread(target=self._worker, name='ratking-rpc-%d' % i)
+            t.daemon = True
+            t.start()
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+    def _worker(self):
+
+        while True:
+            self.process_request_thread(*self.requests.get())
+
+
+class ThreadPoolXMLRPCServer(ThreadPoolMixIn, SimpleXMLRPCServer):
+    pass
+
+
+class TimeoutRequestHandler(SimpleXMLRPCRequestHandler):
+    """Request handler whose socket reads/writes give up after timeout seconds (set in start_instance)."""
+
+    timeout = None
+
+
+# not exposed by the python 2 socket module. value on linux
+SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17)
+
+# the user on the other end of the unix socket, for the request the current thread is handling.
+#   unset for tcp requests
+caller = threading.local()
+
+
+class UnixXMLRPCServer(SimpleXMLRPCServer):
+    """XMLRPC server listening on a unix domain socket at path."""
+
+    address_family = socket.AF_UNIX
+    allow_reuse_address = False
+
+    def __init__(self, path, requestHandler):
+
+        # a socket left behind by a daemon that didn't shut down cleanly
+        if os.path.exists(path):
+            os.remove(path)
+
+        SimpleXMLRPCServer.__init__(self, path, requestHandler=requestHandler, logRequests=False)
+
+        # anyone may connect, requests are authorized on the caller's uid (see PeerCredRequestHandler)
+        os.chmod(path, 0666)
+
+
+class ThreadPoolUnixXMLRPCServer(ThreadPoolMixIn, UnixXMLRPCServer):
+    pass
+
+
+class PeerCredRequestHandler(TimeoutRequestHandler):
+    """Identifies the caller on a unix socket from the kernel (SO_PEERCRED), instead of trusting the client."""
+
+    # TCP_NODELAY doesn't apply to unix sockets
+    disable_nagle_algorithm = False
+
+    def handle(self):
+
+        creds = self.request.getsockopt(socket.SOL_SOCKET, SO_PEERCRED, struct.calcsize('3i'))
+        pid, uid, gid = struct.unpack('3i', creds)
+
+        try:
+            caller.user = pwd.getpwuid(uid).pw_name
+
+        except KeyError:
+            caller.user = str(uid)
+
+        try:
+            TimeoutRequestHandler.handle(self)
+
+        finally:
+            caller.user = None
+
+    def address_string(self):
+        return 'unix'
 
 
 class RpcCtl:
 
-    def __init__(self, sched, config, logging):
+    def __init__(self, sched, config, logging, schedctl=None):
         """Initializes the RpcCtl class. Should only be called from ratkingd daemon."""
 
         self.sched = sched
@@ -16,15 +118,94 @@ class RpcCtl:
         self.logging = logging
 
         # creates a mapping to the scheduling and job control object references from main daemon startup
-        self.rpcreq = JobCtl(self.sched, self.config, self.logging)
-        self.schedreq = SchedCtl(self.sched, self.config, self.logging)
+        #
+        # reuse the daemon's SchedCtl when given, so rpc requests see the same JobCtl (and job index)
+        #   that import_jobs populated
+        if schedctl is None:
+            schedctl = SchedCtl(self.sched, self.config, self.logging)
+
+        self.schedreq = schedctl
+        self.rpcreq = self.schedreq.job_control_instance
+
+        # [xmlrpc] socket adds a local unix socket transport next to tcp
+        self.socket_path = get_option(self.config, 'socket', '', section='xmlrpc')
+
+
+    def _dispatch(self, method, params):
+        """
+        Called by the xmlrpc server for every request. Requests that came in over the unix socket
+        are checked against valid_users here, with the caller's real username, so those clients
+        don't need the separate check_auth round trip.
+
+        Over tcp the username is whatever the client sends, nothing proves it. Methods that act as
+        a user have that username checked against valid_users, and with [xmlrpc] socket set,
+        they're only served on the socket.
+        """
+
+        start = time.time()
+        user = getattr(caller, 'user', None)
+
+        if user is not None:
+            returncode, output = self.check_auth(user)
+
+            if returncode is False:
+                return returncode, output
+
+        # raises for methods that don't exist, those aren't counted, so callers can't add labels.
+        #   no dotted names, as register_instance(self) had it, or callers could walk from here
+        #   to the JobCtl, Supervisor and config, and call anything on them
+        if method.startswith('_'):
+            raise Exception('method "%s" is not supported' % method)
+
+        func = resolve_dotted_attribute(self, method, False)
+
+        if not callable(func):
+            raise Exception('method "%s" is not supported' % method)
+
+        if user is None and 'user' in inspect.getargspec(func).args:
+
+            if self.socket_path:
+                return False, "Method: '%s' is only served on the unix socket: %s" % (method, self.socket_path)
+
+            # args[0] is self
+            index = inspect.getargspec(func).args.index('user') - 1
+
+            if index < len(params):
+                returncode, output = self.check_auth(params[index])
+
+                if returncode is False:
+                    return returncode, output
+
+        try:
+            return func(*params)
+
+        finally:
+            self.rpcreq.metrics.rpc_calls.inc((method,))
+            self.rpcreq.metrics.rpc_latency.observe(time.time() - start, (method,))
+
+
+    def _user(self, user):
+        """the user a request runs as: the unix socket peer if there is one, otherwise what the client sent"""
+
+        peer = getattr(caller, 'user', None)
+
+        if peer is not None:
+            return peer
+
+        return user
 
 
     # statically define all of the JobCtl methods we want access to, versus allowing access to all functions
     #
     # these all interact with the JobCtl/Schedctl objects
     def add_job(self, jobfile, user, realuser):
-        return self.rpcreq.add_job(jobfile, user, realuser)
+        return self.rpcreq.add_job(jobfile, self._user(user), realuser)
+
+    def add_jobs(self, jobfiles, user, realuser):
+        return self.rpcreq.add_jobs(jobfiles, self._user(user), realuser)
+
+    def cancel_run(self, run_id, user, realuser):
+        return self.rpcreq.cancel_run(run_id, self._user(user), realuser)
 
     def check_auth(self, username):
         """Checks if user is allowed to issue xmlrpc queries."""
@@ -40,37 +221,103 @@ class RpcCtl:
         return self.schedreq.check_sched()
 
     def disable_job(self, jobname, user, realuser):
-        return self.rpcreq.disable_job(jobname, user, realuser)
+        return self.rpcreq.disable_job(jobname, self._user(user), realuser)
+
+    def disable_jobs(self, selector, user, realuser):
+        return self.rpcreq.disable_jobs(selector, self._user(user), realuser)
 
     def enable_job(self, jobname, user, realuser):
-        return self.rpcreq.enable_job(jobname, user, realuser)
+        return self.rpcreq.enable_job(jobname, self._user(user), realuser)
+
+    def enable_jobs(self, selector, user, realuser):
+        return self.rpcreq.enable_jobs(selector, self._user(user), realuser)
 
     def force_run_job(self, jobname, user, realuser):
-        return self.rpcreq.force_run_job(jobname, user, realuser)
+        return self.rpcreq.force_run_job(jobname, self._user(user), realuser)
+
+    def forecast(self, query):
+        return self.rpcreq.forecast(query)
+
+    def job_costs(self, query):
+        return self.rpcreq.job_costs(query)
+
+    def job_history(self, query):
+        return self.rpcreq.job_history(query)
+
+    def list_jobs(self, query):
+        return self.rpcreq.list_jobs(query)
+
+    def plugin_stats(self):
+        return True, self.rpcreq.plugins.stats()
 
     def remove_job(self, jobname, user, realuser):
-        return self.rpcreq.remove_job(jobname, user, realuser)
+        return self.rpcreq.remove_job(jobname, self._user(user), realuser)
+
+    def remove_jobs(self, selector, user, realuser):
+        return self.rpcreq.remove_jobs(selector, self._user(user), realuser)
+
+    def running_jobs(self, query=None):
+        return self.rpcreq.running_jobs(dict(query or {}))
 
     def show_jobs(self):
         return self.rpcreq.show_jobs()
 
+    def tail_job_output(self, jobname, run_id, offset, user, realuser):
+        """output is bytes, not necessarily text, it goes out as base64"""
+
+        returncode, output = self.rpcreq.tail_job_output(jobname, run_id, offset, self._user(user), realuser)
+
+        if returncode:
+            output['data'] = xmlrpclib.Binary(output['data'])
+
+        return returncode, output
+
+    def trace_summary(self, query):
+        return self.rpcreq.trace_summary(query)
+
     def start_sched(self, user):
-        return self.schedreq.start_sched(user)
+        return self.schedreq.start_sched(self._user(user))
 
     def stop_sched(self, user):
-        return self.schedreq.stop_sched(user)
+        return self.schedreq.stop_sched(self._user(user))
 
 
     def start_instance(self):
         """Starts an XMLRPC server, and registers its own functions"""
 
+        # [xmlrpc] workers > 1 serves that many requests at a time, so one slow request doesn't
+        #   hold up every other ratctl caller
+        workers = get_option(self.config, 'workers', 8, section='xmlrpc')
+        TimeoutRequestHandler.timeout = get_option(self.config, 'timeout', 30.0, section='xmlrpc')
+
+        socket_path = self.socket_path
+
         try:
-            self.server = SimpleXMLRPCServer((self.config.get('xmlrpc', 'host'), int(self.config.get('xmlrpc', 'port'))))
-            self.server.allow_none=False
-            self.server.logRequests=False
-            self.server.RequestHandlerClass.rpc_paths = self.config.get('xmlrpc', 'url')
-            self.server.register_introspection_functions()
-            self.server.register_instance(self)
+            if socket_path:
+
+                if workers > 1:
+                    self.unix_server = ThreadPoolUnixXMLRPCServer(socket_path, PeerCredRequestHandler)
+                    self.unix_server.start_workers(workers)
+
+                else:
+                    self.unix_server = UnixXMLRPCServer(socket_path, PeerCredRequestHandler)
+
+                self._register(self.unix_server)
+
+                t = threading.Thread(target=self.unix_server.serve_forever, name='ratking-rpc-unix')
+                t.daemon = True
+                t.start()
+
+            address = (self.config.get('xmlrpc', 'host'), int(self.config.get('xmlrpc', 'port')))
+
+            if workers > 1:
+                self.server = ThreadPoolXMLRPCServer(address, requestHandler=TimeoutRequestHandler)
+                self.server.start_workers(workers)
+
+            else:
+                self.server = SimpleXMLRPCServer(address, requestHandler=TimeoutRequestHandler)
+
+            self._register(self.server)
             self.server.serve_forever()
 
             return True, "Successfully started instance."
@@ -78,7 +325,14 @@ class RpcCtl:
         except Exception as e:
             return False, "Error starting instance: %s" % e
 
-        
+
+    def _register(self, server):
+
+        server.allow_none=False
+        server.logRequests=False
+        server.RequestHandlerClass.rpc_paths = self.config.get('xmlrpc', 'url')
+        server.register_introspection_functions()
+        server.register_instance(self)
 
 
     def stop_instance(self):
@@ -0,0 +1,256 @@
+import heapq
+import itertools
+import logging
+import threading
+from apscheduler.job import Job, MaxInstancesReachedError
+from apscheduler.threadpool import ThreadPool
+from apscheduler.triggers import CronTrigger
+from apscheduler.util import asbool, combine_opts, time_difference
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+
+class HeapScheduler(object):
+    """
+    A scheduler for large numbers of jobs, used when scheduler_engine=heap.
+
+    Has the parts of APScheduler's Scheduler API that ratking uses (start, shutdown,
+    running, add_job, add_cron_job, unschedule_job, get_jobs) and takes the same
+    apscheduler.* options, but keeps jobs in a min-heap on their next run time instead
+    of a list that is scanned on every wakeup. Adding and removing a job is O(log n),
+    and a wakeup only touches the jobs that are due.
+
+    All jobs due at a wakeup are popped together, and handed to the thread pool in
+    batches of batch_size jobs per thread pool task.
+
+    Jobs are apscheduler Job objects, so misfire_grace_time, coalesce, max_instances
+    and max_runs work as they do with APScheduler.
+    """
+
+    def __init__(self, gconfig={}, **options):
+
+        config = combine_opts(gconfig, 'apscheduler.', options)
+
+        self.misfire_grace_time = int(config.pop('misfire_grace_time', 1))
+        self.coalesce = asbool(config.pop('coalesce', True))
+        self.daemonic = asbool(config.pop('daemonic', True))
+        self.batch_size = int(config.pop('batch_size', 64))
+
+        self._threadpool = ThreadPool(**combine_opts(config, 'threadpool.'))
+
+        # heap of [next_run_time, seq, job] entries, and job -> its entry. unscheduling a job
+        #   only blanks its entry (job = None), those are skipped when popped, and cleaned out
+        #   once they outnumber the live ones
+        self._heap = []
+        self._entries = {}
+        self._removed = 0
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+        self._wakeup = threading.Event()
+        self._stopped = True
+        self._thread = None
+
+
+    @property
+    def running(self):
+        return not self._stopped and self._thread is not None and self._thread.isAlive()
+
+
+    def start(self):
+
+        if self.running:
+            raise RuntimeError('Scheduler is already running')
+
+        self._stopped = False
+        self._thread = threading.Thread(target=self._main_loop, name='ratking-scheduler')
+        self._thread.setDaemon(self.daemonic)
+        self._thread.start()
+
+
+    def shutdown(self, wait=True, shutdown_threadpool=True):
+
+        if not self.running:
+            return
+
+        self._stopped = True
+        self._wakeup.set()
+
+        if shutdown_threadpool:
+            self._threadpool.shutdown(wait)
+
+        if wait:
+            self._thread.join()
+
+
+    def add_job(self, trigger, func, args, kwargs, jobstore='default', **options):
+        """adds a job that runs func(*args, **kwargs) when trigger fires. returns its Job"""
+
+        job = Job(trigger, func, args or [], kwargs or {},
+                  options.pop('misfire_grace_time', self.misfire_grace_time),
+                  options.pop('coalesce', self.coalesce), **options)
+
+        if not job.compute_next_run_time(datetime.now()):
+            raise ValueError('Not adding job since it would never be run')
+
+        with self._lock:
+            self._push(job)
+
+            # only a job that's due before everything else changes when to wake up
+            wakeup = self._heap[0][2] is job
+
+        if wakeup:
+            self._wakeup.set()
+
+        logger.debug('Added job "%s"', job)
+
+        return job
+
+
+    def add_cron_job(self, func, year=None, month=None, day=None, week=None, day_of_week=None, hour=None,
+                     minute=None, second=None, start_date=None, args=None, kwargs=None, **options):
+
+        trigger = CronTrigger(year=year, month=month, day=day, week=week, day_of_week=day_of_week,
+                              hour=hour, minute=minute, second=second, start_date=start_date)
+
+        return self.add_job(trigger, func, args, kwargs, **options)
+
+
+    def unschedule_job(self, job):
+
+        with self._lock:
+            entry = self._entries.pop(job, None)
+
+            if entry is None:
+                raise KeyError('Job "%s" is not scheduled' % job)
+
+            entry[2] = None
+            self._removed += 1
+
+            if self._removed > 1024 and self._removed > len(self._entries):
+                self._heap = [ e for e in self._heap if e[2] is not None ]
+                heapq.heapify(self._heap)
+                self._removed = 0
+
+        logger.debug('Removed job "%s"', job)
+
+
+    def get_jobs(self):
+        """returns the scheduled jobs, soonest first"""
+
+        with self._lock:
+            return [ entry[2] for entry in sorted(self._entries.itervalues()) ]
+
+
+    def _push(self, job):
+        """must be called with self._lock held"""
+
+        entry = [job.next_run_time, self._seq.next(), job]
+        self._entries[job] = entry
+        heapq.heappush(self._heap, entry)
+
+
+    def _main_loop(self):
+
+        logger.info('Scheduler started')
+
+        while not self._stopped:
+
+            # cleared before looking at the heap, so a job added from here on wakes the loop up
+            self._wakeup.clear()
+
+            now = datetime.now()
+            due = self._pop_due(now)
+
+            for i in xrange(0, len(due), self.batch_size):
+                self._threadpool.submit(self._run_batch, due[i:i + self.batch_size])
+
+            with self._lock:
+                next_wakeup_time = self._heap[0][0] if self._heap else None
+
+            if next_wakeup_time is not None:
+                self._wakeup.wait(time_difference(next_wakeup_time, now))
+
+            else:
+                self._wakeup.wait()
+
+        logger.info('Scheduler has been shut down')
+
+
+    def _pop_due(self, now):
+        """takes every job due by now off the heap, and puts it back at its next run time. returns [(job, run_times)]"""
+
+        due = []
+
+        with self._lock:
+
+            while self._heap and self._heap[0][0] <= now:
+                entry = heapq.heappop(self._heap)
+                job = entry[2]
+
+                if job is None:
+                    self._removed -= 1
+                    continue
+
+                run_times = job.get_run_times(now)
+
+                if run_times:
+                    due.append((job, run_times))
+
+                    if job.coalesce:
+                        job.runs += 1
+
+                    else:
+                        job.runs += len(run_times)
+
+                # jobs that will never run again (max_runs) are dropped
+                if job.compute_next_run_time(now + timedelta(microseconds=1)):
+                    self._push(job)
+
+                else:
+                    del self._entries[job]
+
+        return due
+
+
+    def _run_batch(self, batch):
+
+        for job, run_times in batch:
+
+            try:
+                self._run_job(job, run_times)
+
+            except Exception:
+                logger.exception('Error running job "%s"', job)
+
+
+    def _run_job(self, job, run_times):
+        """runs a job once per run time (once if coalescing), unless the run time was missed"""
+
+        for run_time in run_times:
+            difference = datetime.now() - run_time
+
+            if difference > timedelta(seconds=job.misfire_grace_time):
+                logger.warning('Run time of job "%s" was missed by %s', job, difference)
+                continue
+
+            try:
+                job.add_instance()
+
+            except MaxInstancesReachedError:
+                logger.warning('Execution of job "%s" skipped: maximum number of running instances reached (%d)',
+                               job, job.max_instances)
+                break
+
+            try:
+                job.func(*job.args, **job.kwargs)
+
+            except Exception:
+                logger.exception('Job "%s" raised an exception', job)
+
+            finally:
+                job.remove_instance()
+
+            if job.coalesce:
+                break
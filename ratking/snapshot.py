@@ -0,0 +1,120 @@
+import cPickle
+import os
+import threading
+import time
+from util import get_option
+
+
+class JobSnapshot(threading.Thread):
+    """
+    Keeps a snapshot of the validated job table in snapshot_file, so a restart doesn't
+    have to parse and validate every jobfile again.
+
+    The snapshot holds JobCtl's parse cache (jobfile -> mtime, size and parse result), the
+    jobfiles that were added successfully, and the runtime status (Enabled/Disabled) of
+    every job. import_jobs() loads it, and only parses and validates the jobfiles whose
+    mtime or size changed. Jobs from unchanged jobfiles get their saved status back.
+
+    Run as a thread, it writes the snapshot every snapshot_interval seconds, when
+    something changed since the last write, and once more when it's stopped.
+    """
+
+    version = 1
+
+    def __init__(self, jobctl, config, logging):
+
+        threading.Thread.__init__(self, name='ratking-snapshot')
+        self.daemon = True
+
+        self.jobctl = jobctl
+        self.config = config
+        self.logging = logging
+
+        self.path = self.config.get('main', 'snapshot_file')
+        self.interval = get_option(self.config, 'snapshot_interval', 30.0)
+
+        self.saved = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+
+    def load(self):
+        """returns the saved snapshot as a dict, or None if there isn't a usable one"""
+
+        try:
+            with open(self.path, 'rb') as f:
+                snapshot = cPickle.load(f)
+
+        except IOError:
+            return None
+
+        except Exception as e:
+            self.logging.warning("Ignoring unreadable job snapshot: %s (%s)", self.path, e)
+            return None
+
+        if not isinstance(snapshot, dict) or snapshot.get('version') != self.version:
+            self.logging.warning("Ignoring job snapshot of an unknown version: %s", self.path)
+            return None
+
+        return snapshot
+
+
+    def save(self):
+        """writes the current job table, if it changed since the last save. returns True if it wrote it"""
+
+        jobctl = self.jobctl
+
+        with jobctl.job_lock:
+            state = {
+                'jobfiles': dict(jobctl.parse_cache),
+                'added': set( job.jobfile for job in jobctl.job_index.itervalues() ),
+                'status': dict( (name, job.status) for name, job in jobctl.job_index.iteritems() ),
+                }
+
+        with self.lock:
+
+            if state == self.saved:
+                return False
+
+            snapshot = dict(state, version=self.version, time=time.time())
+            tmp = '%s.%d.tmp' % (self.path, os.getpid())
+
+            try:
+                with open(tmp, 'wb') as f:
+                    cPickle.dump(snapshot, f, cPickle.HIGHEST_PROTOCOL)
+
+                # never leave a half written snapshot behind
+                os.rename(tmp, self.path)
+
+            except (IOError, OSError, cPickle.PicklingError) as e:
+                self.logging.error("Writing job snapshot failed: %s (%s)", self.path, e)
+                return False
+
+            self.saved = state
+
+        self.logging.debug("Wrote job snapshot of %d jobs: %s", len(state['status']), self.path)
+
+        return True
+
+
+    def run(self):
+
+        while not self.stopped.wait(self.interval):
+
+            try:
+                self.save()
+
+            except Exception as e:
+                self.logging.exception("Job snapshot error: %s", e)
+
+
+    def stop(self):
+        """stops the thread, and writes the changes since its last write. called when the daemon shuts down"""
+
+        self.stopped.set()
+
+        try:
+            self.save()
+
+        except Exception as e:
+            self.logging.exception("Job snapshot error: %s", e)
@@ -0,0 +1,512 @@
+import errno
+import fcntl
+import itertools
+import json
+import os
+import signal
+import sys
+import threading
+import time
+import tracing
+from util import get_option
+from workerpool import WorkerPool
+
+
+class Supervisor(object):
+    """
+    Starts job runs without waiting for them, and reaps them from a dedicated thread.
+
+    dispatch() forks the job (or hands it to the prefork WorkerPool) and returns a run id
+    right away, so APScheduler's thread pool threads only ever do scheduling. The reaper
+    thread collects exit status, duration and rusage of every run with a non-blocking
+    wait4 loop every reaper_interval seconds. max_instances is enforced here, against
+    the table of running jobs, since a dispatched run no longer holds its job instance.
+
+    The reaper also ends runs that go past their job's timeout, or that were cancelled:
+    SIGTERM to the run's process group, then SIGKILL kill_grace seconds later.
+    """
+
+    def __init__(self, jobctl, config, logging):
+
+        self.jobctl = jobctl
+        self.config = config
+        self.logging = logging
+
+        self.interval = get_option(self.config, 'reaper_interval', 0.2)
+
+        # seconds between SIGTERM and SIGKILL when a run is timed out or cancelled
+        self.kill_grace = get_option(self.config, 'kill_grace', 10.0)
+
+        # with preloaded plugins, the daemon keeps its plugin cache current before each fork,
+        #   so forked children and prefork workers start with the plugin already imported
+        self.preload_plugins = get_option(self.config, 'preload_plugins', False)
+
+        # pipes are made and their write ends closed again under this lock, so no other run is
+        #   forked in between, holding on to a write end and keeping the output pipe from closing
+        self.fork_lock = threading.Lock()
+
+        # run_id -> Run for every run that hasn't been reaped yet, and job_name -> number of them
+        self.runs = {}
+        self.instances = {}
+        self.lock = threading.Lock()
+        self.run_ids = itertools.count(1)
+
+        # callables, called with each Run once it has finished
+        self.listeners = []
+
+        # exec_mode=prefork runs jobs in per-owner pools of long-lived workers, instead of
+        #   forking a new process for every run
+        if get_option(self.config, 'exec_mode', 'fork') == 'prefork':
+            self.worker_pool = WorkerPool(self.jobctl, self.config, self.logging, self.finish)
+
+        else:
+            self.worker_pool = None
+
+        self.reaper = None
+
+
+    def dispatch(self, kwargs, max_instances=1, scheduled=None, fired=None, job_type=''):
+        """
+        starts a run of a job. returns its run id, or None if max_instances runs are already going.
+
+        scheduled is the time (epoch) the run was due, None for runs that weren't scheduled (force runs).
+        fired is the time the scheduler called run_job for it
+        """
+
+        job_name = kwargs['job_name']
+
+        with self.lock:
+
+            if self.instances.get(job_name, 0) >= max_instances:
+                self.logging.warning("Execution of job '%s' skipped: maximum number of running instances reached (%d)",
+                        job_name, max_instances)
+                return None
+
+            run = Run(self.run_ids.next(), kwargs, scheduled, job_type)
+
+            if scheduled is not None:
+                run.marks['scheduled'] = scheduled
+
+            if fired is not None:
+                run.marks['fired'] = fired
+
+            # the job may have been removed since it was scheduled
+            job = self.jobctl.job_index.get(job_name)
+
+            # the deadline is set once the run starts: now if it's forked, when a worker takes it if it's queued
+            run.timeout = getattr(job, 'timeout', 0) or None
+
+            self.runs[run.run_id] = run
+            self.instances[job_name] = self.instances.get(job_name, 0) + 1
+
+            if self.reaper is None:
+                self.reaper = threading.Thread(target=self._reap, name='ratking-reaper')
+                self.reaper.daemon = True
+                self.reaper.start()
+
+        # resource limits can't be taken back off a long-lived worker, so jobs with any get their own process
+        if self.worker_pool is not None and not getattr(job, 'limits', None):
+
+            # the plugin cache counts are the daemon's, and workers started from here on get the code
+            try:
+                self.jobctl.plugins.compile(run.kwargs['plugin_name'])
+
+            except ImportError as ie:
+                self.finish(run, 'failed', None, "plugin error: %s" % ie)
+                return run.run_id
+
+            self.worker_pool.submit(run)
+
+        else:
+
+            if run.timeout:
+                run.deadline = run.start + run.timeout
+
+            self._fork(run)
+
+        return run.run_id
+
+
+    def cancel(self, run_id, reason='cancelled'):
+        """
+        ends a run: SIGTERM now, SIGKILL after kill_grace seconds if it's still going. its status
+        will be reason. returns False if there's no such run, or it hasn't started yet
+        """
+
+        with self.lock:
+            run = self.runs.get(run_id)
+
+            if run is None or run.pid is None or run.kill_reason is not None:
+                return False
+
+            run.kill_reason = reason
+            run.term_sent = time.time()
+
+        self.logging.warning("Job: '%s' run %d %s, sending SIGTERM to pid %s.", run.job_name, run.run_id,
+                'timed out' if reason == 'timeout' else reason, run.pid)
+        self._signal(run, signal.SIGTERM)
+
+        return True
+
+
+    # columns of a running() record
+    running_fields = ['run_id', 'job_name', 'owner', 'pid', 'start', 'elapsed', 'rss', 'state']
+
+    def running(self):
+        """
+        returns a record (see running_fields) per run that hasn't been reaped yet, oldest first.
+        rss is the run's current resident memory in KB, '' if it isn't known. state is 'starting'
+        until the run has a pid, 'running', or 'timeout'/'cancelled' while it's being killed
+        """
+
+        now = time.time()
+
+        with self.lock:
+            runs = sorted(self.runs.values(), key=lambda run: run.run_id)
+
+        records = []
+
+        for run in runs:
+
+            if run.pid is None:
+                state = 'starting'
+
+            else:
+                state = run.kill_reason or 'running'
+
+            records.append([ run.run_id, run.job_name, run.owner, run.pid or '', run.start, now - run.start,
+                             resident_kb(run.pid), state ])
+
+        return records
+
+
+    def finish(self, run, status, exitcode, output=None, rusage=None):
+        """records the end of a run, and tells the listeners about it"""
+
+        # a timed out or cancelled run ends however the signal made it end
+        if run.kill_reason is not None:
+            status = run.kill_reason
+
+        run.end = run.marks['reaped'] = time.time()
+        run.duration = run.end - run.start
+        run.status = status
+        run.exitcode = exitcode
+        run.output = output
+        run.rusage = rusage or {}
+
+        with self.lock:
+            del self.runs[run.run_id]
+            self.instances[run.job_name] -= 1
+
+            if self.instances[run.job_name] == 0:
+                del self.instances[run.job_name]
+
+        if status == 'success':
+            self.logging.info("Job: '%s' run %d finished in %.2fs.", run.job_name, run.run_id, run.duration)
+
+        else:
+            self.logging.error("Job: '%s' run %d %s (exit code: %s) after %.2fs: %s",
+                    run.job_name, run.run_id, status, exitcode, run.duration, output or '')
+
+        for listener in self.listeners:
+
+            try:
+                listener(run)
+
+            except Exception as e:
+                self.logging.exception("Error notifying run listener: %s", e)
+
+
+    def _fork(self, run):
+
+        # compiled here, so the child inherits the code (or with preload_plugins, the module), and
+        #   the plugin cache counts are the daemon's
+        try:
+
+            if self.preload_plugins:
+                self.jobctl.plugins.load(run.kwargs['plugin_name'])
+
+            else:
+                self.jobctl.plugins.compile(run.kwargs['plugin_name'])
+
+        except ImportError as ie:
+            self.finish(run, 'failed', None, "plugin error: %s" % ie)
+            return
+
+        # the child sends its lifecycle marks back on a pipe, read once it's reaped
+        if self.jobctl.tracer is not None:
+            trace_r, trace_w = os.pipe()
+
+        else:
+            trace_r = trace_w = None
+
+        run.marks['handoff'] = time.time()
+
+        with self.fork_lock:
+
+            # with output_dir, the child's stdout and stderr go to a pipe, read by OutputCapture
+            if self.jobctl.output is not None:
+                output_r, output_w = self.jobctl.output.pipe()
+
+            else:
+                output_r = output_w = None
+
+            try:
+                pid = os.fork()
+
+            except OSError as oe:
+
+                for fd in (trace_r, trace_w, output_r, output_w):
+
+                    if fd is not None:
+                        os.close(fd)
+
+                self.finish(run, 'failed', None, "fork failed: %s" % oe)
+                return
+
+            if pid != 0 and output_w is not None:
+                os.close(output_w)
+
+        if pid == 0:
+            exitcode = 0
+
+            # its own process group, so a timeout or cancel also gets anything the job started
+            os.setpgid(0, 0)
+
+            tracing.reset()
+            tracing.mark('child_start')
+
+            if output_w is not None:
+                os.dup2(output_w, 1)
+                os.dup2(output_w, 2)
+                os.close(output_w)
+                os.close(output_r)
+
+            self.jobctl.plugins.after_fork()
+
+            try:
+                self.jobctl._run_job_exec(**run.kwargs)
+
+            # like the interpreter: sys.exit() is success, and a message is printed and exits 1
+            except SystemExit as e:
+
+                if e.code is None:
+                    exitcode = 0
+
+                elif isinstance(e.code, int):
+                    exitcode = e.code
+
+                else:
+                    self.logging.error("Job: '%s' exited: %s", run.job_name, e.code)
+                    exitcode = 1
+
+            except:
+                self.logging.exception("Job: '%s' did not execute successfully", run.job_name)
+                exitcode = 1
+
+            finally:
+
+                if trace_w is not None:
+
+                    # well under PIPE_BUF, so the write is atomic and can't block
+                    try:
+                        os.write(trace_w, json.dumps(tracing.marks))
+
+                    except (OSError, ValueError):
+                        pass
+
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(exitcode)
+
+        if output_r is not None:
+            self.jobctl.output.add(output_r, run.job_name, run.run_id)
+
+        if trace_r is not None:
+            os.close(trace_w)
+            fcntl.fcntl(trace_r, fcntl.F_SETFL, fcntl.fcntl(trace_r, fcntl.F_GETFL) | os.O_NONBLOCK)
+            run.trace_fd = trace_r
+
+        # in the parent too, so the group exists before killpg could be called on it
+        try:
+            os.setpgid(pid, pid)
+
+        except OSError:
+            pass
+
+        run.pid = pid
+        run.forked = True
+
+
+    def _reap(self):
+        """reaper thread main loop"""
+
+        while True:
+
+            try:
+                # prefork runs are collected by the pool, whose poll doubles as the reaper's sleep.
+                #   jobs with resource limits are forked in prefork mode too
+                if self.worker_pool is not None:
+                    self.worker_pool.poll(self.interval)
+
+                else:
+                    time.sleep(self.interval)
+
+                self._reap_forked()
+                self._check_timeouts()
+
+            except Exception as e:
+                self.logging.exception("Reaper error: %s", e)
+
+
+    def _reap_forked(self):
+
+        with self.lock:
+            forked = [ run for run in self.runs.itervalues() if run.forked ]
+
+        for run in forked:
+
+            try:
+                pid, status, rusage = os.wait4(run.pid, os.WNOHANG)
+
+            except OSError as oe:
+
+                if oe.errno == errno.EINTR:
+                    continue
+
+                if run.trace_fd is not None:
+                    os.close(run.trace_fd)
+
+                self.finish(run, 'lost', None, "wait4 failed: %s" % oe)
+                continue
+
+            if pid == 0:
+                continue
+
+            if run.trace_fd is not None:
+                self._read_marks(run)
+
+            if os.WIFSIGNALED(status):
+                self.finish(run, 'killed', -os.WTERMSIG(status), "killed by signal %d" % os.WTERMSIG(status),
+                        rusage_dict(rusage))
+
+            else:
+                exitcode = os.WEXITSTATUS(status)
+                self.finish(run, 'success' if exitcode == 0 else 'failed', exitcode, None, rusage_dict(rusage))
+
+
+    def _check_timeouts(self):
+        """times out runs past their deadline, and SIGKILLs runs kill_grace seconds after their SIGTERM"""
+
+        now = time.time()
+
+        with self.lock:
+            overdue = [ run for run in self.runs.itervalues() if run.pid is not None
+                            and ((run.deadline is not None and run.kill_reason is None and now > run.deadline)
+                                or (run.term_sent is not None and not run.kill_sent and now > run.term_sent + self.kill_grace)) ]
+
+        for run in overdue:
+
+            if run.kill_reason is None:
+                self.cancel(run.run_id, 'timeout')
+
+            else:
+                self.logging.warning("Job: '%s' run %d still running %.0fs after SIGTERM, sending SIGKILL.",
+                        run.job_name, run.run_id, self.kill_grace)
+                run.kill_sent = True
+                self._signal(run, signal.SIGKILL)
+
+
+    def _signal(self, run, signum):
+        """
+        signals the process group of a run: a forked run's own, or that of the prefork worker running
+        it, which the pool replaces once it's gone
+        """
+
+        try:
+            os.killpg(run.pid, signum)
+
+        except OSError as oe:
+
+            if oe.errno != errno.ESRCH:
+                self.logging.error("Could not signal job: '%s' run %d (pid %s): %s", run.job_name, run.run_id,
+                        run.pid, oe)
+
+
+    def _read_marks(self, run):
+        """adds the marks a reaped child sent on its trace pipe to the run"""
+
+        try:
+            data = os.read(run.trace_fd, 65536)
+
+        except OSError:
+            data = ''
+
+        finally:
+            os.close(run.trace_fd)
+            run.trace_fd = None
+
+        if data:
+            run.marks.update(json.loads(data))
+
+
+class Run(object):
+    """one run of a job, from dispatch until it's reaped"""
+
+    def __init__(self, run_id, kwargs, scheduled=None, job_type=''):
+
+        self.run_id = run_id
+        self.kwargs = kwargs
+        self.job_name = kwargs['job_name']
+        self.owner = kwargs['owner']
+        self.job_type = job_type
+        self.scheduled = scheduled
+        self.start = time.time()
+        self.end = None
+        self.duration = None
+        self.pid = None
+        self.forked = False
+
+        # timeout: the job's timeout in seconds, deadline: epoch the run times out at, once it has
+        #   started. kill_reason is set ('timeout', 'cancelled') once it's being killed, and becomes its status
+        self.timeout = None
+        self.deadline = None
+        self.kill_reason = None
+        self.term_sent = None
+        self.kill_sent = False
+        self.status = 'running'
+        self.exitcode = None
+        self.output = None
+        self.rusage = {}
+
+        # lifecycle phase -> time, see tracing.PHASES
+        self.marks = {'dispatched': self.start}
+        self.trace_fd = None
+
+
+PAGE_KB = os.sysconf('SC_PAGE_SIZE') / 1024
+
+def resident_kb(pid):
+    """current resident memory of pid in KB, from /proc/<pid>/statm. '' if it can't be read"""
+
+    if pid is None:
+        return ''
+
+    try:
+        with open('/proc/%d/statm' % pid) as statm:
+            return int(statm.read().split()[1]) * PAGE_KB
+
+    except (IOError, IndexError, ValueError):
+        return ''
+
+
+def rusage_dict(rusage):
+    """the interesting fields of a resource.struct_rusage, as a dict"""
+
+    return {
+        'utime': rusage.ru_utime,
+        'stime': rusage.ru_stime,
+        'maxrss': rusage.ru_maxrss,
+        'inblock': rusage.ru_inblock,
+        'oublock': rusage.ru_oublock,
+        }
@@ -0,0 +1,212 @@
+import collections
+import json
+import os
+import threading
+import time
+from util import get_option
+
+
+# the lifecycle of a run, in order. each mark is the time a run reached that phase, and the
+#   span ending at a mark is named after the stage the run was in until then
+#
+#   scheduled           - the time the run was due (scheduled runs only)
+#   fired               - apscheduler's thread pool calls run_job: scheduler wakeup and thread pool queueing
+#   dispatched          - the Supervisor has a Run for it
+#   handoff             - about to fork, or handed to a prefork worker: parent side plugin preload, pool queueing
+#   child_start         - first thing in the child/worker: fork, or the worker picking the run up
+#   plugin_loaded       - plugin import (or plugin cache hit)
+#   privileges_dropped  - setuid/setgid to the job owner (not per run in a prefork worker)
+#   main_start          - anything between the above and lib.main
+#   main_end            - lib.main
+#   reaped              - process exit, and the reaper noticing it
+PHASES = [
+    ('scheduled', None),
+    ('fired', 'scheduler'),
+    ('dispatched', 'dispatch'),
+    ('handoff', 'queue'),
+    ('child_start', 'fork'),
+    ('plugin_loaded', 'plugin_load'),
+    ('privileges_dropped', 'privilege_drop'),
+    ('main_start', 'setup'),
+    ('main_end', 'main'),
+    ('reaped', 'reap'),
+    ]
+
+SPANS = [ span for phase, span in PHASES if span is not None ]
+
+# marks taken in a job's own process (a forked child, or a prefork worker for its current
+#   run), as [(phase, time)]. sent back to the daemon when the run ends
+marks = []
+
+
+def mark(phase):
+    marks.append((phase, time.time()))
+
+
+def reset():
+    del marks[:]
+
+
+class Tracer(object):
+    """
+    Turns the lifecycle marks of finished runs into spans, keeps per job and overall
+    summaries of them, and with trace_file set, appends them there as JSON lines, one
+    span per line, in the shape of OTLP spans (trace id, span id, parent, times in ns).
+    """
+
+    # durations per span kept for the overall percentiles
+    window = 1000
+
+    def __init__(self, config, logging):
+
+        self.config = config
+        self.logging = logging
+
+        # job_name -> span -> [count, total, max]
+        self.jobs = {}
+
+        # span -> recent durations, of all jobs
+        self.recent = dict( (span, collections.deque(maxlen=self.window)) for span in SPANS )
+
+        self.lock = threading.Lock()
+
+        path = get_option(self.config, 'trace_file', '')
+
+        if path:
+            self.out = open(path, 'a')
+
+        else:
+            self.out = None
+
+        self.last_flush = time.time()
+
+
+    def record(self, run):
+        """Supervisor listener"""
+
+        spans = spans_of(run.marks)
+
+        with self.lock:
+            job = self.jobs.setdefault(run.job_name, {})
+
+            for span, start, end in spans:
+                duration = end - start
+                stats = job.get(span)
+
+                if stats is None:
+                    job[span] = [1, duration, duration]
+
+                else:
+                    stats[0] += 1
+                    stats[1] += duration
+                    stats[2] = max(stats[2], duration)
+
+                self.recent[span].append(duration)
+
+            if self.out is not None:
+                self._export(run, spans)
+
+
+    def summary(self, job_name=None, limit=20):
+        """
+        returns {'spans': SPANS, 'overall': {span: {count, mean, p50, p95, max}}, 'jobs': {job: {span: {count, mean, max}}}}
+
+        jobs has job_name, or else the limit jobs that spend the most time outside of main
+        """
+
+        with self.lock:
+            overall = {}
+
+            for span, durations in self.recent.iteritems():
+
+                if durations:
+                    values = sorted(durations)
+                    overall[span] = {
+                        'count': len(values),
+                        'mean': sum(values) / len(values),
+                        'p50': values[len(values) / 2],
+                        'p95': values[min(int(len(values) * 0.95), len(values) - 1)],
+                        'max': values[-1],
+                        }
+
+            if job_name:
+                names = [ job_name ] if job_name in self.jobs else []
+
+            else:
+                names = sorted(self.jobs, key=lambda name: overhead(self.jobs[name]), reverse=True)[:limit]
+
+            jobs = {}
+
+            for name in names:
+                jobs[name] = dict( (span, {'count': count, 'mean': total / count, 'max': longest})
+                                    for span, (count, total, longest) in self.jobs[name].iteritems() )
+
+        return {'spans': SPANS, 'overall': overall, 'jobs': jobs}
+
+
+    def _export(self, run, spans):
+        """writes the spans of a run to trace_file. called with self.lock held"""
+
+        if not spans:
+            return
+
+        trace_id = os.urandom(16).encode('hex')
+        root_id = os.urandom(8).encode('hex')
+        attributes = {'job.name': run.job_name, 'job.owner': run.owner, 'run.id': run.run_id,
+                      'run.status': run.status, 'run.exitcode': run.exitcode}
+
+        lines = [ span_json(trace_id, root_id, '', 'run', spans[0][1], spans[-1][2], attributes) ]
+
+        for span, start, end in spans:
+            lines.append(span_json(trace_id, os.urandom(8).encode('hex'), root_id, span, start, end,
+                                   {'job.name': run.job_name, 'run.id': run.run_id}))
+
+        try:
+            self.out.write(''.join(lines))
+
+            # a busy daemon writes traces all the time, flushing once a second keeps that cheap
+            if time.time() - self.last_flush > 1:
+                self.out.flush()
+                self.last_flush = time.time()
+
+        except IOError as ie:
+            self.logging.error("Writing trace file failed: %s", ie)
+
+
+def spans_of(run_marks):
+    """[(span, start, end)] from a run's {phase: time}. a missing mark merges its span into the next one"""
+
+    spans = []
+    previous = None
+
+    for phase, span in PHASES:
+        t = run_marks.get(phase)
+
+        if t is None:
+            continue
+
+        if previous is not None:
+            spans.append((span, previous, max(t, previous)))
+
+        previous = t
+
+    return spans
+
+
+def overhead(job):
+    """mean seconds per run a job spends outside of lib.main"""
+
+    return sum(total / count for span, (count, total, longest) in job.iteritems() if span != 'main')
+
+
+def span_json(trace_id, span_id, parent_id, name, start, end, attributes):
+
+    return json.dumps({
+        'trace_id': trace_id,
+        'span_id': span_id,
+        'parent_span_id': parent_id,
+        'name': name,
+        'start_time_unix_nano': int(start * 1e9),
+        'end_time_unix_nano': int(end * 1e9),
+        'attributes': attributes,
+        }, sort_keys=True) + '\n'
@@ -0,0 +1,21 @@
+def get_option(config, option, default, section='main'):
+    """
+    Returns an optional setting from the ratkingd config file, or default if it isn't set.
+
+    The value is converted to the type of default (bool, int, float or str), so the
+    default doubles as the option's type.
+    """
+
+    if not config.has_option(section, option):
+        return default
+
+    if isinstance(default, bool):
+        return config.getboolean(section, option)
+
+    elif isinstance(default, int):
+        return config.getint(section, option)
+
+    elif isinstance(default, float):
+        return config.getfloat(section, option)
+
+    return config.get(section, option)
@@ -0,0 +1,170 @@
+import os
+import threading
+import time
+from util import get_option
+
+# pyinotify is optional, without it the watcher falls back to polling job_dir
+try:
+    import pyinotify
+
+except ImportError:
+    pyinotify = None
+
+
+class JobDirWatcher(threading.Thread):
+    """
+    Watches job_dir and adds, updates or removes only the jobs whose jobfile changed.
+
+    Uses inotify (through pyinotify) when available, otherwise polls job_dir every
+    watch_poll_interval seconds. Changes are collected until job_dir has been quiet
+    for watch_debounce seconds, then applied as one batch through JobCtl.reload_jobfile.
+    """
+
+    def __init__(self, jobctl, config, logging):
+
+        threading.Thread.__init__(self, name='ratking-jobdir-watcher')
+        self.daemon = True
+
+        self.jobctl = jobctl
+        self.config = config
+        self.logging = logging
+
+        self.job_dir = self.config.get('main', 'job_dir')
+        self.debounce = get_option(self.config, 'watch_debounce', 1.0)
+        self.poll_interval = get_option(self.config, 'watch_poll_interval', 5.0)
+        self.use_inotify = pyinotify is not None and not get_option(self.config, 'watch_polling', False)
+
+        self.pending = set()
+        self.last_event = 0.0
+        self.stopped = threading.Event()
+
+
+    def run(self):
+
+        self.logging.info("Watching job_dir: '%s' for changes (%s).", self.job_dir,
+                'inotify' if self.use_inotify else 'polling every %ss' % self.poll_interval)
+
+        try:
+            if self.use_inotify:
+                self._watch_inotify()
+
+            else:
+                self._watch_polling()
+
+        except Exception as e:
+            self.logging.exception("Job_dir watcher died: %s", e)
+
+
+    def stop(self):
+        self.stopped.set()
+
+
+    def flush(self):
+        """applies all pending jobfile changes as one batch"""
+
+        batch = sorted(self.pending)
+        self.pending.clear()
+
+        if not batch:
+            return
+
+        self.logging.info("Job_dir watcher: applying %d changed jobfile(s).", len(batch))
+
+        for path in batch:
+
+            try:
+                returncode, output = self.jobctl.reload_jobfile(path)
+
+            except Exception as e:
+                returncode, output = False, e
+
+            if returncode is False:
+                self.logging.error("Job_dir watcher: '%s': %s", path, output)
+
+            else:
+                self.logging.debug("Job_dir watcher: '%s': %s", path, output)
+
+
+    def _add_pending(self, path):
+
+        if path.endswith('.conf') and os.path.normpath(os.path.dirname(path)) == os.path.normpath(self.job_dir):
+            self.pending.add(path)
+            self.last_event = time.time()
+
+
+    def _watch_inotify(self):
+
+        watcher = self
+
+        class Handler(pyinotify.ProcessEvent):
+
+            def process_default(self, event):
+
+                # the kernel dropped events, so we can't tell what changed. rescan everything
+                if event.mask & pyinotify.IN_Q_OVERFLOW:
+                    watcher.pending.update(watcher._scan().keys())
+                    watcher.pending.update(watcher.jobctl.parse_cache.keys())
+                    watcher.last_event = time.time()
+
+                else:
+                    watcher._add_pending(event.pathname)
+
+        mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM | pyinotify.IN_DELETE
+
+        wm = pyinotify.WatchManager()
+        notifier = pyinotify.Notifier(wm, Handler())
+        wm.add_watch(self.job_dir, mask)
+
+        try:
+            while not self.stopped.is_set():
+
+                # wake up at least once a second to notice stop(), and to flush a quiet batch
+                if notifier.check_events(1000):
+                    notifier.read_events()
+                    notifier.process_events()
+
+                if self.pending and time.time() - self.last_event >= self.debounce:
+                    self.flush()
+
+        finally:
+            notifier.stop()
+
+
+    def _watch_polling(self):
+
+        seen = self._scan()
+
+        while not self.stopped.wait(self.poll_interval):
+
+            current = self._scan()
+
+            for path in set(seen) | set(current):
+
+                if seen.get(path) != current.get(path):
+                    self._add_pending(path)
+
+            seen = current
+            self.flush()
+
+
+    def _scan(self):
+        """returns {path: (mtime, size)} for every jobfile in job_dir"""
+
+        jobfiles = {}
+
+        for entry in os.listdir(self.job_dir):
+
+            if not entry.endswith('.conf'):
+                continue
+
+            path = os.path.join(self.job_dir, entry)
+
+            try:
+                st = os.stat(path)
+
+            except OSError:
+                continue
+
+            jobfiles[path] = (st.st_mtime, st.st_size)
+
+        return jobfiles
@@ -0,0 +1,374 @@
+import collections
+import errno
+import multiprocessing
+import os
+import resource
+import select
+import sys
+import threading
+import time
+import traceback
+import tracing
+from util import get_option
+
+
+class WorkerPool(object):
+    """
+    Per-owner pools of long-lived job workers, used when exec_mode=prefork.
+
+    Each worker drops privileges to its owner once, when it starts, and keeps plugin
+    modules imported between runs. Jobs are only ever handed to a worker of the job's
+    owner. A worker is recycled after pool_max_jobs runs, once its max RSS passes
+    pool_max_rss (KB), or as soon as a job in it raises or exits, so a failed run
+    can't leak into the next one.
+
+    submit() never blocks: runs wait in a per-owner queue until a worker is free.
+    poll() is called from the Supervisor's reaper thread, collects the results of
+    finished runs and passes them to on_finish.
+    """
+
+    def __init__(self, jobctl, config, logging, on_finish):
+
+        self.jobctl = jobctl
+        self.config = config
+        self.logging = logging
+        self.on_finish = on_finish
+
+        self.size = get_option(self.config, 'pool_size', 4)
+        self.max_jobs = get_option(self.config, 'pool_max_jobs', 500)
+        self.max_rss = get_option(self.config, 'pool_max_rss', 262144)
+
+        # owner -> idle workers, owner -> number of live workers (idle or busy),
+        #   owner -> runs waiting for a worker, and pipe fd -> (worker, run) for busy workers
+        self.idle = {}
+        self.count = {}
+        self.pending = {}
+        self.busy = {}
+        self.lock = threading.Lock()
+
+
+    def submit(self, run):
+        """queues a run for one of its owner's workers, and starts it if a worker is free"""
+
+        with self.lock:
+            self.pending.setdefault(run.owner, collections.deque()).append(run)
+            failed = self._assign(run.owner)
+
+        self._report_failed(failed)
+
+
+    def poll(self, timeout):
+        """waits up to timeout seconds for busy workers to finish, and collects their results"""
+
+        with self.lock:
+            conns = [ worker.conn for worker, run in self.busy.itervalues() ]
+
+        if not conns:
+            time.sleep(timeout)
+            return
+
+        try:
+            ready = select.select(conns, [], [], timeout)[0]
+
+        except select.error as e:
+
+            if e.args[0] == errno.EINTR:
+                return
+
+            raise
+
+        for conn in ready:
+
+            with self.lock:
+                worker, run = self.busy.pop(conn.fileno())
+
+            try:
+                returncode, output, recycle, rusage, marks = conn.recv()
+                run.marks.update(marks)
+
+            except (EOFError, IOError, OSError) as e:
+                worker.process.join(1)
+                returncode, output, recycle, rusage = False, "Worker pid %s for owner '%s' died: %s" \
+                        % (worker.process.pid, run.owner, e or worker.process.exitcode), True, {}
+
+            # the worker flushed its output before it sent the result, so it's all in the pipe
+            if worker.output_fd is not None:
+                self.jobctl.output.stop(worker.output_fd)
+
+            if recycle:
+                self._stop_worker(worker)
+
+            with self.lock:
+
+                if recycle:
+                    self.count[run.owner] -= 1
+
+                else:
+                    self.idle[run.owner].append(worker)
+
+                failed = self._assign(run.owner)
+
+            self.on_finish(run, 'success' if returncode else 'failed', 0 if returncode else 1,
+                    None if returncode else output, rusage)
+
+            self._report_failed(failed)
+
+
+    def shutdown(self):
+        """stops all idle workers"""
+
+        with self.lock:
+
+            for owner, workers in self.idle.items():
+
+                for worker in workers:
+                    self._stop_worker(worker)
+                    self.count[owner] -= 1
+
+                del workers[:]
+
+
+    def _assign(self, owner):
+        """
+        hands queued runs of owner to free workers. must be called with self.lock held.
+
+        returns a list of (run, error) for runs that couldn't be started
+        """
+
+        pending = self.pending.get(owner)
+        failed = []
+
+        while pending:
+
+            try:
+                worker = self._checkout(owner)
+
+            except OSError as e:
+                failed.append((pending.popleft(), "could not start a prefork worker: %s" % e))
+                continue
+
+            if worker is None:
+                break
+
+            run = pending.popleft()
+            run.pid = worker.process.pid
+            run.start = run.marks['handoff'] = time.time()
+
+            # before the worker has the job, so none of the run's output goes to the run before it
+            if worker.output_fd is not None:
+                self.jobctl.output.start(worker.output_fd, run.job_name, run.run_id)
+
+            try:
+                worker.conn.send(run.kwargs)
+
+            except (IOError, OSError) as e:
+
+                if worker.output_fd is not None:
+                    self.jobctl.output.stop(worker.output_fd)
+
+                self._stop_worker(worker)
+                self.count[owner] -= 1
+                failed.append((run, "could not send job to worker pid %s: %s" % (worker.process.pid, e)))
+                continue
+
+            # the timeout counts from when the worker has the run, not from the wait for a free one
+            if run.timeout:
+                run.deadline = time.time() + run.timeout
+
+            self.busy[worker.conn.fileno()] = (worker, run)
+
+        return failed
+
+
+    def _checkout(self, owner):
+        """
+        returns an idle worker for owner, or a new one if the pool isn't full, otherwise None.
+        must be called with self.lock held.
+        """
+
+        workers = self.idle.setdefault(owner, [])
+
+        while workers:
+            worker = workers.pop()
+
+            if worker.process.is_alive():
+                return worker
+
+            self.logging.debug("Prefork worker pid %s for owner '%s' exited, replacing it.",
+                    worker.process.pid, owner)
+            self.count[owner] -= 1
+
+        if self.count.get(owner, 0) >= self.size:
+            return None
+
+        worker = self._spawn(owner)
+        self.count[owner] = self.count.get(owner, 0) + 1
+
+        return worker
+
+
+    def _report_failed(self, failed):
+
+        for run, error in failed:
+            self.on_finish(run, 'failed', None, error)
+
+
+    def _spawn(self, owner):
+
+        parent_conn, child_conn = multiprocessing.Pipe()
+
+        # under the supervisor's fork lock, like its forked runs, so the worker doesn't inherit the
+        #   write end of a forked run's output pipe (which would then never see EOF), and a forked
+        #   run doesn't inherit this one's
+        with self.jobctl.supervisor.fork_lock:
+
+            # with output_dir, the worker's stdout and stderr go to a pipe, read by OutputCapture
+            if self.jobctl.output is not None:
+                output_r, output_w = self.jobctl.output.pipe()
+
+            else:
+                output_r = output_w = None
+
+            process = multiprocessing.Process(target=self._worker_main, args=(child_conn, owner, output_r, output_w))
+            process.daemon = True
+
+            try:
+                process.start()
+
+            except OSError:
+
+                for fd in (output_r, output_w):
+
+                    if fd is not None:
+                        os.close(fd)
+
+                raise
+
+            if output_w is not None:
+                os.close(output_w)
+
+        child_conn.close()
+
+        if output_r is not None:
+            self.jobctl.output.add(output_r)
+
+        self.logging.debug("Started prefork worker pid %s for owner '%s'.", process.pid, owner)
+
+        return Worker(process, parent_conn, output_r)
+
+
+    def _stop_worker(self, worker):
+
+        try:
+            worker.conn.send(None)
+
+        except (IOError, OSError):
+            pass
+
+        worker.conn.close()
+        worker.process.join(1)
+
+        if worker.process.is_alive():
+            worker.process.terminate()
+            worker.process.join()
+
+
+    def _worker_main(self, conn, owner, output_r=None, output_w=None):
+        """main loop of a worker process. runs jobs sent by the daemon until told to stop or recycled"""
+
+        # its own process group, so a timed out or cancelled run takes anything it started down with it
+        os.setpgid(0, 0)
+
+        if output_w is not None:
+            os.dup2(output_w, 1)
+            os.dup2(output_w, 2)
+            os.close(output_w)
+            os.close(output_r)
+
+        self.jobctl.plugins.after_fork()
+        self.jobctl._drop_to_owner({'owner': owner, 'job_name': 'prefork worker'})
+
+        jobs = 0
+
+        while True:
+
+            try:
+                kwargs = conn.recv()
+
+            except EOFError:
+                break
+
+            if kwargs is None:
+                break
+
+            tracing.reset()
+            tracing.mark('child_start')
+
+            jobs += 1
+            recycle = False
+            before = resource.getrusage(resource.RUSAGE_SELF)
+
+            try:
+                # the pool routes by owner, this is just a second line of defense
+                if kwargs['owner'] != owner:
+                    raise ValueError("job owner '%s' does not match worker owner '%s'" % (kwargs['owner'], owner))
+
+                lib = self.jobctl._load_plugin(kwargs)
+                tracing.mark('plugin_loaded')
+
+                # ALL plugin's main() function should accept **kwargs
+                tracing.mark('main_start')
+                lib.main(**kwargs)
+                tracing.mark('main_end')
+
+                result = True, "Job: '%s' finished." % kwargs['job_name']
+
+            # sys.exit() and sys.exit(0) end the job, not the worker, and are a success
+            except SystemExit as e:
+
+                if e.code is None or e.code == 0:
+                    result = True, "Job: '%s' finished." % kwargs['job_name']
+
+                else:
+                    result = False, "Job: '%s' exited: %s" % (kwargs.get('job_name'), e.code)
+                    recycle = True
+
+            except Exception as e:
+                result = False, "Job: '%s' did not execute successfully, error: '%s'\n%s" \
+                        % (kwargs.get('job_name'), e, traceback.format_exc())
+                recycle = True
+
+            after = resource.getrusage(resource.RUSAGE_SELF)
+
+            if jobs >= self.max_jobs or after.ru_maxrss > self.max_rss:
+                recycle = True
+
+            # this run's share of the worker's rusage. maxrss can only be the worker's peak
+            rusage = {
+                'utime': after.ru_utime - before.ru_utime,
+                'stime': after.ru_stime - before.ru_stime,
+                'maxrss': after.ru_maxrss,
+                'inblock': after.ru_inblock - before.ru_inblock,
+                'oublock': after.ru_oublock - before.ru_oublock,
+                }
+
+            # the daemon stops reading this run's output once it has the result
+            sys.stdout.flush()
+            sys.stderr.flush()
+
+            conn.send(result + (recycle, rusage, dict(tracing.marks)))
+
+            if recycle:
+                break
+
+        conn.close()
+
+
+class Worker(object):
+    """a prefork worker process and the daemon's end of its pipe"""
+
+    def __init__(self, process, conn, output_fd=None):
+
+        self.process = process
+        self.conn = conn
+        self.output_fd = output_fd
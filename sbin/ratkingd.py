@@ -11,7 +11,7 @@ import select
 import sys, os, time, atexit
 from apscheduler.scheduler import Scheduler
 from pwd import getpwnam
-from signal import SIGTERM 
+from signal import SIGINT, SIGTERM, SIG_DFL, signal
 
 
 class Ratkingd(object):
@@ -116,7 +116,11 @@ class Ratkingd(object):
         # import some modules and then go to the strip club
         sys.path.append(self.config.get('main', 'lib_dir'))
         from ratking.engine import SchedCtl
+        from ratking.metrics import MetricsServer
         from ratking.rpchandler import RpcCtl
+        from ratking.scheduler import HeapScheduler
+        from ratking.util import get_option
+        from ratking.watcher import JobDirWatcher
 
         # who am i?
         realuser = os.getlogin()
@@ -149,7 +153,12 @@ class Ratkingd(object):
 
         logging.debug("APScheduler options: %s", sched_options)
 
-        self.sched = Scheduler(**sched_options)
+        # scheduler_engine=heap swaps APScheduler's scheduler for ratking's own, for large job counts
+        if get_option(self.config, 'scheduler_engine', 'apscheduler') == 'heap':
+            self.sched = HeapScheduler(**sched_options)
+
+        else:
+            self.sched = Scheduler(**sched_options)
 
         # we'll control the scheduler through the RatkingCtl class
         try:
@@ -163,10 +172,48 @@ class Ratkingd(object):
             print "Found you, error: %s" % e
             pass
 
+        # import every plugin up front, so job runs start with them already loaded
+        if get_option(self.config, 'preload_plugins', False):
+            ratking.job_control_instance.plugins.preload()
+
+        # keep the jobstore snapshot current, for the next start
+        if ratking.snapshot is not None:
+            ratking.snapshot.start()
+
+        # stop (SIGTERM) or ^C: write the last job changes to the snapshot before going
+        daemon_pid = os.getpid()
+
+        def shutdown(signum, frame):
+
+            # job runs are forked from here and inherit the handler, they go the default way
+            if os.getpid() != daemon_pid:
+                signal(signum, SIG_DFL)
+                os.kill(os.getpid(), signum)
+                return
+
+            logging.info("Received signal %d, shutting down...", signum)
+
+            if ratking.snapshot is not None:
+                ratking.snapshot.stop()
+
+            sys.exit(0)
+
+        signal(SIGTERM, shutdown)
+        signal(SIGINT, shutdown)
+
+        # pick up jobfile changes in job_dir without a restart
+        if get_option(self.config, 'watch_job_dir', False):
+            watcher = JobDirWatcher(ratking.job_control_instance, self.config, logging)
+            watcher.start()
+
+        # prometheus metrics over http, next to the xmlrpc server
+        if get_option(self.config, 'metrics_port', 0):
+            metrics = MetricsServer(ratking.job_control_instance.metrics, self.config, logging)
+            metrics.start()
    
         
         logging.info("Starting xmlrpc instance...")
-        ratrpc = RpcCtl(self.sched, self.config, logging)
+        ratrpc = RpcCtl(self.sched, self.config, logging, ratking)
         ratrpc.start_instance()
 
     '''
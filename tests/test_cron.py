@@ -0,0 +1,135 @@
+import random
+import unittest
+from datetime import datetime, timedelta
+
+from ratking import cron
+
+
+def fields(schedule):
+    """the masks of a schedule's fields, parsed on their own"""
+
+    minutes, hours, doms, months, dows = [ cron.parse_field(field, *spec)
+            for field, spec in zip(schedule.split(), cron.FIELDS) ]
+
+    return minutes, hours, doms, months, (dows | dows >> 7) & 0x7f
+
+
+def brute_force(schedule, start, limit=timedelta(days=400)):
+    """first minute at or after start that schedule fires at, checked day by day and minute by minute like cron"""
+
+    minutes, hours, doms, months, dows = fields(schedule)
+    star = schedule.split()[2].startswith('*') or schedule.split()[4].startswith('*')
+
+    t = start.replace(second=0, microsecond=0)
+
+    if t < start:
+        t += timedelta(minutes=1)
+
+    end = start + limit
+
+    while t < end:
+        dom = bool(doms >> t.day & 1)
+        dow = bool(dows >> ((t.weekday() + 1) % 7) & 1)
+
+        if not months >> t.month & 1 or not ((dom and dow) if star else (dom or dow)):
+            t = t.replace(hour=0, minute=0) + timedelta(days=1)
+            continue
+
+        if hours >> t.hour & 1 and minutes >> t.minute & 1:
+            return t
+
+        t += timedelta(minutes=1)
+
+    return None
+
+
+class TestNextFireTime(unittest.TestCase):
+
+    def next_fire(self, schedule, start):
+        return cron.CronSchedule(schedule).get_next_fire_time(start)
+
+
+    def test_every_minute(self):
+        self.assertEqual(self.next_fire('* * * * *', datetime(2026, 3, 1, 12, 0)), datetime(2026, 3, 1, 12, 0))
+        self.assertEqual(self.next_fire('* * * * *', datetime(2026, 3, 1, 12, 0, 1)), datetime(2026, 3, 1, 12, 1))
+
+
+    def test_steps_and_ranges(self):
+        self.assertEqual(self.next_fire('*/15 * * * *', datetime(2026, 3, 1, 12, 16)), datetime(2026, 3, 1, 12, 30))
+        self.assertEqual(self.next_fire('0-30/10 9-17 * * *', datetime(2026, 3, 1, 17, 31)),
+                datetime(2026, 3, 2, 9, 0))
+        self.assertEqual(self.next_fire('5/20 * * * *', datetime(2026, 3, 1, 12, 46)), datetime(2026, 3, 1, 13, 5))
+
+
+    def test_end_of_year(self):
+        self.assertEqual(self.next_fire('0 0 1 1 *', datetime(2026, 12, 31, 23, 59)), datetime(2027, 1, 1, 0, 0))
+
+
+    def test_weekdays_are_numbered_like_cron(self):
+        # 2026-03-01 is a sunday
+        self.assertEqual(self.next_fire('0 9 * * 0', datetime(2026, 3, 2)), datetime(2026, 3, 8, 9, 0))
+        self.assertEqual(self.next_fire('0 9 * * 7', datetime(2026, 3, 2)), datetime(2026, 3, 8, 9, 0))
+        self.assertEqual(self.next_fire('0 9 * * mon-fri', datetime(2026, 3, 7)), datetime(2026, 3, 9, 9, 0))
+        self.assertEqual(self.next_fire('0 9 * * 1-5', datetime(2026, 3, 7)), datetime(2026, 3, 9, 9, 0))
+
+
+    def test_day_of_month_or_day_of_week(self):
+        # the 15th, or any monday
+        self.assertEqual(self.next_fire('0 0 15 * mon', datetime(2026, 3, 10)), datetime(2026, 3, 15, 0, 0))
+        self.assertEqual(self.next_fire('0 0 15 * mon', datetime(2026, 3, 15, 0, 1)), datetime(2026, 3, 16, 0, 0))
+
+        # a stepped '*' still restricts, and then a day has to match both: the 1st, 11th, 21st or 31st, on a monday
+        self.assertEqual(self.next_fire('0 0 */10 * mon', datetime(2026, 3, 1)), datetime(2026, 5, 11, 0, 0))
+
+
+    def test_leap_day(self):
+        self.assertEqual(self.next_fire('0 0 29 2 *', datetime(2026, 3, 1)), datetime(2028, 2, 29, 0, 0))
+
+
+    def test_never(self):
+        self.assertEqual(self.next_fire('0 0 30 2 *', datetime(2026, 3, 1)), None)
+
+
+    def test_spread(self):
+        schedule = cron.SpreadSchedule(cron.CronSchedule('*/5 * * * *'), 90)
+
+        self.assertEqual(schedule.get_next_fire_time(datetime(2026, 3, 1, 12, 0)), datetime(2026, 3, 1, 12, 1, 30))
+        self.assertEqual(schedule.get_next_fire_time(datetime(2026, 3, 1, 12, 1, 31)), datetime(2026, 3, 1, 12, 6, 30))
+
+
+    def test_against_brute_force(self):
+        rand = random.Random(1)
+        schedules = ['*/7 * * * *', '30 */5 * * *', '0 12 1,15 * *', '10 8 * 2-4 sat,sun', '0 0 13 * 5',
+                '45 23 */10 */2 1-3', '0 6 31 * *']
+
+        for schedule in schedules:
+
+            for i in range(5):
+                start = datetime(2026, 1, 1) + timedelta(seconds=rand.randint(0, 365 * 86400))
+
+                self.assertEqual(self.next_fire(schedule, start), brute_force(schedule, start),
+                        "'%s' from %s" % (schedule, start))
+
+
+class TestParse(unittest.TestCase):
+
+    def test_invalid(self):
+
+        for schedule in ['* * * *', '60 * * * *', '* 24 * * *', '* * 0 * *', '* * * 13 *', '* * * * 8',
+                '*/0 * * * *', '5-1 * * * *', '* * * * funday']:
+            self.assertRaises(ValueError, cron.CronSchedule, schedule)
+
+
+    def test_compiled_once(self):
+        self.assertTrue(cron.compile_schedule('*/5 * * * *') is cron.compile_schedule('*/5  *  * * *'))
+
+
+    def test_numeric_weekdays(self):
+        self.assertTrue(cron.CronSchedule('0 9 * * 1-5').numeric_weekdays)
+        self.assertTrue(cron.CronSchedule('0 9 * * */2').numeric_weekdays)
+        self.assertFalse(cron.CronSchedule('0 9 * * mon-fri').numeric_weekdays)
+        self.assertFalse(cron.CronSchedule('0 9 1 * *').numeric_weekdays)
+
+
+if __name__ == '__main__':
+    unittest.main()
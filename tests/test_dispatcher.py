@@ -0,0 +1,187 @@
+import ConfigParser
+import logging
+import unittest
+
+from ratking.dispatcher import Dispatcher, parse_limits
+
+
+class Counter(object):
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def observe(self, value):
+        pass
+
+
+class FakeMetrics(object):
+
+    def __init__(self):
+        self.queue_rejected = Counter()
+        self.queue_expired = Counter()
+        self.queue_wait = Counter()
+
+
+class FakeSupervisor(object):
+    """starts nothing, hands out run ids and keeps the runs it was given"""
+
+    def __init__(self):
+        self.listeners = []
+        self.started = []
+
+    def dispatch(self, kwargs, max_instances, scheduled, fired, job_type):
+        self.started.append(kwargs['job_name'])
+        return len(self.started)
+
+
+class FakeJobCtl(object):
+
+    def __init__(self):
+        self.supervisor = FakeSupervisor()
+        self.metrics = FakeMetrics()
+
+
+class Finished(object):
+    """what the supervisor passes to its listeners when a run ends"""
+
+    def __init__(self, job_name, owner='alice', job_type=''):
+        self.job_name = job_name
+        self.owner = owner
+        self.job_type = job_type
+
+
+def run(job_name, owner='alice'):
+    return {'job_name': job_name, 'owner': owner}
+
+
+class TestDispatcher(unittest.TestCase):
+
+    def dispatcher(self, **options):
+
+        config = ConfigParser.SafeConfigParser()
+        config.add_section('main')
+
+        for option, value in options.items():
+            config.set('main', option, str(value))
+
+        self.jobctl = FakeJobCtl()
+
+        return Dispatcher(self.jobctl, config, logging)
+
+
+    def test_no_caps(self):
+        d = self.dispatcher()
+
+        self.assertEqual([ d.submit(run('job%d' % i)) for i in range(3) ], [1, 2, 3])
+        self.assertEqual(d.depth(), 0)
+
+
+    def test_queued_over_cap_and_started_on_release(self):
+        d = self.dispatcher(max_running=1)
+
+        self.assertEqual(d.submit(run('a')), 1)
+        self.assertEqual(d.submit(run('b')), 0)
+        self.assertEqual(d.depth(), 1)
+
+        d.release(Finished('a'))
+
+        self.assertEqual(self.jobctl.supervisor.started, ['a', 'b'])
+        self.assertEqual(d.depth(), 0)
+
+
+    def test_one_queued_run_per_job(self):
+        d = self.dispatcher(max_running=1)
+
+        d.submit(run('a'))
+        self.assertEqual(d.submit(run('b')), 0)
+        self.assertEqual(d.submit(run('b')), None)
+        self.assertEqual(d.depth(), 1)
+
+
+    def test_queue_max_size(self):
+        d = self.dispatcher(max_running=1, queue_max_size=2)
+
+        d.submit(run('a'))
+        d.submit(run('b'))
+        d.submit(run('c'))
+
+        self.assertEqual(d.submit(run('d')), None)
+        self.assertEqual(self.jobctl.metrics.queue_rejected.value, 1)
+
+
+    def test_priority(self):
+        d = self.dispatcher(max_running=1)
+
+        d.submit(run('a'))
+        d.submit(run('low'), priority=1)
+        d.submit(run('high'), priority=5)
+
+        d.release(Finished('a'))
+        self.assertEqual(self.jobctl.supervisor.started, ['a', 'high'])
+
+
+    def test_owner_cap_lets_other_owners_through(self):
+        d = self.dispatcher(max_running_per_owner=1, owner_limits='bob:2')
+
+        d.submit(run('a1'))
+        self.assertEqual(d.submit(run('a2')), 0)
+        self.assertEqual(d.submit(run('b1', 'bob')), 2)
+        self.assertEqual(d.submit(run('b2', 'bob')), 3)
+        self.assertEqual(d.submit(run('b3', 'bob')), 0)
+
+        d.release(Finished('b1', 'bob'))
+        self.assertEqual(self.jobctl.supervisor.started, ['a1', 'b1', 'b2', 'b3'])
+        self.assertEqual(d.depth(), 1)
+
+
+    def test_expired_on_release(self):
+        d = self.dispatcher(max_running=1, queue_max_wait=60)
+
+        d.submit(run('a'))
+        d.submit(run('b'))
+        d.queued['b'].queued_at -= 61
+
+        d.release(Finished('a'))
+
+        self.assertEqual(self.jobctl.supervisor.started, ['a'])
+        self.assertEqual(d.depth(), 0)
+        self.assertEqual(self.jobctl.metrics.queue_expired.value, 1)
+
+
+    def test_expired_replaced_on_submit(self):
+        d = self.dispatcher(max_running=1, queue_max_wait=60)
+
+        d.submit(run('a'))
+        d.submit(run('b'))
+        d.queued['b'].queued_at -= 61
+
+        # the stale run is dropped and the new one takes its place, while the cap is still full
+        self.assertEqual(d.submit(run('b')), 0)
+        self.assertEqual(d.depth(), 1)
+        self.assertEqual(self.jobctl.metrics.queue_expired.value, 1)
+
+        d.release(Finished('a'))
+
+        self.assertEqual(self.jobctl.supervisor.started, ['a', 'b'])
+        self.assertEqual(d.depth(), 0)
+        self.assertEqual(d.queue, [])
+
+
+    def test_not_started_is_released(self):
+        d = self.dispatcher(max_running=1)
+        self.jobctl.supervisor.dispatch = lambda *args: None
+
+        self.assertEqual(d.submit(run('a')), None)
+        self.assertEqual(d.running, 0)
+
+
+    def test_parse_limits(self):
+        self.assertEqual(parse_limits('alice:2, bob:8'), {'alice': 2, 'bob': 8})
+        self.assertEqual(parse_limits(''), {})
+
+
+if __name__ == '__main__':
+    unittest.main()